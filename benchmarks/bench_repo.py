@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Benchmarks for the hot paths of the MongoDB repository.
+
+By default the benchmarks run against an in-memory stand-in (mongomock), so they need no server and the numbers
+are comparable between versions of this package. Pass `--uri` to run them against a real (for example, a locally
+spawned) mongod instead.
+
+    python benchmarks/bench_repo.py --output bench.json
+    python benchmarks/bench_repo.py --compare bench.json
+
+With `--compare`, the run exits with status 1 if any benchmark is slower than the baseline by more than
+`--tolerance`.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import statistics
+import sys
+import timeit
+
+
+log = logging.getLogger("benchmarks")
+
+PAGE_SIZES = (10, 100, 1000)
+PAGE_DEPTHS = (0, 1000)
+
+
+def _make_document_class():
+    from mongoengine import Document, fields
+
+    class BenchDocument(Document):
+        meta = {
+            "collection": "bench_records",
+            "indexes": [{"name": "bench_name", "fields": ["name"]}, {"name": "bench_score", "fields": ["score"]}],
+            "strict": False,
+            "db_alias": "benchmarks",
+        }
+
+        name = fields.StringField(required=True)
+        score = fields.IntField(default=0)
+        tags = fields.ListField(fields.StringField())
+        owner_id = fields.ObjectIdField()
+        created_at = fields.DateTimeField()
+        deleted_at = fields.DateTimeField()
+
+    return BenchDocument
+
+
+def _record(i: int) -> dict:
+    from bson.objectid import ObjectId
+
+    return {
+        "name": f"Record {i:06d}",
+        "score": i % 100,
+        "tags": ["alpha", "beta", "gamma"][: i % 3 + 1],
+        "owner_id": ObjectId(),
+        "created_at": datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=i),
+    }
+
+
+def connect(uri: str = None):
+    """Connect the `benchmarks` alias to the given server, or to an in-memory stand-in.
+
+    :param str uri: The URI of the MongoDB server. If `None`, mongomock is used.
+    :return str: A description of the backend.
+    """
+    import mongoengine
+
+    if uri is None:
+        import mongomock
+
+        mongoengine.connect(
+            "benchmarks", host="mongodb://localhost", mongo_client_class=mongomock.MongoClient, alias="benchmarks"
+        )
+        return f"mongomock {mongomock.__version__}"
+
+    mongoengine.connect(host=uri, alias="benchmarks")
+    return "mongod " + mongoengine.get_db("benchmarks").client.server_info()["version"]
+
+
+class RepositoryBenchmarks(object):
+    """Sets up a collection and times the repository operations against it."""
+
+    def __init__(self, records: int = 5000, number: int = 20, repeat: int = 5):
+        """Initialize the RepositoryBenchmarks object.
+
+        :param int records: The number of records to seed the collection with.
+        :param int number: The number of calls per timing run.
+        :param int repeat: The number of timing runs per benchmark. The best and median runs are reported.
+        """
+        from sweetrpg_db.mongodb.repo import MongoDataRepository
+
+        self.records = records
+        self.number = number
+        self.repeat = repeat
+        self.document = _make_document_class()
+        self.repo = MongoDataRepository(model=dict, document=self.document, collection="bench_records")
+        self.results = {}
+
+    def seed(self):
+        """Empty the collection and fill it with `records` records."""
+        self.document._get_collection().delete_many({})
+        self.repo.create_many([_record(i) for i in range(self.records)])
+        self.ids = [r["_id"] for r in self.document._get_collection().find({}, {"_id": 1})]
+        self.sample = self.document._get_collection().find_one({"_id": self.ids[len(self.ids) // 2]})
+
+    def time(self, name: str, func, number: int = None):
+        """Time a function, and store the per-call timings in `results`.
+
+        :param str name: The name of the benchmark.
+        :param func: The function to time. It is called with no arguments.
+        :param int number: (Optional) The number of calls per timing run, if not the default.
+        """
+        number = number or self.number
+        runs = timeit.Timer(func).repeat(repeat=self.repeat, number=number)
+        per_call = [run / number for run in runs]
+        self.results[name] = {"best": min(per_call), "median": statistics.median(per_call), "number": number}
+        log.info("%-36s best %10.1f us  median %10.1f us", name, min(per_call) * 1e6, statistics.median(per_call) * 1e6)
+
+    def run(self) -> dict:
+        """Run all of the benchmarks.
+
+        :return dict: The timings, keyed by benchmark name.
+        """
+        from sweetrpg_db.mongodb.options import QueryOptions
+
+        self.seed()
+        repo = self.repo
+        ids = self.ids
+        counter = iter(range(10**9))
+
+        self.time("create", lambda: repo.create(_record(next(counter))))
+        self.time("get", lambda: repo.get(ids[next(counter) % len(ids)]))
+        self.time("get_raw", lambda: repo.get(ids[next(counter) % len(ids)], raw=True))
+
+        for size in PAGE_SIZES:
+            for depth in PAGE_DEPTHS:
+                options = QueryOptions(filters={}, sort=[("name", 1)], skip=depth, limit=size)
+                number = max(1, self.number * 10 // size)
+                self.time(f"query[limit={size},skip={depth}]", lambda: repo.query(options), number=number)
+                self.time(
+                    f"query_raw[limit={size},skip={depth}]", lambda: repo.query(options, raw=True), number=number
+                )
+
+        self.time("update", lambda: repo.update(ids[next(counter) % len(ids)], {"inc__score": 1}))
+
+        deletable = iter(ids[len(ids) // 2 :])
+        self.time("delete", lambda: repo.delete(next(deletable)))
+
+        record = self.sample
+        self.time("_modify_record", lambda: repo._modify_record(record), number=self.number * 100)
+
+        querystring = [
+            {"name": "name", "op": "eq", "val": "Record 000001"},
+            {"name": "score", "op": "ge", "val": 50},
+            {"name": "tags", "op": "in_", "val": ["alpha", "beta"]},
+            {"name": "deleted_at", "op": "is_", "val": False},
+        ]
+        self.time(
+            "QueryOptions.set_filters",
+            lambda: QueryOptions().set_filters(from_querystring=querystring),
+            number=self.number * 100,
+        )
+
+        self.document._get_collection().delete_many({})
+        return self.results
+
+
+def environment(backend: str) -> dict:
+    """Describes the environment the benchmarks ran in.
+
+    :param str backend: A description of the database backend.
+    :return dict: The versions of Python, this package and its database dependencies.
+    """
+    import mongoengine
+    import pymongo
+    import sweetrpg_db
+
+    return {
+        "backend": backend,
+        "python": platform.python_version(),
+        "sweetrpg_db": sweetrpg_db.__version__,
+        "pymongo": pymongo.version,
+        "mongoengine": mongoengine.__version__,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Compare timings with a baseline.
+
+    :param dict results: The timings of this run.
+    :param dict baseline: The timings of the baseline run.
+    :param float tolerance: The fraction by which a benchmark may be slower than the baseline.
+    :return list: The names of the benchmarks that regressed.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            log.info("%-36s (new)", name)
+            continue
+        ratio = result["best"] / previous["best"]
+        regressed = ratio > 1 + tolerance
+        log.info("%-36s %6.2fx%s", name, ratio, "  REGRESSED" if regressed else "")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the sweetrpg-db MongoDB repository.")
+    parser.add_argument("--uri", help="The URI of a MongoDB server to use instead of the in-memory stand-in.")
+    parser.add_argument("--records", type=int, default=5000, help="The number of records to seed.")
+    parser.add_argument("--number", type=int, default=20, help="The number of calls per timing run.")
+    parser.add_argument("--repeat", type=int, default=5, help="The number of timing runs per benchmark.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare the results with a baseline JSON file written by --output.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="The allowed slowdown when comparing.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    log.setLevel(logging.INFO)
+    backend = connect(args.uri)
+    report = {"environment": environment(backend)}
+    log.info("Environment: %s", report["environment"])
+
+    benchmarks = RepositoryBenchmarks(records=args.records, number=args.number, repeat=args.repeat)
+    report["results"] = benchmarks.run()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["environment"]["backend"] != backend:
+            log.warning("The baseline was run against %s, not %s", baseline["environment"]["backend"], backend)
+        regressions = compare(report["results"], baseline["results"], args.tolerance)
+        if regressions:
+            log.error("%d benchmark(s) regressed: %s", len(regressions), ", ".join(regressions))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
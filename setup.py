@@ -7,9 +7,11 @@ setup(
         "dnspython~=2.0",
         "marshmallow~=3.0",
         "mongoengine~=0.27",
-        "PyMongo[srv]~=3.0",
+        "PyMongo[srv]>=3.12,<5",
         "sweetrpg-model-core",
         "sweetrpg-common",
     ],
-    extras_require={},
+    extras_require={
+        "async": ["motor~=3.0"],
+    },
 )
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+The `sweetrpg-db` command, which exports and imports collections.
+
+    sweetrpg-db --uri mongodb://localhost/sweetrpg export volumes volumes.jsonl --workers 8
+    sweetrpg-db --uri mongodb://localhost/sweetrpg import volumes volumes.jsonl --upsert
+"""
+
+import argparse
+from bson import json_util
+import importlib
+import logging
+from mongoengine import DynamicDocument
+import os
+import sys
+from .mongodb.connection import connections
+from .mongodb.options import QueryOptions
+from .mongodb.repo import MongoDataRepository
+from .mongodb.transfer import FORMATS, export_records, import_records
+
+
+def _import_object(path: str):
+    """Import an object from a `package.module:name` path."""
+    module_name, _, name = path.partition(":")
+    if not name:
+        raise ValueError(f"Expected 'package.module:name', not '{path}'")
+    return getattr(importlib.import_module(module_name), name)
+
+
+def _document_class(collection: str, alias: str, path: str = None) -> type:
+    """Returns the document class to read and write a collection with.
+
+    :param str collection: The name of the collection.
+    :param str alias: The connection alias.
+    :param str path: (Optional) The `package.module:Class` path of a document class. If `None`, a dynamic
+        document class that accepts any fields is used.
+    :return type: The document class.
+    """
+    if path:
+        document_class = _import_object(path)
+        if document_class._get_collection_name() != collection:
+            raise ValueError(f"{document_class.__name__} is stored in '{document_class._get_collection_name()}'")
+        return document_class
+
+    meta = {"collection": collection, "db_alias": alias, "strict": False}
+    return type(f"CLI_{collection}", (DynamicDocument,), {"meta": meta})
+
+
+def _repo(args) -> MongoDataRepository:
+    if args.alias not in connections:
+        connections.register(args.alias, host=args.uri, max_pool_size=max(100, args.workers * 2))
+    document_class = _document_class(args.collection, args.alias, args.document)
+    kwargs = {}
+    if getattr(args, "schema", None):
+        kwargs["schema"] = _import_object(args.schema)
+    return MongoDataRepository(
+        model=dict, document=document_class, collection=args.collection, alias=args.alias, **kwargs
+    )
+
+
+def export_command(args) -> int:
+    options = QueryOptions(
+        filters=json_util.loads(args.filter) if args.filter else None,
+        projection=args.fields.split(",") if args.fields else None,
+    )
+    result = export_records(
+        _repo(args),
+        args.path,
+        fmt=args.format,
+        options=options,
+        deleted=args.deleted,
+        workers=args.workers,
+        batch_size=args.batch_size,
+    )
+    print(f"Exported {result.written_count} records from {args.collection}", file=sys.stderr)
+    return 0
+
+
+def import_command(args) -> int:
+    result = import_records(
+        _repo(args),
+        args.path,
+        fmt=args.format,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        upsert=args.upsert,
+        validate=args.validate,
+    )
+    print(f"Imported {result.written_count} of {result.count} records into {args.collection}", file=sys.stderr)
+    for index, error in result.errors[:10]:
+        print(f"  record {index}: {error}", file=sys.stderr)
+    if len(result.errors) > 10:
+        print(f"  ... and {len(result.errors) - 10} more errors", file=sys.stderr)
+    return 1 if result.errors else 0
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """Build the argument parser for the command.
+
+    :return ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(prog="sweetrpg-db", description="Export and import SweetRPG collections.")
+    parser.add_argument(
+        "--uri", default=os.environ.get("MONGODB_URI"), help="The MongoDB URI, including the database name."
+    )
+    parser.add_argument("--alias", default="sweetrpg-db", help="The connection alias to register.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log progress.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("collection", help="The name of the collection.")
+    common.add_argument("path", help="The file to write or read, or '-' for standard output or input.")
+    common.add_argument("--document", help="The 'package.module:Class' of the collection's document class.")
+    common.add_argument("--format", choices=FORMATS, help="The file format. By default it is guessed from the path.")
+    common.add_argument("--workers", type=int, default=4, help="The number of parallel workers.")
+    common.add_argument("--batch-size", type=int, default=1000, help="The number of records per batch.")
+
+    export_parser = commands.add_parser("export", parents=[common], help="Export a collection to a file.")
+    export_parser.add_argument("--filter", help="A query filter, as Extended JSON.")
+    export_parser.add_argument("--fields", help="A comma-separated list of the fields to export.")
+    export_parser.add_argument("--schema", help="The 'package.module:Class' of a schema to take the fields from.")
+    export_parser.add_argument("--deleted", action="store_true", help="Include records marked deleted.")
+    export_parser.set_defaults(func=export_command)
+
+    import_parser = commands.add_parser("import", parents=[common], help="Import a file into a collection.")
+    import_parser.add_argument("--upsert", action="store_true", help="Replace records that already exist.")
+    import_parser.add_argument("--validate", action="store_true", help="Skip records that fail validation.")
+    import_parser.set_defaults(func=import_command)
+
+    return parser
+
+
+def main(argv: list = None) -> int:
+    """Run the `sweetrpg-db` command.
+
+    :param list argv: (Optional) The arguments. By default they are taken from the command line.
+    :return int: The exit status.
+    """
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if not args.uri:
+        parser.error("--uri or the MONGODB_URI environment variable is required")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+    try:
+        return args.func(args)
+    except (OSError, ValueError) as e:
+        print(f"sweetrpg-db: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,604 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Asyncio MongoDB repository module.
+"""
+
+import asyncio
+import copy
+import datetime
+from .instrumentation import OperationEvent
+from .options import QueryOptions
+from .repo import BaseMongoDataRepository
+from .results import QueryPage, WriteResult
+from .unit_of_work import AsyncUnitOfWork
+from pymongo import ReturnDocument
+import logging
+from mongoengine.queryset import transform
+from mongoengine import Document
+from typing import AsyncIterator, Iterable
+
+
+class AsyncMongoDataRepository(BaseMongoDataRepository):
+    """A repository class for interacting with a MongoDB database from asyncio code.
+
+    This has the same API and soft-delete semantics as :class:`sweetrpg_db.mongodb.repo.MongoDataRepository`,
+    but its methods are coroutines built on a `Motor <https://motor.readthedocs.io/>`_ database. The document class
+    is only used to validate, hydrate and convert records; all database access goes through Motor.
+
+    Motor is not installed by default; install the ``async`` extra (``pip install sweetrpg-db[async]``), which
+    brings in Motor 3 and, with it, PyMongo 4.
+    """
+
+    def __init__(self, **kwargs):
+        """Create an asyncio MongoDB repository instance.
+
+        :param kwargs: Keyword arguments for setting up the repository connection. These are the same as for
+            :class:`sweetrpg_db.mongodb.repo.MongoDataRepository`, with the addition of:
+        :key db: A :class:`motor.motor_asyncio.AsyncIOMotorDatabase` object used for connecting to the database.
+            The connection registry is only used for the per-operation read preferences and write concerns, since
+            Motor creates its own client.
+        """
+        super().__init__(**kwargs)
+        self.db = kwargs["db"]
+
+    def _get_collection(self, operation: str = None):
+        """Returns the collection to use for an operation, with the operation's read preference and write concern.
+
+        :param str operation: (Optional) The name of the repository operation, such as `query`.
+        :return AsyncIOMotorCollection: The Motor collection.
+        """
+        connection = self.connection
+        cached = self._collections.get(operation)
+        # the collection is made again if the alias has been registered, unregistered or replaced since
+        if cached is not None and cached[0] is connection:
+            return cached[1]
+
+        collection = self.db[self.collection]
+        if connection is not None:
+            options = connection.collection_options(operation)
+            if options:
+                collection = collection.with_options(**options)
+        self._collections[operation] = (connection, collection)
+        return collection
+
+    def _related_kwargs(self) -> dict:
+        return {**super()._related_kwargs(), "db": self.db}
+
+    def unit_of_work(self, max_size: int = 1000, ordered: bool = False) -> AsyncUnitOfWork:
+        """Start a unit of work, which queues creates, updates and deletes and writes them with one `bulk_write`.
+            Use it with `async with`; see :meth:`MongoDataRepository.unit_of_work`.
+
+        :param int max_size: The number of queued writes at which the unit of work is flushed automatically.
+        :param bool ordered: Send the writes in order, stopping at the first failure.
+        :return AsyncUnitOfWork: The unit of work.
+        """
+        return AsyncUnitOfWork(self, max_size=max_size, ordered=ordered)
+
+    async def ensure_live_indexes(self, create: bool = True) -> list:
+        """Check that the collection has partial indexes covering only records which are not marked "deleted", and
+            create any that are missing. See :meth:`MongoDataRepository.ensure_live_indexes`.
+
+        :param bool create: Create the missing indexes. If `False`, they are only reported.
+        :return list: The names of the indexes that were missing.
+        """
+        collection = self._get_collection("ensure_live_indexes")
+        missing = self._missing_indexes(self._live_index_models(), await collection.index_information())
+        names = [model.document["name"] for model in missing]
+        logging.info("Missing %s live indexes: %s", self.document_class.__name__, names)
+        if create and missing:
+            await collection.create_indexes(missing)
+
+        return names
+
+    async def create(self, data: dict) -> Document:
+        """Inserts a new object in the database with the data provided.
+
+        :param dict data: The data for the object
+        :return Document: The inserted document.
+        """
+        with self._instrument("create") as event:
+            logging.debug("data: %s", data)
+
+            logging.info("Creating new %s record with data %s...", self.document_class.__name__, data)
+            doc = self.document_class(**data)
+            logging.debug("doc: %s", doc)
+            doc.validate()
+            son = doc.to_mongo()
+            result = await self._get_collection("create").insert_one(son)
+            doc.pk = result.inserted_id
+            logging.debug("saved doc: %s", doc)
+            self._invalidate(doc.pk)
+
+            return event.set_result(doc)
+
+    async def get(self, record_id: str, deleted: bool = False, raw: bool = False) -> Document | dict:
+        """Fetch a single record from the database.
+
+        :param str record_id: The identifier for the record to fetch.
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the record as a plain dictionary (see :meth:`_modify_record`) instead of a document.
+        :return Document: An instance of the object type from `model_class`, or a dictionary if `raw` is set.
+        """
+        with self._instrument("get") as event:
+            logging.debug("record_id: %s", record_id)
+            id_value = self._id_value(record_id)
+            logging.debug("id_value: %s", id_value)
+            query_filter = {"_id": id_value}
+            if not deleted:
+                query_filter.update(self._deleted_filter())
+            logging.debug("query_filter: %s", query_filter)
+            event.query_filter = query_filter
+
+            key = (self.collection, id_value, deleted)
+            record = self.cache.get(key) if self.cache is not None else None
+            if record is None:
+                logging.info("Fetching %s record for ID %s...", self.document_class.__name__, id_value)
+                # a write that invalidates the key during the read keeps the record it read out of the cache
+                token = self.cache.reserve(key) if self.cache is not None else None
+                try:
+                    collection = self._get_collection("get")
+                    record = await collection.find_one(query_filter, projection=self._default_fields())
+                    logging.debug("record: %s", record)
+                    if record is None:
+                        return event.set_result(None)
+                    if token is not None:
+                        self.cache.set(key, record, token=token)
+                finally:
+                    if token is not None:
+                        self.cache.release(key, token)
+            if self.cache is not None:
+                record = copy.deepcopy(record)
+
+            return event.set_result(self._from_record(record, raw=raw))
+
+    async def get_many(
+        self, record_ids: Iterable, deleted: bool = False, chunk_size: int = 1000, raw: bool = False
+    ) -> list:
+        """Fetch multiple records from the database with as few queries as possible.
+
+        :param Iterable record_ids: The identifiers for the records to fetch. These can be strings or
+            :class:`bson.objectid.ObjectId` values, mixed.
+        :param bool deleted: Include "deleted" objects in the query
+        :param int chunk_size: The maximum number of IDs to send in a single `$in` query.
+        :param bool raw: Return the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return list: A list with one entry per requested ID, in the same order. Entries for records that were not
+            found are `None`.
+        """
+        with self._instrument("get_many") as event:
+            id_values = list(map(self._id_value, record_ids))
+            logging.debug("id_values: %s", id_values)
+            unique_ids = list(dict.fromkeys(id_values))
+
+            logging.info("Fetching %d %s records...", len(unique_ids), self.document_class.__name__)
+            records = {}
+            for start in range(0, len(unique_ids), chunk_size):
+                query_filter = {"_id": {"$in": unique_ids[start : start + chunk_size]}}
+                if not deleted:
+                    query_filter.update(self._deleted_filter())
+                logging.debug("query_filter: %s", query_filter)
+                event.query_filter = query_filter
+                cursor = self._get_collection("get_many").find(query_filter, projection=self._default_fields())
+                async for record in cursor:
+                    records[record["_id"]] = self._from_record(record, raw=raw)
+            logging.debug("records: %s", records)
+
+            return event.set_result([records.get(id_value) for id_value in id_values])
+
+    def _cursor(self, options: QueryOptions, deleted: bool = False, keyset: bool = False, event: OperationEvent = None):
+        """Build a Motor cursor for the specified query options.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool keyset: Sort for keyset pagination, even if the options do not have a cursor.
+        :param OperationEvent event: (Optional) The instrumentation event to record the query filter in.
+        :return AsyncIOMotorCursor: The cursor. No query is sent until it is iterated.
+        """
+        query_filter, sort, projection = self._query_spec(options, deleted=deleted, keyset=keyset)
+        if event is not None:
+            event.query_filter = query_filter
+
+        logging.info("Searching for %s records matching filter %s...", self.document_class, query_filter)
+        collection = self._get_collection(event.operation if event is not None else "query")
+        cursor = collection.find(query_filter, projection=self._projection_spec(projection))
+        if sort:
+            cursor = cursor.sort(self._sort_spec(sort))
+        return cursor.skip(options.skip).limit(options.limit)
+
+    async def _prefetch(self, records: list, tree: dict, raw: bool = False):
+        """Fetch the records that a list of records references, with one query per relation level, and attach
+            them. See :meth:`sweetrpg_db.mongodb.repo.MongoDataRepository._prefetch`.
+        """
+        for name, subtree in tree.items():
+            related, _, _ = self._relation(name)
+            ids = self._reference_ids(records, name, raw=raw)
+            logging.debug("including %d %s records", len(ids), name)
+            if not ids:
+                continue
+            found = {i: r for i, r in zip(ids, await related.get_many(ids, raw=raw)) if r is not None}
+            self._attach(records, name, found, raw=raw)
+            if subtree:
+                await related._prefetch(list(found.values()), subtree, raw=raw)
+
+    async def query(self, options: QueryOptions, deleted: bool = False, raw: bool = False) -> list:
+        """Perform a query for objects in the database.
+
+        :param QueryOptions options: (Optional) Options specifying limits to the query's returned results. The
+            records referenced through the relations in `include` are fetched and attached (see :meth:`_prefetch`).
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return list: Returns a list of Document-subclass instances matching the query, or dictionaries if `raw`
+            is set.
+        """
+        with self._instrument("query") as event:
+            key = (self.collection, options.cache_key(), deleted)
+            records = self.query_cache.get(key) if self.query_cache is not None else None
+            if records is None:
+                token = self.query_cache.reserve(key) if self.query_cache is not None else None
+                try:
+                    records = await self._cursor(options, deleted=deleted, event=event).to_list(length=None)
+                    logging.debug("records: %s", records)
+                    if token is not None:
+                        self.query_cache.set(key, records, token=token)
+                finally:
+                    if token is not None:
+                        self.query_cache.release(key, token)
+            if self.query_cache is not None:
+                records = copy.deepcopy(records)
+
+            if raw:
+                records = self.converter.convert_many(records)
+            else:
+                records = list(map(self.document_class._from_son, records))
+            if options.include:
+                await self._prefetch(records, self._include_tree(options.include), raw=raw)
+            return event.set_result(records)
+
+    async def count(self, options: QueryOptions = None, deleted: bool = False, estimated: bool = False) -> int:
+        """Count the objects in the database matching a query.
+
+        :param QueryOptions options: (Optional) Options with the filters to count. Pagination options are ignored.
+        :param bool deleted: Include "deleted" objects in the count
+        :param bool estimated: If the options have no filters, use the collection's metadata for a fast, estimated
+            count instead of counting matches. The estimate includes objects marked "deleted".
+        :return int: The number of matching objects.
+        """
+        with self._instrument("count") as event:
+            options = options or QueryOptions(filters={})
+            if estimated and not options.filters:
+                logging.info("Estimating the number of %s records...", self.document_class.__name__)
+                return event.set_result(await self._get_collection("count").estimated_document_count())
+
+            query_filter = self._options_filter(options, deleted=deleted)
+            event.query_filter = query_filter
+            logging.info("Counting %s records matching filter %s...", self.document_class.__name__, query_filter)
+            return event.set_result(await self._get_collection("count").count_documents(query_filter))
+
+    async def query_with_total(
+        self, options: QueryOptions, deleted: bool = False, raw: bool = False, estimated: bool = False
+    ) -> QueryPage:
+        """Perform a query for a page of objects, and count all of the objects matching the query, in a single
+            `$facet` aggregation.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :param bool estimated: If the options have no filters, run the query and an estimated count (see
+            :meth:`count`) instead of the aggregation.
+        :return QueryPage: The page of Document-subclass instances, with the number of matching objects in `total`.
+        """
+        with self._instrument("query_with_total") as event:
+            if estimated and not options.filters:
+                records = await self.query(options, deleted=deleted, raw=raw)
+                total = await self.count(options, deleted=deleted, estimated=True)
+                return event.set_result(QueryPage(records, total=total))
+
+            pipeline = self._total_pipeline(options, deleted=deleted)
+            event.query_filter = pipeline[0]["$match"]
+            logging.info("Searching for %s records with total matching pipeline %s...", self.document_class, pipeline)
+            results = await self._get_collection("query_with_total").aggregate(pipeline).to_list(length=None)
+            logging.debug("results: %s", results)
+            total = results[0]["total"][0]["count"] if results[0]["total"] else 0
+
+            records = [self._from_record(record, raw=raw) for record in results[0]["records"]]
+            if options.include:
+                await self._prefetch(records, self._include_tree(options.include), raw=raw)
+            return event.set_result(QueryPage(records, total=total))
+
+    async def query_page(self, options: QueryOptions, deleted: bool = False, raw: bool = False) -> QueryPage:
+        """Fetch a page of objects using keyset pagination.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results. `limit` must be set
+            for a next-page cursor to be returned.
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return QueryPage: The page of Document-subclass instances, and the cursor for the next page.
+        """
+        with self._instrument("query_page") as event:
+            records = await self._cursor(options, deleted=deleted, keyset=True, event=event).to_list(length=None)
+            logging.debug("records: %s", records)
+
+            next_cursor = None
+            if options.limit > 0 and len(records) == options.limit:
+                next_cursor = self._make_cursor(records[-1], options.keyset_sort())
+            logging.debug("next_cursor: %s", next_cursor)
+
+            records = [self._from_record(record, raw=raw) for record in records]
+            if options.include:
+                await self._prefetch(records, self._include_tree(options.include), raw=raw)
+            return event.set_result(QueryPage(records, next_cursor))
+
+    async def iter_query(
+        self, options: QueryOptions, deleted: bool = False, batch_size: int = 100, raw: bool = False
+    ) -> AsyncIterator[Document | dict]:
+        """Perform a query for objects in the database, yielding them as they are read from the cursor.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param int batch_size: The number of documents the server returns in each cursor batch.
+        :param bool raw: Yield the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return AsyncIterator[Document]: An async iterator of Document-subclass instances matching the query, or
+            dictionaries if `raw` is set.
+        """
+        with self._instrument("iter_query") as event:
+            event.result_count = 0
+            async for record in self._cursor(options, deleted=deleted, event=event).batch_size(batch_size):
+                event.result_count += 1
+                record = self._from_record(record, raw=raw)
+                with event.paused():
+                    yield record
+
+    async def _split_boundaries(self, query_filter: dict, parts: int, key: str = "_id", operation: str = None) -> list:
+        """Find the values of a key that split the records matching a filter into ranges of about the same size.
+            See :meth:`sweetrpg_db.mongodb.repo.MongoDataRepository._split_boundaries`.
+        """
+        collection = self._get_collection(operation)
+        field = self._db_field(key)
+        total = await collection.count_documents(query_filter) if parts > 1 else 0
+        logging.debug("splitting %d records into %d parts by %s", total, parts, field)
+        boundaries = []
+        for part in range(1, parts):
+            skip = total * part // parts
+            if skip == 0:
+                continue
+            async for record in collection.find(query_filter, {field: 1}, sort=[(field, 1)], skip=skip, limit=1):
+                self._add_boundary(boundaries, record, field)
+        logging.debug("boundaries: %s", boundaries)
+
+        return boundaries
+
+    async def _scan_range(
+        self, collection, query_filter: dict, fields: dict, sort: list, batch_size: int, output: asyncio.Queue
+    ):
+        """Read one range of a parallel scan into an output queue, in chunks of up to `batch_size` records. A
+            `None` is queued when the range is finished, or the exception if reading it failed.
+        """
+        try:
+            chunk = []
+            async for record in collection.find(query_filter, fields, sort=sort, batch_size=batch_size):
+                chunk.append(record)
+                if len(chunk) >= batch_size:
+                    await output.put(chunk)
+                    chunk = []
+            if chunk:
+                await output.put(chunk)
+            await output.put(None)
+        except Exception as e:
+            await output.put(e)
+
+    async def iter_parallel(
+        self,
+        options: QueryOptions = None,
+        deleted: bool = False,
+        workers: int = 4,
+        key: str = "_id",
+        ordered: bool = False,
+        batch_size: int = 100,
+        raw: bool = False,
+    ) -> AsyncIterator[Document | dict]:
+        """Scan the objects matching a query with several cursors concurrently, yielding them as they are read.
+            Each range of `key` is read by its own task; see
+            :meth:`sweetrpg_db.mongodb.repo.MongoDataRepository.iter_parallel`.
+
+        :param QueryOptions options: (Optional) Options with the filters and projection of the scan. Sorting and
+            pagination are not supported.
+        :param bool deleted: Include "deleted" objects in the scan
+        :param int workers: The number of ranges to read concurrently.
+        :param str key: The name of an indexed field to split the ranges on.
+        :param bool ordered: Yield the records in order of `key`.
+        :param int batch_size: The number of documents the server returns in each cursor batch.
+        :param bool raw: Yield the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return AsyncIterator[Document]: An async iterator of Document-subclass instances matching the query, or
+            dictionaries if `raw` is set.
+        :raises ValueError: If the options sort or paginate.
+        """
+        with self._instrument("iter_parallel") as event:
+            event.result_count = 0
+            options = options or QueryOptions()
+            query_filter, fields, sort = self._scan_spec(options, deleted=deleted, key=key, ordered=ordered)
+            event.query_filter = query_filter
+            boundaries = await self._split_boundaries(query_filter, workers, key=key, operation="iter_parallel")
+            filters = self._range_filters(query_filter, boundaries, key=key)
+            logging.info("Scanning %s records in %d range(s) of %s...", self.document_class, len(filters), key)
+
+            collection = self._get_collection("iter_parallel")
+            if ordered:
+                outputs = [asyncio.Queue(maxsize=2) for _ in filters]
+            else:
+                outputs = [asyncio.Queue(maxsize=2 * len(filters))] * len(filters)
+            tasks = [
+                asyncio.create_task(self._scan_range(collection, range_filter, fields, sort, batch_size, output))
+                for range_filter, output in zip(filters, outputs)
+            ]
+            try:
+                # each queue is read until all of the ranges that write to it have finished
+                if ordered:
+                    readers = [(output, 1) for output in outputs]
+                else:
+                    readers = [(outputs[0], len(filters))]
+                for output, ranges in readers:
+                    finished = 0
+                    while finished < ranges:
+                        chunk = await output.get()
+                        if chunk is None:
+                            finished += 1
+                            continue
+                        if isinstance(chunk, Exception):
+                            raise chunk
+                        for record in chunk:
+                            event.result_count += 1
+                            record = self._from_record(record, raw=raw)
+                            with event.paused():
+                                yield record
+            finally:
+                # stop the tasks if the caller stops iterating early
+                for task in tasks:
+                    task.cancel()
+
+    def _aggregate_cursor(
+        self,
+        options: QueryOptions,
+        stages: list,
+        deleted: bool,
+        allow_disk_use: bool,
+        batch_size: int,
+        event: OperationEvent,
+    ):
+        pipeline = self._aggregate_pipeline(options, stages, deleted=deleted)
+        event.query_filter = pipeline[0]["$match"]
+        kwargs = {"allowDiskUse": allow_disk_use}
+        if batch_size is not None:
+            kwargs["batchSize"] = batch_size
+
+        logging.info("Aggregating %s records with pipeline %s...", self.document_class, pipeline)
+        return self._get_collection(event.operation).aggregate(pipeline, **kwargs)
+
+    async def aggregate(
+        self,
+        options: QueryOptions = None,
+        stages: list = None,
+        deleted: bool = False,
+        allow_disk_use: bool = False,
+        batch_size: int = None,
+    ) -> list:
+        """Run an aggregation pipeline on the server, starting with stages built from the query options.
+
+        :param QueryOptions options: (Optional) Options specifying the records to aggregate.
+        :param list stages: (Optional) The aggregation stages to run on the matched records.
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool allow_disk_use: Let the server write temporary files for stages that exceed its memory limit.
+        :param int batch_size: (Optional) The number of documents the server returns in each cursor batch.
+        :return list: The documents the pipeline produced, as dictionaries.
+        """
+        with self._instrument("aggregate") as event:
+            cursor = self._aggregate_cursor(options, stages, deleted, allow_disk_use, batch_size, event)
+            return event.set_result(await cursor.to_list(length=None))
+
+    async def iter_aggregate(
+        self,
+        options: QueryOptions = None,
+        stages: list = None,
+        deleted: bool = False,
+        allow_disk_use: bool = False,
+        batch_size: int = 100,
+    ) -> AsyncIterator[dict]:
+        """Run an aggregation pipeline on the server, yielding the documents as they are read from the cursor.
+
+        :param QueryOptions options: (Optional) Options specifying the records to aggregate.
+        :param list stages: (Optional) The aggregation stages to run on the matched records.
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool allow_disk_use: Let the server write temporary files for stages that exceed its memory limit.
+        :param int batch_size: The number of documents the server returns in each cursor batch.
+        :return AsyncIterator[dict]: An async iterator of the documents the pipeline produced.
+        """
+        with self._instrument("iter_aggregate") as event:
+            event.result_count = 0
+            async for document in self._aggregate_cursor(options, stages, deleted, allow_disk_use, batch_size, event):
+                event.result_count += 1
+                with event.paused():
+                    yield document
+
+    async def update(
+        self, record_id: str, update: dict, deleted: bool = False, projection: list = None, raw: bool = False
+    ) -> Document | dict:
+        """Update the specified record with a single `find_one_and_update` call.
+
+        :param str record_id: The ID of the record to update.
+        :param dict update: The data to update for the record. Keys use the same format as :meth:`Document.update`.
+        :param bool deleted: Indicates whether the update operation should look for deleted records.
+        :param list projection: A list of field names to include in the returned record. If `None`, the
+            repository's default projection is used, or all fields are returned if there is none.
+        :param bool raw: Return the record as a plain dictionary (see :meth:`_modify_record`) instead of a document.
+        :return Document: The update version of the object, or `None` if no matching record was found.
+        """
+        with self._instrument("update") as event:
+            id_value = self._id_value(record_id)
+
+            update_oper = transform.update(self.document_class, **update)
+            logging.debug("update_oper: %s", update_oper)
+
+            logging.info("Updating %s record %s...", self.model_class, id_value)
+            query_filter = {"_id": id_value}
+            if not deleted:
+                query_filter.update(self._deleted_filter())
+            logging.debug("query_filter: %s", query_filter)
+            event.query_filter = query_filter
+
+            fields = self._projection_spec(projection or self.default_projection)
+            record = await self._get_collection("update").find_one_and_update(
+                query_filter, update_oper, projection=fields, return_document=ReturnDocument.AFTER
+            )
+            logging.debug("record: %s", record)
+            self._invalidate(id_value)
+            if record is None:
+                logging.info("No document found to update for record ID %s.", record_id)
+                return event.set_result(None)
+
+            return event.set_result(self._from_record(record, raw=raw))
+
+    async def delete(self, record_id: str, actually: bool = False) -> WriteResult:
+        """'Delete' the specified record by setting its `deleted_at` field to the current timestamp.
+
+        :param str record_id: The record ID of the object to delete. This can be a string or :class:`bson.objectid.ObjectId`.
+        :param bool actually: Actually delete the record instead of just marking it "deleted". Unlike
+            :meth:`MongoDataRepository.delete`, document delete rules are not applied.
+        :return WriteResult: The matched and modified counts. This is truthy if the record was found.
+        """
+        with self._instrument("delete") as event:
+            id_value = self._id_value(record_id)
+
+            if actually:
+                logging.info("Deleting %s record %s...", self.model_class.__name__, id_value)
+                event.query_filter = {"_id": id_value}
+                result = await self._get_collection("delete").delete_one(event.query_filter)
+                logging.debug("result: %s", result.raw_result)
+                self._invalidate(id_value)
+                return event.set_result(WriteResult(result.deleted_count, result.deleted_count))
+
+            logging.info("Marking %s record %s deleted...", self.model_class.__name__, id_value)
+            query_filter = {"_id": id_value, **self._deleted_filter()}
+            event.query_filter = query_filter
+            now = datetime.datetime.utcnow()
+            result = await self._get_collection("delete").update_one(query_filter, {"$set": {"deleted_at": now}})
+            logging.debug("result: %s", result.raw_result)
+            self._invalidate(id_value)
+
+            return event.set_result(WriteResult(result.matched_count, result.modified_count))
+
+    async def restore(self, record_id: str) -> WriteResult:
+        """Restore a record that was marked "deleted" by :meth:`delete`, by removing its `deleted_at` field.
+
+        :param str record_id: The record ID of the object to restore. This can be a string or :class:`bson.objectid.ObjectId`.
+        :return WriteResult: The matched and modified counts. This is truthy if a deleted record was found.
+        """
+        with self._instrument("restore") as event:
+            id_value = self._id_value(record_id)
+
+            logging.info("Restoring %s record %s...", self.model_class.__name__, id_value)
+            query_filter = {"_id": id_value, "deleted_at": {"$type": "date"}}
+            event.query_filter = query_filter
+            result = await self._get_collection("restore").update_one(query_filter, {"$unset": {"deleted_at": ""}})
+            logging.debug("result: %s", result.raw_result)
+            self._invalidate(id_value)
+
+            return event.set_result(WriteResult(result.matched_count, result.modified_count))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+In-process caching for MongoDB repositories.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded cache with least-recently-used eviction and an optional time-to-live.
+
+    Keys are tuples whose first item is the name of the collection the entry was read from, so that all of the
+    entries for a collection can be invalidated at once. The cached records depend on how a repository reads them,
+    so a cache can only be shared by repositories that read the collection the same way (see :meth:`bind`).
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0, clock=time.monotonic):
+        """Initialize the LRUCache object.
+
+        :param int max_size: The maximum number of entries to keep.
+        :param float ttl: The number of seconds an entry stays valid. If `None`, entries do not expire.
+        :param clock: A function returning the current time in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._collections = {}
+        self._settings = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<LRUCache(max_size={self.max_size}, ttl={self.ttl}, size={len(self)})>"
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key: tuple):
+        del self._entries[key]
+        keys = self._collections.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._collections[key[0]]
+
+    def bind(self, collection: str, settings):
+        """Record the settings that a repository reads a collection's records with, such as its projection.
+
+        :param str collection: The name of the collection.
+        :param settings: A hashable description of how the records are read.
+        :raises ValueError: If the collection's records are already cached with other settings, since entries read
+            with one set of settings would be returned to a repository that uses another.
+        """
+        with self._lock:
+            bound = self._settings.setdefault(collection, settings)
+        if bound != settings:
+            raise ValueError(f"'{collection}' records are already cached with other settings: {bound}")
+
+    def get(self, key: tuple):
+        """Fetch an entry from the cache.
+
+        :param tuple key: The key of the entry.
+        :return: The cached value, or `None` if there is no valid entry for the key.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= self.clock():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def reserve(self, key: tuple) -> object:
+        """Start reading a value to store in the cache. If the key is invalidated before the value is stored with
+        the returned token, the value may be stale, and :meth:`set` does not store it.
+
+            token = cache.reserve(key)
+            try:
+                cache.set(key, read(), token=token)
+            finally:
+                cache.release(key, token)
+
+        :param tuple key: The key of the entry.
+        :return object: The token to pass to :meth:`set` and :meth:`release`.
+        """
+        token = object()
+        with self._lock:
+            self._pending.setdefault(key, set()).add(token)
+        return token
+
+    def release(self, key: tuple, token: object):
+        """Finish a read started with :meth:`reserve`, whether or not its value was stored.
+
+        :param tuple key: The key of the entry.
+        :param object token: The token returned by :meth:`reserve`.
+        """
+        with self._lock:
+            tokens = self._pending.get(key)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._pending[key]
+
+    def set(self, key: tuple, value, token: object = None) -> bool:
+        """Store an entry in the cache, evicting the least recently used entries if the cache is full.
+
+        :param tuple key: The key of the entry.
+        :param value: The value to store.
+        :param object token: (Optional) The token returned by :meth:`reserve` before the value was read. If the key
+            has been invalidated since, the value is not stored.
+        :return bool: `True` if the value was stored.
+        """
+        expires_at = self.clock() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if token is not None and token not in self._pending.get(key, ()):
+                return False
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            self._collections.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key: tuple):
+        """Remove an entry from the cache, if it exists.
+
+        :param tuple key: The key of the entry.
+        """
+        with self._lock:
+            # reads of the key that are in progress may have read the old value
+            self._pending.pop(key, None)
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_collection(self, collection: str):
+        """Remove all of the entries for a collection.
+
+        :param str collection: The name of the collection.
+        """
+        with self._lock:
+            for key in [key for key in self._pending if key[0] == collection]:
+                del self._pending[key]
+            for key in list(self._collections.get(collection, ())):
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries from the cache. The counters are not reset."""
+        with self._lock:
+            self._entries.clear()
+            self._collections.clear()
+            self._pending.clear()
+
+    def stats(self) -> dict:
+        """Returns the cache's counters.
+
+        :return dict: The number of hits, misses and evictions, and the current size.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._entries)}
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Registry of MongoDB connections that repositories bind to by alias.
+"""
+
+import logging
+import mongoengine
+from mongoengine.connection import DEFAULT_CONNECTION_NAME
+from pymongo import ReadPreference
+from pymongo.read_preferences import _ServerMode
+from pymongo.write_concern import WriteConcern
+import threading
+
+
+class ConnectionSettings(object):
+    """The settings for one connection alias: how the client is created, and the read preference and write
+    concern that each repository operation uses.
+    """
+
+    _read_preferences = {
+        "primary": ReadPreference.PRIMARY,
+        "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+        "secondary": ReadPreference.SECONDARY,
+        "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+        "nearest": ReadPreference.NEAREST,
+    }
+
+    def __init__(
+        self,
+        alias: str = DEFAULT_CONNECTION_NAME,
+        host: str = None,
+        max_pool_size: int = 100,
+        min_pool_size: int = 0,
+        compressors: list = None,
+        connect_timeout: float = 20.0,
+        server_selection_timeout: float = 30.0,
+        socket_timeout: float = None,
+        read_preference: _ServerMode | str = None,
+        write_concern: WriteConcern | dict = None,
+        read_preferences: dict = None,
+        write_concerns: dict = None,
+        **client_kwargs,
+    ):
+        """Initialize the ConnectionSettings object.
+
+        :param str alias: The name of the connection.
+        :param str host: The MongoDB URI to connect to. The database name is taken from the URI.
+        :param int max_pool_size: The maximum number of connections in the client's pool.
+        :param int min_pool_size: The number of connections the client keeps open when idle.
+        :param list compressors: (Optional) The wire compressors to offer, in order of preference, such as
+            `["zstd", "snappy", "zlib"]`.
+        :param float connect_timeout: The number of seconds to wait for a connection to open.
+        :param float server_selection_timeout: The number of seconds to wait for a suitable server.
+        :param float socket_timeout: (Optional) The number of seconds to wait for a response. If `None`, there is
+            no limit.
+        :param read_preference: (Optional) The default read preference, as a
+            :class:`pymongo.read_preferences.ReadPreference` mode or its name, such as `secondaryPreferred`.
+        :param write_concern: (Optional) The default write concern, as a :class:`pymongo.write_concern.WriteConcern`
+            or a dictionary of its arguments.
+        :param dict read_preferences: (Optional) Read preferences by repository operation name, such as `query` or
+            `count`, which override the default.
+        :param dict write_concerns: (Optional) Write concerns by repository operation name, such as `create` or
+            `delete`, which override the default.
+        :param client_kwargs: Other keyword arguments for :class:`pymongo.mongo_client.MongoClient`.
+        """
+        self.alias = alias
+        self.host = host
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.compressors = compressors
+        self.connect_timeout = connect_timeout
+        self.server_selection_timeout = server_selection_timeout
+        self.socket_timeout = socket_timeout
+        self.read_preference = self._read_preference(read_preference)
+        self.write_concern = self._write_concern(write_concern)
+        self.read_preferences = {k: self._read_preference(v) for k, v in (read_preferences or {}).items()}
+        self.write_concerns = {k: self._write_concern(v) for k, v in (write_concerns or {}).items()}
+        self.client_kwargs = client_kwargs
+
+    def __repr__(self):
+        return f"<ConnectionSettings(alias={self.alias}, max_pool_size={self.max_pool_size}, read_preference={self.read_preference}, write_concern={self.write_concern})>"
+
+    @classmethod
+    def _read_preference(cls, value):
+        if value is None or isinstance(value, _ServerMode):
+            return value
+        try:
+            return cls._read_preferences[value]
+        except KeyError:
+            raise ValueError(f"Unknown read preference '{value}'") from None
+
+    @staticmethod
+    def _write_concern(value):
+        if value is None or isinstance(value, WriteConcern):
+            return value
+        return WriteConcern(**value)
+
+    def client_options(self) -> dict:
+        """Returns the keyword arguments for creating the client.
+
+        :return dict: Keyword arguments for :class:`pymongo.mongo_client.MongoClient`.
+        """
+        options = {
+            "maxPoolSize": self.max_pool_size,
+            "minPoolSize": self.min_pool_size,
+            "connectTimeoutMS": int(self.connect_timeout * 1000),
+            "serverSelectionTimeoutMS": int(self.server_selection_timeout * 1000),
+        }
+        if self.socket_timeout is not None:
+            options["socketTimeoutMS"] = int(self.socket_timeout * 1000)
+        if self.compressors:
+            options["compressors"] = ",".join(self.compressors)
+        options.update(self.client_kwargs)
+        return options
+
+    def collection_options(self, operation: str = None) -> dict:
+        """Returns the options for the collection that a repository operation uses.
+
+        :param str operation: (Optional) The name of the repository operation, such as `query`.
+        :return dict: Keyword arguments for :meth:`pymongo.collection.Collection.with_options`. Options that are not
+            configured are left out.
+        """
+        options = {}
+        read_preference = self.read_preferences.get(operation, self.read_preference)
+        if read_preference is not None:
+            options["read_preference"] = read_preference
+        write_concern = self.write_concerns.get(operation, self.write_concern)
+        if write_concern is not None:
+            options["write_concern"] = write_concern
+        return options
+
+
+class ConnectionRegistry(object):
+    """A registry of connection settings by alias.
+
+    Registering an alias also registers it with mongoengine, so document classes whose `db_alias` matches use the
+    same client. The client is created the first time it is used.
+    """
+
+    def __init__(self):
+        """Initialize the ConnectionRegistry object."""
+        self._settings = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<ConnectionRegistry(aliases={list(self._settings)})>"
+
+    def __contains__(self, alias: str):
+        return alias in self._settings
+
+    def register(self, alias: str = DEFAULT_CONNECTION_NAME, host: str = None, **kwargs) -> ConnectionSettings:
+        """Register the settings for a connection alias.
+
+        :param str alias: The name of the connection.
+        :param str host: The MongoDB URI to connect to.
+        :param kwargs: The other arguments for :class:`ConnectionSettings`.
+        :return ConnectionSettings: The settings.
+        :raises ValueError: If the alias is already registered.
+        """
+        settings = ConnectionSettings(alias=alias, host=host, **kwargs)
+        with self._lock:
+            if alias in self._settings:
+                raise ValueError(f"Connection '{alias}' is already registered")
+            logging.info("Registering MongoDB connection '%s'...", alias)
+            mongoengine.register_connection(
+                alias,
+                host=host,
+                read_preference=settings.read_preference or ReadPreference.PRIMARY,
+                **settings.client_options(),
+            )
+            self._settings[alias] = settings
+
+        return settings
+
+    def get(self, alias: str) -> ConnectionSettings:
+        """Returns the settings for an alias.
+
+        :param str alias: The name of the connection.
+        :return ConnectionSettings: The settings, or `None` if the alias is not registered.
+        """
+        return self._settings.get(alias)
+
+    def client(self, alias: str = DEFAULT_CONNECTION_NAME):
+        """Returns the client for an alias, creating it if needed.
+
+        :param str alias: The name of the connection.
+        :return MongoClient: The client.
+        """
+        return mongoengine.get_connection(alias)
+
+    def database(self, alias: str = DEFAULT_CONNECTION_NAME):
+        """Returns the database for an alias, creating the client if needed.
+
+        :param str alias: The name of the connection.
+        :return Database: The database named in the alias's URI.
+        """
+        return mongoengine.get_db(alias)
+
+    def unregister(self, alias: str):
+        """Close the client for an alias, and forget its settings.
+
+        :param str alias: The name of the connection.
+        """
+        with self._lock:
+            logging.info("Unregistering MongoDB connection '%s'...", alias)
+            self._settings.pop(alias, None)
+            mongoengine.disconnect(alias)
+
+
+# the registry that repositories look up their alias in by default
+connections = ConnectionRegistry()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Conversion of raw MongoDB records into plain dictionaries.
+"""
+
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+import datetime
+from mongoengine import fields
+from typing import Iterable
+
+
+def convert_value(value):
+    """Convert a value of any type to its plain representation.
+
+    :param any value: The value to convert. Supports :class:`bson.objectid.ObjectId`,
+        :class:`datetime.datetime`, :class:`bson.timestamp.Timestamp`, and lists of
+        any of those types.
+    :return any: The converted value. Values of other types are returned unchanged.
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    elif isinstance(value, datetime.datetime):
+        return _format_datetime(value)
+    elif isinstance(value, Timestamp):
+        return value.as_datetime()
+    elif isinstance(value, list):
+        return list(map(convert_value, value))
+
+    return value
+
+
+def _format_datetime(value: datetime.datetime) -> str:
+    return value.replace(tzinfo=datetime.timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _convert_object_id(value):
+    if value.__class__ is ObjectId:
+        return str(value)
+    return convert_value(value)
+
+
+def _convert_datetime(value):
+    if value.__class__ is datetime.datetime:
+        return _format_datetime(value)
+    return convert_value(value)
+
+
+def _list_converter(item_converter):
+    def convert_list(value):
+        if value.__class__ is list:
+            return [item_converter(item) for item in value]
+        return convert_value(value)
+
+    return convert_list
+
+
+class RecordConverter(object):
+    """Converts raw records of a document class into plain dictionaries.
+
+    The converter looks at the field definitions of the document class once, and picks a conversion for each
+    field up front, so converting a record does not need to inspect the type of every value. Fields that are not
+    defined on the document class (or whose type is not known) are converted with :func:`convert_value`.
+    """
+
+    _cache = {}
+    _plain_fields = (
+        fields.StringField,
+        fields.IntField,
+        fields.FloatField,
+        fields.BooleanField,
+        fields.DecimalField,
+    )
+
+    def __init__(self, document_class=None):
+        """Initialize the RecordConverter object.
+
+        :param document_class: The class of the document the records belong to. If `None`, every value is
+            converted with :func:`convert_value`.
+        """
+        self.document_class = document_class
+        self._converters = {"_id": ("id", convert_value)}
+        if document_class is not None:
+            for field in document_class._fields.values():
+                key = "id" if field.db_field == "_id" else field.db_field
+                self._converters[field.db_field] = (key, self._compile_field(field))
+
+    def __repr__(self):
+        return f"<RecordConverter(document_class={self.document_class})>"
+
+    @classmethod
+    def for_document(cls, document_class) -> "RecordConverter":
+        """Returns the converter for a document class, creating it the first time it is needed.
+
+        :param document_class: The class of the document the records belong to.
+        :return RecordConverter: The cached converter for the class.
+        """
+        converter = cls._cache.get(document_class)
+        if converter is None:
+            converter = cls._cache[document_class] = cls(document_class)
+        return converter
+
+    def _compile_field(self, field):
+        """Picks the conversion function for a field.
+
+        :param BaseField field: The field definition.
+        :return: A function to convert a value of the field, or `None` if values are used unchanged.
+        """
+        if isinstance(field, fields.ObjectIdField):
+            return _convert_object_id
+        elif isinstance(field, (fields.ReferenceField, fields.LazyReferenceField)) and not field.dbref:
+            return _convert_object_id
+        elif isinstance(field, (fields.DateTimeField, fields.DateField)):
+            return _convert_datetime
+        elif isinstance(field, fields.ListField) and field.field is not None:
+            item_converter = self._compile_field(field.field)
+            if item_converter is None:
+                return None
+            return _list_converter(item_converter)
+        elif isinstance(field, self._plain_fields):
+            return None
+
+        return convert_value
+
+    def convert(self, record: dict) -> dict:
+        """Convert a record by converting any values to strings, and renaming the internal '_id'
+            field to 'id'.
+
+        :param dict record: The record to convert.
+        :return dict: The converted record.
+        """
+        converters = self._converters
+        modified_record = {}
+        for k, v in record.items():
+            converter = converters.get(k)
+            if converter is None:
+                modified_record[k] = convert_value(v)
+                continue
+            key, convert = converter
+            if convert is None or v is None:
+                modified_record[key] = v
+            else:
+                modified_record[key] = convert(v)
+
+        return modified_record
+
+    def convert_many(self, records: Iterable) -> list:
+        """Convert a batch of records.
+
+        :param Iterable records: The records to convert.
+        :return list: The converted records, in the same order.
+        """
+        convert = self.convert
+        return [convert(record) for record in records]
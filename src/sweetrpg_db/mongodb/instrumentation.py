@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Instrumentation for MongoDB repository operations.
+"""
+
+from .results import BulkCreateResult, QueryPage, WriteResult
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+
+def redact_filter(value):
+    """Replace the values in a query filter with `?`, keeping the field names and operators.
+
+    >>> redact_filter({"name": {"$in": ["a", "b"]}, "$or": [{"score": 1}, {"score": {"$gt": 2}}]})
+    {'name': {'$in': '?'}, '$or': [{'score': '?'}, {'score': {'$gt': '?'}}]}
+
+    :param any value: The query filter.
+    :return any: The shape of the filter.
+    """
+    if isinstance(value, dict):
+        return {k: redact_filter(v) for k, v in value.items()}
+    elif isinstance(value, list) and value and all(isinstance(v, dict) for v in value):
+        return list(map(redact_filter, value))
+    return "?"
+
+
+class OperationEvent(object):
+    """Describes one repository operation, and is passed to the repository's listeners when it finishes.
+
+    For streaming operations, such as `iter_query`, the operation finishes when its iterator is exhausted, closed
+    or garbage-collected. Their `duration` only covers the time spent reading and converting records; the time the
+    caller spends between records is recorded separately in `consumer_time`.
+    """
+
+    def __init__(self, operation: str, collection: str):
+        """Initialize the OperationEvent object.
+
+        :param str operation: The name of the repository method, such as `get` or `query`.
+        :param str collection: The name of the collection.
+        """
+        self.operation = operation
+        self.collection = collection
+        self.query_filter = None
+        self.result_count = None
+        self.duration = None
+        self.consumer_time = 0.0
+        self.error = None
+
+    def __repr__(self):
+        return f"<OperationEvent(operation={self.operation}, collection={self.collection}, filter_shape={self.filter_shape}, duration={self.duration}, consumer_time={self.consumer_time}, result_count={self.result_count}, error={self.error!r})>"
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Add the time spent in the block to `consumer_time` instead of `duration`. Streaming operations wrap each
+            `yield` in this, so that a slow caller does not make the operation look slow.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.consumer_time += time.perf_counter() - start
+
+    def set_result(self, value):
+        """Set `result_count` from the value an operation returns.
+
+        :param any value: The value returned by the operation.
+        :return any: The value, unchanged.
+        """
+        if value is None:
+            self.result_count = 0
+        elif isinstance(value, (list, QueryPage)):
+            self.result_count = sum(1 for record in value if record is not None)
+        elif isinstance(value, BulkCreateResult):
+            self.result_count = len(value)
+        elif isinstance(value, WriteResult):
+            self.result_count = value.modified_count
+        elif not isinstance(value, int):
+            self.result_count = 1
+        return value
+
+    @property
+    def filter_shape(self):
+        """The query filter of the operation, with its values redacted (see :func:`redact_filter`)."""
+        if self.query_filter is None:
+            return None
+        return redact_filter(self.query_filter)
+
+
+class SlowQueryLogger(object):
+    """A repository listener that logs operations which take longer than a threshold."""
+
+    def __init__(self, threshold: float = 0.1, logger: logging.Logger = None):
+        """Initialize the SlowQueryLogger object.
+
+        :param float threshold: The duration, in seconds, at or above which an operation is logged.
+        :param Logger logger: (Optional) The logger to write to. The root logger is used by default.
+        """
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger()
+
+    def __repr__(self):
+        return f"<SlowQueryLogger(threshold={self.threshold})>"
+
+    def __call__(self, event: OperationEvent):
+        if event.duration < self.threshold:
+            return
+        self.logger.warning(
+            "Slow %s on %s took %.3fs (filter %s, %s results, error %r)",
+            event.operation,
+            event.collection,
+            event.duration,
+            event.filter_shape,
+            event.result_count,
+            event.error,
+        )
+
+
+class HistogramCollector(object):
+    """A repository listener that collects a histogram of operation durations, per collection and operation."""
+
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: tuple = default_buckets):
+        """Initialize the HistogramCollector object.
+
+        :param tuple buckets: The upper bounds of the histogram buckets, in seconds, in increasing order. Durations
+            above the last bound are counted in an extra overflow bucket.
+        """
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<HistogramCollector(buckets={self.buckets})>"
+
+    def __call__(self, event: OperationEvent):
+        key = (event.collection, event.operation)
+        index = bisect.bisect_left(self.buckets, event.duration)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    "counts": [0] * (len(self.buckets) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                    "results": 0,
+                    "errors": 0,
+                }
+            series["counts"][index] += 1
+            series["count"] += 1
+            series["sum"] += event.duration
+            series["results"] += event.result_count or 0
+            if event.error is not None:
+                series["errors"] += 1
+
+    def snapshot(self) -> dict:
+        """Returns a copy of the collected data.
+
+        :return dict: A dictionary keyed by `(collection, operation)`. Each value has the per-bucket `counts` (not
+            cumulative), the total `count` and `sum` of durations, and the number of `results` and `errors`.
+        """
+        with self._lock:
+            return {key: dict(series, counts=list(series["counts"])) for key, series in self._series.items()}
+
+    def reset(self):
+        """Discard the collected data."""
+        with self._lock:
+            self._series.clear()
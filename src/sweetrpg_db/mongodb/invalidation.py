@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Cache invalidation driven by MongoDB change streams.
+"""
+
+from bson import json_util
+import logging
+import os
+from pymongo.errors import OperationFailure, PyMongoError
+import threading
+import time
+
+
+class TokenStore(object):
+    """Keeps the resume token of a change stream in memory. Subclasses persist it, so that a restarted process
+    resumes where the previous one stopped.
+    """
+
+    def __init__(self):
+        """Initialize the TokenStore object."""
+        self.token = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}(token={self.token})>"
+
+    def load(self) -> dict:
+        """Returns the stored resume token.
+
+        :return dict: The token, or `None` if there is none.
+        """
+        return self.token
+
+    def save(self, token: dict):
+        """Store a resume token.
+
+        :param dict token: The token, or `None` to forget the stored token.
+        """
+        self.token = token
+
+
+class FileTokenStore(TokenStore):
+    """Keeps the resume token of a change stream in a file."""
+
+    def __init__(self, path: str):
+        """Initialize the FileTokenStore object.
+
+        :param str path: The path of the file. It is created when the first token is saved.
+        """
+        super().__init__()
+        self.path = path
+
+    def __repr__(self):
+        return f"<FileTokenStore(path={self.path})>"
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                self.token = json_util.loads(f.read())
+        except FileNotFoundError:
+            self.token = None
+        return self.token
+
+    def save(self, token: dict):
+        self.token = token
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(json_util.dumps(token))
+        os.replace(temp_path, self.path)
+
+
+class ChangeStreamInvalidator(object):
+    """Watches a repository's collection for changes made by any process, and removes the changed records from the
+    repository's caches as the changes arrive.
+
+    Change streams need a replica set (a single-node replica set is enough). Call :meth:`start` to watch in a
+    background thread, or :meth:`run` to watch in the current one.
+    """
+
+    # changes to one record
+    _record_operations = ("insert", "update", "replace", "delete")
+    # changes that affect every record in the collection
+    _collection_operations = ("drop", "rename", "dropDatabase", "invalidate")
+    # server error codes meaning the stream cannot be resumed from the stored token
+    _history_lost_codes = (260, 280, 286)
+
+    def __init__(
+        self,
+        repo,
+        token_store: TokenStore = None,
+        refresh: bool = False,
+        max_await_time: float = 1.0,
+        retry_delay: float = 5.0,
+        save_interval: float = 1.0,
+    ):
+        """Initialize the ChangeStreamInvalidator object.
+
+        :param BaseMongoDataRepository repo: The repository whose caches to invalidate.
+        :param TokenStore token_store: (Optional) Where to keep the resume token. By default it is only kept in
+            memory, so a new process starts from the current time.
+        :param bool refresh: Replace changed records in the `get()` cache with the changed document, instead of
+            removing them. Records are only removed if the repository has a default projection.
+        :param float max_await_time: The number of seconds the server waits for changes before returning an empty
+            batch, which is also how often a stop request is checked.
+        :param float retry_delay: The number of seconds to wait before reconnecting after an error.
+        :param float save_interval: The minimum number of seconds between saves of the resume token.
+        """
+        self.repo = repo
+        self.token_store = token_store or TokenStore()
+        self.refresh = refresh
+        self.max_await_time = max_await_time
+        self.retry_delay = retry_delay
+        self.save_interval = save_interval
+        self.changes = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self._token = None
+        self._saved_at = 0.0
+
+    def __repr__(self):
+        return f"<ChangeStreamInvalidator(repo={self.repo}, refresh={self.refresh}, changes={self.changes})>"
+
+    def _pipeline(self) -> list:
+        fields = {"operationType": 1, "documentKey": 1}
+        if self.refresh:
+            fields["fullDocument"] = 1
+        operations = list(self._record_operations + self._collection_operations)
+        return [{"$match": {"operationType": {"$in": operations}}}, {"$project": fields}]
+
+    def _clear(self):
+        for cache in (self.repo.cache, self.repo.query_cache):
+            if cache is not None:
+                cache.invalidate_collection(self.repo.collection)
+
+    def handle(self, change: dict):
+        """Apply one change event to the repository's caches.
+
+        :param dict change: The change event, as returned by the change stream.
+        """
+        self.changes += 1
+        operation = change["operationType"]
+        if operation in self._collection_operations:
+            logging.info("Clearing cached %s records after '%s'", self.repo.collection, operation)
+            self._clear()
+            return
+
+        id_value = change["documentKey"]["_id"]
+        logging.debug("change: %s %s", operation, id_value)
+        self.repo._invalidate(id_value)
+        document = change.get("fullDocument")
+        if self.refresh and document is not None and self.repo.cache is not None and not self.repo.default_projection:
+            self.repo.cache.set((self.repo.collection, id_value, True), document)
+            if self.repo._is_live(document):
+                self.repo.cache.set((self.repo.collection, id_value, False), document)
+
+    def _save_token(self, token: dict, force: bool = False):
+        if token is None or token == self._token:
+            return
+        now = time.monotonic()
+        if force or now - self._saved_at >= self.save_interval:
+            self.token_store.save(token)
+            self._token = token
+            self._saved_at = now
+
+    def _watch(self, token: dict):
+        collection = self.repo._get_collection("watch")
+        full_document = "updateLookup" if self.refresh else None
+        return collection.watch(
+            self._pipeline(),
+            full_document=full_document,
+            resume_after=token,
+            max_await_time_ms=int(self.max_await_time * 1000),
+        )
+
+    def run(self):
+        """Watch the collection until :meth:`stop` is called. Errors are logged, and the stream is reopened from
+        the last resume token. If the server no longer has the changes after that token, the collection's cache
+        entries are cleared and watching starts from the current time.
+        """
+        self._stopping.clear()
+        token = self.token_store.load()
+        logging.info("Watching %s for changes from token %s...", self.repo.collection, token)
+        while not self._stopping.is_set():
+            try:
+                with self._watch(token) as stream:
+                    while not self._stopping.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            self.handle(change)
+                        token = stream.resume_token
+                        self._save_token(token)
+            except OperationFailure as e:
+                if e.code not in self._history_lost_codes:
+                    logging.warning("Change stream on %s failed: %s", self.repo.collection, e)
+                    self._stopping.wait(self.retry_delay)
+                    continue
+                logging.warning("Cannot resume change stream on %s, clearing its cache: %s", self.repo.collection, e)
+                self._clear()
+                token = None
+                self.token_store.save(None)
+                self._token = None
+            except PyMongoError as e:
+                logging.warning("Change stream on %s failed: %s", self.repo.collection, e)
+                self._stopping.wait(self.retry_delay)
+            finally:
+                self._save_token(token, force=True)
+
+        logging.info("Stopped watching %s for changes", self.repo.collection)
+
+    def start(self):
+        """Watch the collection in a background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run, name=f"invalidator-{self.repo.collection}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop watching, and wait for the background thread to finish.
+
+        :param float timeout: (Optional) The number of seconds to wait for the thread.
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Request-scoped loaders that batch single-record fetches into one `$in` query per collection.
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+from typing import Iterable
+
+
+class BaseRecordLoader(object):
+    """The parts of a record loader that do not depend on how the database is accessed.
+
+    A loader belongs to one request: it remembers every record it has loaded, so it should be discarded (or
+    :meth:`clear`-ed) when the request ends, and after writes that it should see.
+    """
+
+    def __init__(self, repo, deleted: bool = False, raw: bool = False, max_batch_size: int = 1000):
+        """Initialize the loader.
+
+        :param BaseMongoDataRepository repo: The repository to load records from.
+        :param bool deleted: Also load records marked "deleted".
+        :param bool raw: Load the records as plain dictionaries instead of documents.
+        :param int max_batch_size: The maximum number of IDs to send in a single `$in` query.
+        """
+        self.repo = repo
+        self.deleted = deleted
+        self.raw = raw
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self._cache = {}
+        self._pending = {}
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}(repo={self.repo}, cached={len(self._cache)}, batches={self.batches})>"
+
+    def _take_pending(self) -> tuple:
+        pending = self._pending
+        self._pending = {}
+        self.batches += 1
+        logging.debug("loading batch of %d %s records", len(pending), self.repo.collection)
+        return pending, {"deleted": self.deleted, "chunk_size": self.max_batch_size, "raw": self.raw}
+
+    def clear(self, record_id=None):
+        """Forget a loaded record, or all of them, so that the next load fetches it again.
+
+        :param record_id: (Optional) The ID of the record to forget. If `None`, all records are forgotten.
+        """
+        if record_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(self.repo._id_value(record_id), None)
+
+
+class DeferredRecord(object):
+    """A record that a :class:`RecordLoader` will fetch, together with the other deferred records, when any of
+    them is first needed.
+    """
+
+    def __init__(self, loader, id_value):
+        """Initialize the DeferredRecord object.
+
+        :param RecordLoader loader: The loader that fetches the record.
+        :param id_value: The ID of the record.
+        """
+        self.loader = loader
+        self.id_value = id_value
+
+    def __repr__(self):
+        return f"<DeferredRecord(id_value={self.id_value})>"
+
+    def get(self):
+        """Returns the record, fetching it and every other deferred record of the loader if needed.
+
+        :return Document: The record, or `None` if it was not found.
+        """
+        return self.loader._resolve(self.id_value)
+
+
+class RecordLoader(BaseRecordLoader):
+    """Loads records by ID for :class:`sweetrpg_db.mongodb.repo.MongoDataRepository`, fetching each record at most
+    once per loader.
+
+    Code that resolves many references can :meth:`defer` each of them first: the first :meth:`DeferredRecord.get`
+    then fetches every deferred record with one `$in` query. :meth:`load` fetches a record right away, together
+    with any records deferred so far.
+    """
+
+    def _dispatch(self):
+        pending, kwargs = self._take_pending()
+        ids = list(pending)
+        for id_value, record in zip(ids, self.repo.get_many(ids, **kwargs)):
+            self._cache[id_value] = record
+
+    def _resolve(self, id_value):
+        if id_value not in self._cache:
+            self._pending[id_value] = None
+            self._dispatch()
+        return self._cache[id_value]
+
+    def prime(self, record_id, record):
+        """Remember a record that was read some other way, so that loading it needs no query.
+
+        :param record_id: The ID of the record.
+        :param record: The record.
+        """
+        self._cache[self.repo._id_value(record_id)] = record
+
+    def defer(self, record_id) -> DeferredRecord:
+        """Queue a record to be fetched with the next batch.
+
+        :param record_id: The ID of the record. This can be a string or :class:`bson.objectid.ObjectId`.
+        :return DeferredRecord: The deferred record.
+        """
+        id_value = self.repo._id_value(record_id)
+        if id_value not in self._cache:
+            self._pending[id_value] = None
+        return DeferredRecord(self, id_value)
+
+    def load(self, record_id):
+        """Returns a record, fetching it (and any deferred records) if it has not been loaded yet.
+
+        :param record_id: The ID of the record. This can be a string or :class:`bson.objectid.ObjectId`.
+        :return Document: The record, or `None` if it was not found.
+        """
+        return self._resolve(self.repo._id_value(record_id))
+
+    def load_many(self, record_ids: Iterable) -> list:
+        """Returns several records, fetching the ones that have not been loaded yet with one batch.
+
+        :param Iterable record_ids: The IDs of the records.
+        :return list: A list with one entry per requested ID, in the same order. Entries for records that were
+            not found are `None`.
+        """
+        deferred = [self.defer(record_id) for record_id in record_ids]
+        return [record.get() for record in deferred]
+
+
+class AsyncRecordLoader(BaseRecordLoader):
+    """Loads records by ID from asyncio code, coalescing every :meth:`load` made in the same turn of the event
+    loop into one `$in` query. It works with
+    :class:`sweetrpg_db.mongodb.async_repo.AsyncMongoDataRepository`, and with
+    :class:`sweetrpg_db.mongodb.repo.MongoDataRepository`, whose queries then run in the loop's default
+    executor.
+
+    Loads that are awaited one after the other cannot be batched; start them together, for example with
+    :func:`asyncio.gather`, or from resolvers that the framework runs concurrently.
+    """
+
+    def __init__(self, repo, deleted: bool = False, raw: bool = False, max_batch_size: int = 1000):
+        super().__init__(repo, deleted=deleted, raw=raw, max_batch_size=max_batch_size)
+        self._tasks = set()
+
+    async def _dispatch(self):
+        pending, kwargs = self._take_pending()
+        ids, futures = list(pending), list(pending.values())
+        try:
+            if inspect.iscoroutinefunction(self.repo.get_many):
+                records = await self.repo.get_many(ids, **kwargs)
+            else:
+                fetch = functools.partial(self.repo.get_many, ids, **kwargs)
+                records = await asyncio.get_running_loop().run_in_executor(None, fetch)
+        except Exception as e:
+            for id_value, future in zip(ids, futures):
+                # a failed load is not remembered, so it can be retried
+                if self._cache.get(id_value) is future:
+                    del self._cache[id_value]
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, record in zip(futures, records):
+            if not future.done():
+                future.set_result(record)
+
+    def _schedule(self):
+        task = asyncio.get_running_loop().create_task(self._dispatch())
+        # keep a reference, so the task is not garbage collected before it runs
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def prime(self, record_id, record):
+        """Remember a record that was read some other way, so that loading it needs no query.
+
+        :param record_id: The ID of the record.
+        :param record: The record.
+        """
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(record)
+        self._cache[self.repo._id_value(record_id)] = future
+
+    def load(self, record_id) -> asyncio.Future:
+        """Returns a record, fetching it together with the other records requested in this turn of the event
+        loop if it has not been loaded yet.
+
+        :param record_id: The ID of the record. This can be a string or :class:`bson.objectid.ObjectId`.
+        :return Future: A future of the record, which is `None` if it was not found.
+        """
+        id_value = self.repo._id_value(record_id)
+        future = self._cache.get(id_value)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._cache[id_value] = future
+            self._pending[id_value] = future
+            if len(self._pending) == 1:
+                # dispatch after the other tasks that are ready in this turn have queued their loads
+                loop.call_soon(self._schedule)
+        return future
+
+    async def load_many(self, record_ids: Iterable) -> list:
+        """Returns several records, fetching the ones that have not been loaded yet with one batch.
+
+        :param Iterable record_ids: The IDs of the records.
+        :return list: A list with one entry per requested ID, in the same order. Entries for records that were
+            not found are `None`.
+        """
+        return list(await asyncio.gather(*map(self.load, record_ids)))
+
+
+class LoaderScope(object):
+    """Holds one loader per repository for the duration of a request, so that each collection is queried once per
+    batch however many resolvers load from it::
+
+        loaders = LoaderScope()
+        volume = loaders[volume_repo].load(volume_id)
+    """
+
+    def __init__(self, loader_class: type = RecordLoader, **kwargs):
+        """Initialize the LoaderScope object.
+
+        :param type loader_class: The class of the loaders to create, :class:`RecordLoader` or
+            :class:`AsyncRecordLoader`.
+        :param kwargs: Keyword arguments for the loaders, such as `raw`.
+        """
+        self.loader_class = loader_class
+        self.kwargs = kwargs
+        self._loaders = {}
+
+    def __repr__(self):
+        return f"<LoaderScope(loader_class={self.loader_class.__name__}, loaders={len(self._loaders)})>"
+
+    def __getitem__(self, repo) -> BaseRecordLoader:
+        loader = self._loaders.get(id(repo))
+        if loader is None:
+            loader = self._loaders[id(repo)] = self.loader_class(repo, **self.kwargs)
+        return loader
+
+    def clear(self):
+        """Forget every loaded record of every loader."""
+        for loader in self._loaders.values():
+            loader.clear()
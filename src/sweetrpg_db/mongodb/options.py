@@ -4,6 +4,18 @@ __author__ = "Paul Schifferer <dm@sweetrpg.com>"
 Query options for accessing MongoDB.
 """
 
+import base64
+from bson import json_util
+from bson.decimal128 import Decimal128
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from collections.abc import Mapping
+import copy
+import datetime
+from operator import itemgetter
+import re
+from types import MappingProxyType
+
 
 class QueryOptions(object):
     """An object to store query options for a PyMongo find*() call."""
@@ -18,53 +30,194 @@ class QueryOptions(object):
         "le": "$lte",
         "ne": "$ne",
         "notin_": "$nin",
-        # '': '$and',
         "isnot": "$not",
-        # '': '$nor',
-        # '': '$or',
         "is_": "$exists",
-        # 'any': 'TODO',
-        # 'between': 'TODO',
-        # 'endswith': 'TODO',
+        # matches if any of the values equals the field, or any element of an array field
+        "any": "$in",
         # 'has': 'TODO',
-        # 'ilike': 'TODO',
-        # 'like': 'TODO',
-        # 'match': 'TODO',
-        # 'notilike': 'TODO',
-        # 'notlike': 'TODO',
-        # 'startswith': 'TODO',
+    }
+    _filter_builders = {
+        "between": "_between_filter",
+        "startswith": "_prefix_filter",
+        "endswith": "_suffix_filter",
+        "like": "_like_filter",
+        "ilike": "_ilike_filter",
+        "notlike": "_notlike_filter",
+        "notilike": "_notilike_filter",
+        "match": "_match_filter",
+    }
+    _filter_groups = {
+        "or": "$or",
+        "or_": "$or",
+        "and": "$and",
+        "and_": "$and",
     }
     _sort_values = {
         "asc": 1,
         "dsc": -1,
     }
+    _cursor_json_options = json_util.JSONOptions(json_mode=json_util.JSONMode.CANONICAL, tz_aware=False)
+    # the scalar types a sort value in a cursor can have; others, such as regular expressions, would change how the
+    # keyset filter matches
+    _cursor_value_types = (type(None), bool, int, Int64, float, Decimal128, str, ObjectId, datetime.datetime)
 
-    def __init__(self, filters: dict = {}, projection: list = [], skip: int = 0, limit: int = 0, sort: list = []):
+    def __init__(
+        self,
+        filters: dict = None,
+        projection: list = None,
+        skip: int = 0,
+        limit: int = 0,
+        sort: list = None,
+        cursor: str = None,
+        include: list = None,
+    ):
         """Initialize the QueryOptions object.
         :param dict filters: A dictionary of filters to apply to the query.
         :param list projection: A list of attribute names to include in the returned result. If `None`, all attributes are returned.
         :param int skip: An offset to use for pagination.
         :param int limit: The maximum number of results to return.
         :param list sort: A list of key-value pairs specifying the attributes to sort on.
+        :param str cursor: An opaque keyset pagination cursor, as returned with a previous page of results. This is
+            an alternative to `skip`.
+        :param list include: A list of relation paths, such as `system.publisher`, whose referenced records are
+            fetched and attached to the results, with one query per relation level. The first field of each path
+            is added to the projection.
         """
-        self.filters = filters
-        self.projection = projection
+        self.filters = filters if filters is not None else {}
+        self.projection = projection if projection is not None else []
         self.skip = skip
         self.limit = limit
-        self.sort = sort
+        self.sort = sort if sort is not None else []
+        self.cursor = cursor
+        self.include = include if include is not None else []
 
     def __repr__(self):
-        return f"<QueryOptions(filters={self.filters}, projection={self.projection}, skip={self.skip}, limit={self.limit}, sort={self.sort})>"
+        return f"<{self.__class__.__name__}(filters={self.filters}, projection={self.projection}, skip={self.skip}, limit={self.limit}, sort={self.sort}, cursor={self.cursor}, include={self.include})>"
+
+    @staticmethod
+    def _prefix_upper_bound(prefix: str) -> str:
+        """Returns the smallest string that is greater than every string starting with `prefix`, or `None` if
+        there is no such string.
+        """
+        prefix = prefix.rstrip("\U0010ffff")
+        if not prefix:
+            return None
+        code = ord(prefix[-1]) + 1
+        if 0xD800 <= code <= 0xDFFF:
+            # surrogates cannot be stored in BSON strings
+            code = 0xE000
+        return prefix[:-1] + chr(code)
+
+    @classmethod
+    def _prefix_filter(cls, value: str) -> dict:
+        """Build an anchored prefix range, which can use an index on the field.
+
+        >>> QueryOptions._prefix_filter("Orc")
+        {'$gte': 'Orc', '$lt': 'Ord'}
+        """
+        if not isinstance(value, str):
+            raise ValueError(f"'startswith' needs a string, not {value!r}")
+        if not value:
+            return {"$type": "string"}
+        upper = cls._prefix_upper_bound(value)
+        if upper is None:
+            return {"$gte": value}
+        return {"$gte": value, "$lt": upper}
+
+    @staticmethod
+    def _between_filter(value: list) -> dict:
+        """Build a single inclusive range from a `[low, high]` pair.
+
+        >>> QueryOptions._between_filter([10, 20])
+        {'$gte': 10, '$lte': 20}
+        """
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            raise ValueError(f"'between' needs a [low, high] pair, not {value!r}")
+        return {"$gte": value[0], "$lte": value[1]}
+
+    @staticmethod
+    def _suffix_filter(value: str) -> dict:
+        return {"$regex": re.escape(value) + "$"}
+
+    @staticmethod
+    def _like_pattern(value: str) -> str:
+        """Translate a SQL `LIKE` pattern, where `%` matches any run of characters and `_` matches one character,
+        into an anchored regular expression. A literal prefix stays at the start of the expression, so a
+        case-sensitive match can still use an index.
+
+        >>> QueryOptions._like_pattern("Orc%")
+        '^Orc'
+        >>> QueryOptions._like_pattern("%_x%%")
+        '^.*.x'
+        """
+        pattern = "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in value)
+        if not pattern.endswith(".*"):
+            return "^" + pattern + "$"
+        while pattern.endswith(".*"):
+            pattern = pattern[:-2]
+        return "^" + pattern
+
+    @classmethod
+    def _like_filter(cls, value: str) -> dict:
+        return {"$regex": cls._like_pattern(value)}
+
+    @classmethod
+    def _ilike_filter(cls, value: str) -> dict:
+        return {"$regex": cls._like_pattern(value), "$options": "i"}
+
+    @classmethod
+    def _notlike_filter(cls, value: str) -> dict:
+        return {"$not": re.compile(cls._like_pattern(value))}
+
+    @classmethod
+    def _notilike_filter(cls, value: str) -> dict:
+        return {"$not": re.compile(cls._like_pattern(value), re.IGNORECASE)}
+
+    @staticmethod
+    def _match_filter(value: str) -> dict:
+        return {"$regex": value}
+
+    def _process_filter(self, filter_info: dict) -> dict:
+        for group, op in self._filter_groups.items():
+            if group in filter_info:
+                return {op: list(map(self._process_filter, filter_info[group]))}
+        if "not" in filter_info:
+            return {"$nor": [self._process_filter(filter_info["not"])]}
 
-    def _process_filter(self, filter_info: dict):
         name = filter_info["name"]
         value = filter_info["val"]
+        builder = self._filter_builders.get(filter_info["op"])
+        if builder is not None:
+            return {name: getattr(self, builder)(value)}
         op = self._filter_operators.get(filter_info["op"], "$eq")
         return {name: {op: value}}
 
+    @staticmethod
+    def _merge_filter(filters: dict, name: str, condition):
+        """Add a condition to a filter. Operators on the same field are merged into one condition, so that
+        `ge` and `le` on a field become a single range; conditions that cannot be merged are combined with `$and`.
+        """
+        existing = filters.get(name)
+        if existing is None:
+            filters[name] = condition
+        elif name == "$and":
+            existing.extend(condition)
+        elif (
+            isinstance(existing, dict)
+            and isinstance(condition, dict)
+            and all(k.startswith("$") for k in list(existing) + list(condition))
+            and not set(existing) & set(condition)
+        ):
+            filters[name] = {**existing, **condition}
+        else:
+            filters.setdefault("$and", []).append({name: condition})
+
     def set_filters(self, filters: dict = None, from_querystring: list = None):
         """Sets filters for the query.
 
+        Filters in querystring format are dictionaries with `name`, `op` and `val` keys, or groups of filters
+        such as `{"or": [...]}`, `{"and": [...]}` and `{"not": {...}}`.
+
         :param dict filters: A dictionary of filters to set.
         :param list from_querystring: Filters to set in querystring format.
         """
@@ -73,7 +226,8 @@ class QueryOptions(object):
         elif from_querystring is not None:
             filters = {}
             for f in from_querystring:
-                filters.update(self._process_filter(f))
+                for name, condition in self._process_filter(f).items():
+                    self._merge_filter(filters, name, condition)
             self.filters = filters
 
     def set_projection(self, projection: list = None, from_querystring: list = None):
@@ -87,6 +241,22 @@ class QueryOptions(object):
         elif from_querystring is not None:
             self.projection = from_querystring
 
+    def set_include(self, include: list = None, from_querystring: str = None):
+        """Sets the relations whose referenced records are attached to the query results.
+
+        >>> options = QueryOptions()
+        >>> options.set_include(from_querystring="system.publisher,authors")
+        >>> options.include
+        ['system.publisher', 'authors']
+
+        :param list include: A list of relation paths.
+        :param str from_querystring: Relation paths in JSON:API `include` format, separated by commas.
+        """
+        if include is not None:
+            self.include = include
+        elif from_querystring is not None:
+            self.include = [path.strip() for path in from_querystring.split(",") if path.strip()]
+
     def _process_sort(self, sort_item: dict):
         name = sort_item["field"]
         direction = self._sort_values.get(sort_item["order"], 1)
@@ -102,3 +272,271 @@ class QueryOptions(object):
             self.sort = sort
         elif from_querystring is not None:
             self.sort = list(map(self._process_sort, from_querystring))
+
+    @classmethod
+    def _freeze(cls, value):
+        """Turn a value into a hashable one that keeps everything MongoDB compares it by: the type of each scalar
+        (so that `True` and `1` differ), whether it is a document or an array, and the order of a document's keys.
+
+        >>> QueryOptions._freeze({"a": True}) == QueryOptions._freeze({"a": 1})
+        False
+        """
+        if isinstance(value, Mapping):
+            return "document", tuple((k, cls._freeze(v)) for k, v in value.items())
+        elif isinstance(value, (list, tuple)):
+            return "array", tuple(map(cls._freeze, value))
+        elif isinstance(value, set):
+            return "set", frozenset(map(cls._freeze, value))
+        return type(value), value
+
+    @staticmethod
+    def _is_operators(value) -> bool:
+        return isinstance(value, Mapping) and bool(value) and all(str(k).startswith("$") for k in value)
+
+    @classmethod
+    def _freeze_filter(cls, query_filter) -> tuple:
+        """Freeze a query filter. The order of its fields and operators does not change which records match, so
+        they are sorted, but the values they are compared with are frozen as they are (see :meth:`_freeze`).
+
+        >>> f = QueryOptions._freeze_filter
+        >>> f({"a": 1, "b": {"$lt": 5, "$gt": 1}}) == f({"b": {"$gt": 1, "$lt": 5}, "a": 1})
+        True
+        >>> f({"a": {"x": 1, "y": 2}}) == f({"a": {"y": 2, "x": 1}})
+        False
+        """
+        return tuple(
+            sorted(((name, cls._freeze_condition(name, value)) for name, value in query_filter.items()), key=itemgetter(0))
+        )
+
+    @classmethod
+    def _freeze_condition(cls, name: str, value):
+        if name in ("$and", "$or", "$nor") and isinstance(value, (list, tuple)):
+            return "filters", tuple(map(cls._freeze_filter, value))
+        if not cls._is_operators(value):
+            # an equality value, whose key order matters
+            return cls._freeze(value)
+
+        operators = []
+        for op, operand in value.items():
+            if op == "$elemMatch" and isinstance(operand, Mapping):
+                if cls._is_operators(operand):
+                    operand = cls._freeze_condition(None, operand)
+                else:
+                    operand = "filter", cls._freeze_filter(operand)
+            elif op == "$not":
+                operand = cls._freeze_condition(None, operand)
+            else:
+                operand = cls._freeze(operand)
+            operators.append((op, operand))
+        return "operators", tuple(sorted(operators, key=itemgetter(0)))
+
+    def cache_key(self) -> tuple:
+        """Returns a hashable key that is the same for any two options that describe the same query.
+
+        Filters are compared regardless of the order their fields and operators were set in (but not the order
+        of the keys of documents they compare with), and the projection is compared regardless of the order of its
+        fields.
+
+        :return tuple: The key.
+        """
+        return (
+            self._freeze_filter(self.filters or {}),
+            tuple(sorted(self.projection or [])),
+            self._freeze(self.sort or []),
+            self.skip,
+            self.limit,
+            self.cursor,
+            tuple(sorted(self.include or [])),
+        )
+
+    def query_filter(self) -> dict:
+        """Returns a copy of the filters that can be added to and passed to PyMongo.
+
+        :return dict: The query filter.
+        """
+        return dict(self.filters or {})
+
+    def keyset_sort(self) -> list:
+        """Returns the sort for keyset pagination, which is the query's sort with `_id` added as a tie-breaker.
+
+        :return list: A list of `(field, direction)` tuples.
+        """
+        sort = list(self.sort)
+        if all(name != "_id" for name, _ in sort):
+            direction = sort[-1][1] if sort else 1
+            sort.append(("_id", direction))
+        return sort
+
+    def compile(self) -> "QueryPlan":
+        """Returns an immutable copy of these options, which can be built once and reused across requests.
+
+        :return QueryPlan: The compiled options.
+        """
+        return QueryPlan(self.filters, self.projection, self.skip, self.limit, self.sort, self.cursor, self.include)
+
+    @staticmethod
+    def encode_cursor(values: list) -> str:
+        """Encodes the sort values of the last record of a page into a keyset pagination cursor.
+
+        :param list values: The values of the `keyset_sort` fields, in order.
+        :return str: An opaque, URL-safe cursor string.
+        """
+        data = json_util.dumps(values, json_options=QueryOptions._cursor_json_options)
+        return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> list:
+        """Decodes a keyset pagination cursor into the sort values it was made from.
+
+        :param str cursor: A cursor created by :meth:`encode_cursor`.
+        :return list: The values of the `keyset_sort` fields, in order.
+        :raises ValueError: If the cursor is not valid, or holds a value that is not a plain scalar, such as a
+            document or a regular expression, which would change how the keyset filter matches.
+        """
+        try:
+            data = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+            values = json_util.loads(data, json_options=QueryOptions._cursor_json_options)
+        except Exception as e:
+            raise ValueError(f"Invalid cursor '{cursor}'") from e
+        if not isinstance(values, list):
+            raise ValueError(f"Invalid cursor '{cursor}'")
+        # exact types, since `Code` is a `str` subclass
+        if any(type(value) not in QueryOptions._cursor_value_types for value in values):
+            raise ValueError(f"Invalid cursor '{cursor}'")
+        return values
+
+
+class QueryPlan(QueryOptions):
+    """Immutable, hashable query options, as returned by :meth:`QueryOptions.compile`.
+
+    A plan can be passed to any repository method that accepts :class:`QueryOptions`. Its filters, projection and
+    sort are copied when the plan is created, and its cache key is computed once, so the same plan can be shared
+    between requests and threads. Use :meth:`replace` to derive a plan for another page.
+
+    The filters are frozen all the way down: documents become read-only mappings and arrays become tuples. Use
+    :meth:`query_filter` for a mutable copy.
+    """
+
+    def __init__(
+        self,
+        filters: dict = None,
+        projection: list = None,
+        skip: int = 0,
+        limit: int = 0,
+        sort: list = None,
+        cursor: str = None,
+        include: list = None,
+    ):
+        """Initialize the QueryPlan object.
+
+        :param dict filters: A dictionary of filters to apply to the query.
+        :param list projection: A list of attribute names to include in the returned result.
+        :param int skip: An offset to use for pagination.
+        :param int limit: The maximum number of results to return.
+        :param list sort: A list of `(field, direction)` tuples specifying the attributes to sort on.
+        :param str cursor: An opaque keyset pagination cursor.
+        :param list include: A list of relation paths whose referenced records are attached to the results.
+        """
+        values = {
+            "filters": self._frozen(filters or {}),
+            "projection": tuple(projection or ()),
+            "skip": skip,
+            "limit": limit,
+            "sort": tuple(tuple(item) if isinstance(item, list) else item for item in sort or ()),
+            "cursor": cursor,
+            "include": tuple(include or ()),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_cache_key", super().cache_key())
+        object.__setattr__(self, "_keyset_sort", super().keyset_sort())
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable; use replace() to change '{name}'")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, QueryPlan):
+            return NotImplemented
+        return self._cache_key == other._cache_key
+
+    def __hash__(self):
+        return hash(self._cache_key)
+
+    def _immutable(self, *args, **kwargs):
+        raise AttributeError(f"{self.__class__.__name__} is immutable; use replace() to change it")
+
+    set_filters = set_projection = set_sort = set_include = _immutable
+
+    @classmethod
+    def _frozen(cls, value):
+        """Returns a read-only copy of a filter value.
+
+        >>> QueryPlan._frozen({"$or": [{"a": 1}, {"b": {"$in": [2, 3]}}]})
+        mappingproxy({'$or': (mappingproxy({'a': 1}), mappingproxy({'b': mappingproxy({'$in': (2, 3)})}))})
+        """
+        if isinstance(value, Mapping):
+            return MappingProxyType({k: cls._frozen(v) for k, v in value.items()})
+        elif isinstance(value, (list, tuple)):
+            return tuple(map(cls._frozen, value))
+        elif isinstance(value, (set, frozenset)):
+            return frozenset(map(cls._frozen, value))
+        return copy.deepcopy(value)
+
+    @classmethod
+    def _thawed(cls, value):
+        """Returns a mutable copy of a value frozen by :meth:`_frozen`."""
+        if isinstance(value, Mapping):
+            return {k: cls._thawed(v) for k, v in value.items()}
+        elif isinstance(value, tuple):
+            return list(map(cls._thawed, value))
+        return value
+
+    def query_filter(self) -> dict:
+        """Returns a mutable copy of the filters, with read-only mappings turned back into dictionaries and tuples
+        into lists, that can be added to and passed to PyMongo.
+
+        :return dict: The query filter.
+        """
+        return self._thawed(self.filters)
+
+    def cache_key(self) -> tuple:
+        """Returns the key computed when the plan was created (see :meth:`QueryOptions.cache_key`).
+
+        :return tuple: The key.
+        """
+        return self._cache_key
+
+    def keyset_sort(self) -> list:
+        """Returns the sort for keyset pagination (see :meth:`QueryOptions.keyset_sort`).
+
+        :return list: A list of `(field, direction)` tuples.
+        """
+        return list(self._keyset_sort)
+
+    def compile(self) -> "QueryPlan":
+        return self
+
+    def replace(self, **changes) -> "QueryPlan":
+        """Returns a copy of the plan with some of its options changed.
+
+        >>> plan = QueryOptions(limit=10).compile()
+        >>> plan.replace(skip=10)
+        <QueryPlan(filters={}, projection=(), skip=10, limit=10, sort=(), cursor=None, include=())>
+
+        :param changes: The options to change, by name.
+        :return QueryPlan: The new plan.
+        """
+        values = {
+            "filters": self.filters,
+            "projection": self.projection,
+            "skip": self.skip,
+            "limit": self.limit,
+            "sort": self.sort,
+            "cursor": self.cursor,
+            "include": self.include,
+        }
+        values.update(changes)
+        return QueryPlan(**values)
@@ -5,18 +5,54 @@ MongoDB repository module.
 """
 
 from ..exceptions import ObjectNotFound
+from bson.dbref import DBRef
 from bson.objectid import ObjectId
-from bson.timestamp import Timestamp
+import contextlib
+import copy
 import datetime
+from .convert import RecordConverter, convert_value
+from .connection import connections
+from .instrumentation import OperationEvent
 from .options import QueryOptions
-from pymongo.write_concern import WriteConcern
+from .results import BulkCreateResult, QueryPage, WriteResult
+from .unit_of_work import UnitOfWork
+from concurrent.futures import ThreadPoolExecutor
+from ..schema.projection import schema_projection
+from pymongo import IndexModel, ReturnDocument
+from pymongo.command_cursor import CommandCursor
+from pymongo.errors import BulkWriteError
+from pymongo.collection import Collection
 import logging
-from mongoengine.queryset import QuerySet
+from mongoengine.errors import FieldDoesNotExist, LookUpError, ValidationError
+from mongoengine.queryset import QuerySet, transform
 from mongoengine import Document
+from mongoengine.fields import (
+    GenericLazyReferenceField,
+    GenericReferenceField,
+    LazyReferenceField,
+    ListField,
+    ReferenceField,
+)
+from mongoengine.connection import DEFAULT_CONNECTION_NAME, get_db
+import queue
+import threading
+import time
+from typing import Iterable, Iterator
 
 
-class MongoDataRepository(object):
-    """A repository class for interacting with a MongoDB database."""
+class BaseMongoDataRepository(object):
+    """The parts of a MongoDB repository that do not depend on how the database is accessed."""
+
+    # predicates on `deleted_at` that match records which are not marked "deleted"
+    _soft_delete_filters = {
+        # matches null or missing values, and can use an index on `deleted_at`
+        "null": None,
+        # matches any value that is not a date, but cannot use an index well
+        "type": {"$not": {"$type": "date"}},
+    }
+
+    # fields whose values point to other documents, which a projection cannot reach into
+    _reference_fields = (ReferenceField, LazyReferenceField, GenericReferenceField, GenericLazyReferenceField)
 
     def __init__(self, **kwargs):
         """Create a MongoDB repository instance.
@@ -25,15 +61,171 @@ class MongoDataRepository(object):
         :key model: The class of the model for this connection.
         :key document: The class of the document for this connection.
         :key db: A :class:`PyMongo` object used for connecting to the database.
+        :key cache: (Optional) A :class:`sweetrpg_db.mongodb.cache.LRUCache` used to cache records read by
+            :meth:`get`. Entries are invalidated by writes made through this repository. The cache can be shared
+            with other repositories for the same collection only if they have the same `schema` projection and
+            `soft_delete` strategy.
+        :key query_cache: (Optional) A :class:`sweetrpg_db.mongodb.cache.LRUCache` used to cache the results of
+            :meth:`query`. All of the collection's entries are invalidated by writes made through this repository. As
+            with `cache`, it can only be shared with repositories that have the same projection and strategy.
+        :key soft_delete: (Optional) The predicate used to exclude records marked "deleted". `null` (the default)
+            matches a null or missing `deleted_at` and can use the indexes created by :meth:`ensure_live_indexes`.
+            `type` matches any `deleted_at` value that is not a date.
+        :key listeners: (Optional) A list of functions that are called with an
+            :class:`sweetrpg_db.mongodb.instrumentation.OperationEvent` after each repository operation.
+        :key alias: (Optional) The connection alias to use. Defaults to the document class's `db_alias`. If the
+            alias is registered in the connection registry (see :mod:`sweetrpg_db.mongodb.connection`), each
+            operation uses the read preference and write concern configured for it. The alias is looked up when
+            the repository is used, so it can be registered after the repository is created.
+        :key registry: (Optional) The :class:`sweetrpg_db.mongodb.connection.ConnectionRegistry` to look the alias
+            up in, instead of the shared one.
+        :key schema: (Optional) A marshmallow schema, or schema class, that the records are serialized with. Reads
+            that do not ask for a projection only fetch the fields the schema dumps (see
+            :func:`sweetrpg_db.schema.projection.schema_projection`).
+        :key relations: (Optional) Repositories for the fields that `QueryOptions.include` can follow, by field
+            name. Repositories for `ReferenceField` fields are created as needed, so they only have to be given for
+            fields that hold IDs without a declared document class, or to use a repository's own settings.
         """
         self.model_class = kwargs["model"]
         self.document_class = kwargs["document"]
         # self.db = kwargs.get("db")
         # print(dir(self.document_class))
         self.collection = kwargs["collection"]  # self.document_class.meta["collection"]
+        self.converter = RecordConverter.for_document(self.document_class)
+        self.cache = kwargs.get("cache")
+        self.query_cache = kwargs.get("query_cache")
+        self.soft_delete = kwargs.get("soft_delete", "null")
+        if self.soft_delete not in self._soft_delete_filters:
+            raise ValueError(f"Unknown soft delete strategy '{self.soft_delete}'")
+        self.listeners = list(kwargs.get("listeners", []))
+        self.alias = kwargs.get("alias") or self.document_class._meta.get("db_alias", DEFAULT_CONNECTION_NAME)
+        self.registry = kwargs.get("registry", connections)
+        # the collection for each operation, with the connection settings it was made with
+        self._collections = {}
+        self.schema = kwargs.get("schema")
+        self.default_projection = self._schema_projection(self.schema) if self.schema is not None else None
+        self.relations = dict(kwargs.get("relations", {}))
+        self._relations = {}
+        for cache in (self.cache, self.query_cache):
+            if cache is not None:
+                cache.bind(self.collection, self._cache_settings())
 
     def __repr__(self):
-        return f"<MongoDataRepository(model_class={self.model_class}, document_class={self.document_class}, collection={self.collection})>"
+        return f"<{self.__class__.__name__}(model_class={self.model_class}, document_class={self.document_class}, collection={self.collection})>"
+
+    def add_listener(self, listener):
+        """Add a function to call with an :class:`sweetrpg_db.mongodb.instrumentation.OperationEvent` after each
+            repository operation.
+
+        :param listener: The function to call.
+        """
+        self.listeners.append(listener)
+
+    def _schema_projection(self, schema) -> list:
+        """Derive the default projection from a schema.
+
+        A path into the documents that a reference field points to is shortened to the reference field, so that
+        the reference is still fetched. If the schema dumps a field that the document class does not declare, such
+        as a field stored in a non-strict document, all fields are fetched, since a projection on the document
+        class could not include it.
+
+        :param Schema schema: The schema, or schema class.
+        :return list: The projected field names, or `None` if all fields have to be fetched.
+        """
+        paths = schema_projection(schema)
+        if paths is None:
+            return None
+
+        declared = {}
+        for path in paths:
+            parts = path.split(".")
+            for length in range(len(parts), 0, -1):
+                try:
+                    path_fields = self.document_class._lookup_field(parts[:length])
+                except LookUpError:
+                    continue
+                # a list of references can be looked up through, but the projection stops at the references
+                for index, field in enumerate(path_fields[:-1]):
+                    if isinstance(field.field if isinstance(field, ListField) else field, self._reference_fields):
+                        length = index + 1
+                        break
+                declared[".".join(parts[:length])] = None
+                break
+            else:
+                logging.debug("schema field %s is not declared, so all fields are fetched", path)
+                return None
+
+        # a path inside another projected path would collide with it
+        projection = [path for path in declared if not any(path.startswith(f"{other}.") for other in declared)]
+        logging.debug("projection: %s", projection)
+
+        return projection or None
+
+    def _cache_settings(self) -> tuple:
+        """Returns the settings that the records this repository caches depend on, for
+            :meth:`sweetrpg_db.mongodb.cache.LRUCache.bind`.
+
+        :return tuple: The soft delete strategy and the default projection.
+        """
+        return self.soft_delete, tuple(self.default_projection or ())
+
+    def _project(self, queryset: QuerySet) -> QuerySet:
+        """Apply the default projection to a query set.
+
+        :param QuerySet queryset: The query set.
+        :return QuerySet: The query set, limited to the default projection if there is one.
+        """
+        if self.default_projection:
+            return queryset.only(*self.default_projection)
+        return queryset
+
+    @property
+    def connection(self):
+        """The :class:`sweetrpg_db.mongodb.connection.ConnectionSettings` registered for the repository's alias, or
+        `None` if the alias is not registered.
+        """
+        return self.registry.get(self.alias)
+
+    def _collection_options(self, operation: str = None) -> dict:
+        """Returns the collection options configured for an operation on the repository's connection.
+
+        :param str operation: (Optional) The name of the repository operation, such as `query`.
+        :return dict: Keyword arguments for `with_options()`, which are empty if the connection is not registered.
+        """
+        connection = self.connection
+        if connection is None:
+            return {}
+        return connection.collection_options(operation)
+
+    def _default_fields(self) -> dict:
+        """Returns the default projection in PyMongo format.
+
+        :return dict: The projection, or `None` if all fields should be returned.
+        """
+        return self._projection_spec(self.default_projection)
+
+    @contextlib.contextmanager
+    def _instrument(self, operation: str):
+        """Time a repository operation and notify the listeners when it finishes. The time spent in the event's
+            :meth:`sweetrpg_db.mongodb.instrumentation.OperationEvent.paused` blocks is left out of its `duration`.
+
+        :param str operation: The name of the operation.
+        :return OperationEvent: The event, on which the operation sets `query_filter` and `result_count`.
+        """
+        event = OperationEvent(operation, self.collection)
+        start = time.perf_counter()
+        try:
+            yield event
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            event.duration = time.perf_counter() - start - event.consumer_time
+            for listener in self.listeners:
+                try:
+                    listener(event)
+                except Exception:
+                    logging.exception("Repository listener %s failed", listener)
 
     def _handle_value(self, value):
         """Convert a value to a string.
@@ -43,196 +235,1222 @@ class MongoDataRepository(object):
             any of those types.
         :return str: A string of the specified value.
         """
-        if isinstance(value, ObjectId):
-            logging.debug("converting ObjectId('%s')...", value)
-            return str(value)
-        elif isinstance(value, datetime.datetime):
-            logging.debug("converting datetime value '%s'...", value)
-            d = value.replace(tzinfo=datetime.timezone.utc)
-            return d.isoformat(timespec="milliseconds")
-        elif isinstance(value, Timestamp):
-            logging.debug("converting Timestamp '%s'...", value)
-            return value.as_datetime()
-        elif isinstance(value, list):
-            logging.debug("converting list '%s'...", value)
-            return list(map(self._handle_value, value))
-
-        logging.debug("returning unprocessed value '%s'...", value)
-        return value
+        return convert_value(value)
 
     def _modify_record(self, record: dict) -> dict:
         """Modify a record by converting any values to strings, and renaming the internal '_id'
-            field to 'id'.
+            field to 'id'. The conversion for each field is chosen from the document class, see
+            :class:`sweetrpg_db.mongodb.convert.RecordConverter`.
 
         :param dict record: The record to modify.
         :return dict: The modified record.
         """
-        modified_record = {}
-        for k, v in record.items():
-            logging.debug("k: %s, v: %s", k, v)
-            if k == "_id":
-                k = "id"
-            modified_value = self._handle_value(v)
-            modified_record[k] = modified_value
-            logging.debug("k: %s, v (modified): %s", k, modified_value)
+        return self.converter.convert(record)
+
+    def _id_value(self, record_id):
+        """Convert a record ID to an :class:`bson.objectid.ObjectId`, if it is a string.
+
+        :param record_id: The record ID. This can be a string or :class:`bson.objectid.ObjectId`.
+        :return ObjectId: The ID value to use in a query filter.
+        """
+        if isinstance(record_id, str):
+            return ObjectId(record_id)
+        return record_id
 
-        return modified_record
+    def _invalidate(self, *id_values):
+        """Remove written records from the repository's caches, if it has any.
+
+        :param ObjectId id_values: The IDs of the records that were written.
+        """
+        if self.cache is not None:
+            for id_value in id_values:
+                self.cache.invalidate((self.collection, id_value, False))
+                self.cache.invalidate((self.collection, id_value, True))
+        if self.query_cache is not None:
+            self.query_cache.invalidate_collection(self.collection)
+
+    def _db_field(self, name: str) -> str:
+        """Translate a document field name into the name stored in the database.
+
+        :param str name: The field name. This can be a dotted path.
+        :return str: The database field name, or `name` if the document class does not define the field.
+        """
+        if name in ("_id", "id", "pk"):
+            return "_id"
+        try:
+            return self.document_class._translate_field_name(name)
+        except LookUpError:
+            return name
+
+    def _keyset_filter(self, sort: list, values: list) -> dict:
+        """Build a range predicate that matches the records that come after a keyset cursor.
+
+        Null and missing values sort before any other value, so they are compared explicitly: after a null value
+        come all the non-null values in ascending order and none in descending order, and in descending order the
+        nulls come after every other value.
+
+        :param list sort: The keyset sort, as returned from :meth:`QueryOptions.keyset_sort`.
+        :param list values: The sort values decoded from the cursor.
+        :return dict: A query filter.
+        """
+        if len(values) != len(sort):
+            raise ValueError("Cursor does not match the query's sort")
+        clauses = []
+        for i, (name, direction) in enumerate(sort):
+            field = self._db_field(name)
+            clause = {self._db_field(prev_name): value for (prev_name, _), value in zip(sort[:i], values[:i])}
+            if values[i] is None:
+                if direction < 0:
+                    # nothing sorts below null
+                    continue
+                clause[field] = {"$ne": None}
+            elif direction > 0:
+                clause[field] = {"$gt": values[i]}
+            else:
+                clause["$or"] = [{field: {"$lt": values[i]}}, {field: None}]
+            clauses.append(clause)
+        return {"$or": clauses}
+
+    def _make_cursor(self, record: dict, sort: list) -> str:
+        """Create a keyset cursor pointing after the specified record.
+
+        :param dict record: The last record of a page, as stored in the database.
+        :param list sort: The keyset sort, as returned from :meth:`QueryOptions.keyset_sort`.
+        :return str: The cursor.
+        """
+        values = []
+        for name, _ in sort:
+            value = record
+            for part in self._db_field(name).split("."):
+                value = value.get(part) if isinstance(value, dict) else None
+            values.append(value)
+        return QueryOptions.encode_cursor(values)
 
     def _adjust_sort(self, sort: tuple) -> str:
         if sort[1] < 0:
             return f"-{sort[0]}"
         return f"+{sort[0]}"
 
+    def _deleted_filter(self) -> dict:
+        """Returns the query filter that excludes records marked "deleted".
+
+        :return dict: A query filter.
+        """
+        return {"deleted_at": self._soft_delete_filters[self.soft_delete]}
+
+    def _is_live(self, record: dict) -> bool:
+        """Check a raw record against the predicate of :meth:`_deleted_filter`.
+
+        :param dict record: The raw record.
+        :return bool: `True` if the record is not marked "deleted".
+        """
+        deleted_at = record.get("deleted_at")
+        if self.soft_delete == "type":
+            return not isinstance(deleted_at, datetime.datetime)
+        return deleted_at is None
+
+    def _range_filters(self, query_filter: dict, boundaries: list, key: str = "_id") -> list:
+        """Split a query filter into one filter for each range of a key between the boundaries.
+
+        The first range also matches records whose key is missing or is of a different type than the boundaries,
+        so every record matching the filter is matched by exactly one range.
+
+        :param dict query_filter: The query filter.
+        :param list boundaries: The ascending values of the key where each range after the first starts.
+        :param str key: The name of the field to split on.
+        :return list: The query filters, in ascending order of the key.
+        """
+        if not boundaries:
+            return [query_filter]
+        field = self._db_field(key)
+        ranges = [{"$not": {"$gte": boundaries[0]}}]
+        ranges.extend({"$gte": lower, "$lt": upper} for lower, upper in zip(boundaries, boundaries[1:]))
+        ranges.append({"$gte": boundaries[-1]})
+        return [{"$and": [query_filter, {field: r}]} if query_filter else {field: r} for r in ranges]
+
+    @staticmethod
+    def _add_boundary(boundaries: list, record: dict, field: str):
+        """Add the value of a field in a record to a list of range boundaries, if it is greater than the last
+            boundary and of the same type as the others. Ranges can only be compared within one type, so records
+            with values of other types fall in the first range (see :meth:`_range_filters`).
+
+        :param list boundaries: The ascending boundary values found so far.
+        :param dict record: The record at the start of the next range.
+        :param str field: The database name of the field to split on, which may be a dotted path.
+        """
+        value = record
+        for name in field.split("."):
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is None or (boundaries and type(value) is not type(boundaries[0])):
+            return
+        if not boundaries or value > boundaries[-1]:
+            boundaries.append(value)
+
+    def _scan_spec(
+        self, options: QueryOptions, deleted: bool = False, key: str = "_id", ordered: bool = False
+    ) -> tuple:
+        """Build the filter, projection and per-range sort of a parallel scan.
+
+        :param QueryOptions options: Options with the filters and projection of the scan.
+        :param bool deleted: Include "deleted" objects in the scan
+        :param str key: The name of the field to split the scan on.
+        :param bool ordered: Sort each range by the key.
+        :return tuple: The query filter, the PyMongo projection, and the PyMongo sort (or `None`).
+        :raises ValueError: If the options sort or paginate.
+        """
+        if options.sort or options.skip or options.limit or options.cursor:
+            raise ValueError("A parallel scan cannot sort or paginate; use `ordered` to read in order of the key")
+        query_filter, _, projection = self._query_spec(options, deleted=deleted)
+        sort = [(self._db_field(key), 1)] if ordered else None
+        return query_filter, self._projection_spec(projection), sort
+
+    @staticmethod
+    def _include_tree(include: list) -> dict:
+        """Turn a list of relation paths into a tree with one level per relation.
+
+        >>> BaseMongoDataRepository._include_tree(["system.publisher", "system", "authors"])
+        {'system': {'publisher': {}}, 'authors': {}}
+
+        :param list include: The relation paths.
+        :return dict: The tree.
+        """
+        tree = {}
+        for path in include or []:
+            node = tree
+            for name in path.split("."):
+                node = node.setdefault(name, {})
+        return tree
+
+    def _related_kwargs(self) -> dict:
+        """Returns the keyword arguments, besides the document class, for the repositories this repository creates
+        for its reference fields, so that they share its settings.
+        """
+        return {"listeners": self.listeners, "soft_delete": self.soft_delete, "registry": self.registry}
+
+    def _relation(self, name: str) -> tuple:
+        """Returns the repository and field of a relation that can be included in query results.
+
+        :param str name: The name of the field.
+        :return tuple: The related repository, the field, and whether the related documents can be attached to
+            documents (and not only to raw records).
+        :raises ValueError: If the field does not exist, or is not a reference and has no repository in
+            `relations`.
+        """
+        relation = self._relations.get(name)
+        if relation is not None:
+            return relation
+
+        field = self.document_class._fields.get(name)
+        if field is None:
+            raise ValueError(f"{self.document_class.__name__} has no field '{name}' to include")
+        inner = field.field if isinstance(field, ListField) else field
+        related = self.relations.get(name)
+        if related is None:
+            if not isinstance(inner, (ReferenceField, LazyReferenceField)):
+                raise ValueError(f"Field '{name}' is not a reference; pass a repository for it in `relations`")
+            document_class = inner.document_type
+            related = self.__class__(
+                model=document_class,
+                document=document_class,
+                collection=document_class._get_collection_name(),
+                **self._related_kwargs(),
+            )
+        relation = (related, field, isinstance(inner, ReferenceField))
+        self._relations[name] = relation
+        return relation
+
+    @staticmethod
+    def _reference_key(related, value):
+        """Returns the ID value that a reference points to."""
+        if isinstance(value, DBRef):
+            value = value.id
+        elif isinstance(value, Document):
+            value = value.pk
+        return related._id_value(value)
+
+    def _reference_ids(self, records: list, name: str, raw: bool = False) -> list:
+        """Collect the distinct IDs that the records reference through a relation.
+
+        :param list records: The records, as documents or raw records.
+        :param str name: The name of the relation's field.
+        :param bool raw: The records are raw records.
+        :return list: The referenced IDs.
+        :raises ValueError: If the related records cannot be attached to documents.
+        """
+        related, field, attachable = self._relation(name)
+        if not raw and not attachable:
+            raise ValueError(f"Field '{name}' can only be included in raw records")
+        key = field.db_field if raw else name
+        ids = {}
+        for record in records:
+            value = record.get(key) if raw else record._data.get(key)
+            for item in value if isinstance(value, list) else [value]:
+                if item is not None and not isinstance(item, (dict, Document)):
+                    ids[self._reference_key(related, item)] = None
+        return list(ids)
+
+    def _attach(self, records: list, name: str, related_records: dict, raw: bool = False):
+        """Replace the references of a relation in the records with the related records that were found.
+            References to records that were not found (or are marked "deleted") are left as they are.
+
+        :param list records: The records, as documents or raw records.
+        :param str name: The name of the relation's field.
+        :param dict related_records: The related records, by ID.
+        :param bool raw: The records are raw records.
+        """
+        related, field, _ = self._relation(name)
+        key = field.db_field if raw else name
+
+        def resolve(item):
+            if item is None or isinstance(item, (dict, Document)):
+                return item
+            return related_records.get(self._reference_key(related, item), item)
+
+        for record in records:
+            # documents get the related documents in place of the references, as if they had been dereferenced
+            data = record if raw else record._data
+            value = data.get(key)
+            if isinstance(value, list):
+                data[key] = [resolve(item) for item in value]
+            elif value is not None:
+                data[key] = resolve(value)
+
+    def _live_index_models(self) -> list:
+        """Build partial index definitions that only cover records which are not marked "deleted", one for each
+            index declared in the document class's `meta`. Unique and sparse indexes are skipped, since making them
+            partial would change their meaning.
+
+        :return list: A list of :class:`pymongo.operations.IndexModel` objects.
+        """
+        if self.soft_delete != "null":
+            raise ValueError(f"Soft delete strategy '{self.soft_delete}' cannot be used in a partial index")
+
+        models = []
+        for spec in self.document_class._meta.get("index_specs", []):
+            if spec.get("unique") or spec.get("sparse"):
+                logging.debug("skipping index spec: %s", spec)
+                continue
+            keys = list(spec["fields"])
+            name = spec.get("name") or "_".join(f"{key}_{direction}" for key, direction in keys)
+            models.append(IndexModel(keys, name=f"{name}_live", partialFilterExpression=self._deleted_filter()))
+        logging.debug("models: %s", models)
+
+        return models
+
+    def _missing_indexes(self, models: list, index_information: dict) -> list:
+        """Find the index definitions that do not exist in a collection.
+
+        :param list models: A list of :class:`pymongo.operations.IndexModel` objects.
+        :param dict index_information: The collection's indexes, as returned by `index_information()`.
+        :return list: The models whose names, keys or partial filters do not match an existing index.
+        """
+        missing = []
+        for model in models:
+            document = model.document
+            existing = index_information.get(document["name"])
+            if (
+                existing is None
+                or list(existing["key"]) != list(document["key"].items())
+                or existing.get("partialFilterExpression") != document.get("partialFilterExpression")
+            ):
+                missing.append(model)
+        return missing
+
+    def _options_filter(self, options: QueryOptions, deleted: bool = False) -> dict:
+        """Build the query filter for the specified query options, without any pagination cursor.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :return dict: A query filter.
+        """
+        query_filter = options.query_filter()
+        if not deleted:
+            query_filter.update(self._deleted_filter())
+        return query_filter
+
+    def _sort_spec(self, sort: list) -> list:
+        """Translate a sort into the database field names.
+
+        :param list sort: A list of `(field, direction)` tuples.
+        :return list: A list of `(db_field, direction)` tuples.
+        """
+        return [(self._db_field(name), direction) for name, direction in sort]
+
+    def _projection_spec(self, projection: list) -> dict:
+        """Translate a list of projected field names into a PyMongo projection.
+
+        :param list projection: A list of field names.
+        :return dict: The projection, or `None` if all fields should be returned.
+        """
+        if not projection:
+            return None
+        return {self._db_field(name): 1 for name in projection}
+
+    def _page_stages(self, options: QueryOptions, sort: list, projection: list) -> list:
+        """Build the aggregation stages that sort, paginate and project the matched records.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param list sort: A list of `(field, direction)` tuples.
+        :param list projection: A list of projected field names.
+        :return list: The stages.
+        """
+        stages = []
+        if sort:
+            stages.append({"$sort": dict(self._sort_spec(sort))})
+        if options.skip:
+            stages.append({"$skip": options.skip})
+        if options.limit:
+            stages.append({"$limit": options.limit})
+        if projection:
+            stages.append({"$project": self._projection_spec(projection)})
+        return stages
+
+    def _total_pipeline(self, options: QueryOptions, deleted: bool = False) -> list:
+        """Build an aggregation pipeline that returns a page of records and the total number of matches.
+
+        The records are sorted before the `$facet` stage, whose sub-pipelines cannot use indexes, so that the sort
+        can walk an index instead of sorting every match in memory. The page is returned inside the single result
+        document, so it has to fit in 16 MB.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :return list: The pipeline. It returns one document, with `records` and `total` lists.
+        """
+        query_filter, sort, projection = self._query_spec(options, deleted=deleted)
+        records = []
+        if options.cursor:
+            # the total counts every match, the page starts after the cursor
+            records.append({"$match": query_filter["$and"][1]})
+            query_filter = query_filter["$and"][0]
+        records.extend(self._page_stages(options, None, projection))
+
+        pipeline = [{"$match": query_filter}]
+        if sort:
+            pipeline.append({"$sort": dict(self._sort_spec(sort))})
+        pipeline.append({"$facet": {"records": records, "total": [{"$count": "count"}]}})
+        return pipeline
+
+    def _aggregate_pipeline(self, options: QueryOptions = None, stages: list = None, deleted: bool = False) -> list:
+        """Build an aggregation pipeline that starts with the filter, sort, pagination and projection of the
+            query options, followed by the caller's stages.
+
+        :param QueryOptions options: (Optional) Options specifying the records to aggregate.
+        :param list stages: (Optional) The aggregation stages to run on the matched records.
+        :param bool deleted: Include "deleted" objects in the query
+        :return list: The pipeline.
+        """
+        options = options or QueryOptions()
+        # the default projection is not applied, since the caller's stages may need any field
+        query_filter, sort, _ = self._query_spec(options, deleted=deleted)
+        pipeline = [{"$match": query_filter}]
+        pipeline.extend(self._page_stages(options, sort, options.projection))
+        pipeline.extend(stages or [])
+        logging.debug("pipeline: %s", pipeline)
+
+        return pipeline
+
+    def _query_spec(self, options: QueryOptions, deleted: bool = False, keyset: bool = False) -> tuple:
+        """Build the filter, sort and projection for the specified query options.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool keyset: Sort for keyset pagination, even if the options do not have a cursor.
+        :return tuple: The query filter, the list of `(field, direction)` sort tuples, and the list of projected
+            field names.
+        """
+        logging.debug("options: %s", options)
+        query_filter = self._options_filter(options, deleted=deleted)
+        sort = options.sort
+        projection = options.projection or self.default_projection or []
+        if projection and options.include:
+            # the included relations have to be fetched to be followed
+            names = list(dict.fromkeys(path.split(".")[0] for path in options.include))
+            projection = [name for name in projection if not any(name.startswith(f"{n}.") for n in names)]
+            projection.extend(name for name in names if name not in projection)
+        if keyset or options.cursor:
+            sort = options.keyset_sort()
+            if projection:
+                projection = list(projection) + [name for name, _ in sort if self._db_field(name) != "_id"]
+        if options.cursor:
+            query_filter = {"$and": [query_filter, self._keyset_filter(sort, options.decode_cursor(options.cursor))]}
+        logging.debug("query_filter: %s", query_filter)
+
+        return query_filter, sort, projection
+
+    def _from_record(self, record: dict, raw: bool = False) -> Document | dict:
+        """Turn a record read from the database into the value returned to the caller.
+
+        :param dict record: The record, as stored in the database.
+        :param bool raw: Return the record as a plain dictionary (see :meth:`_modify_record`) instead of a document.
+        :return Document: An instance of the object type from `model_class`, or a dictionary if `raw` is set.
+        """
+        if raw:
+            return self._modify_record(record)
+        return self.document_class._from_son(record)
+
+
+class MongoDataRepository(BaseMongoDataRepository):
+    """A repository class for interacting with a MongoDB database."""
+
+    def _get_collection(self, operation: str = None) -> Collection:
+        """Returns the collection to use for an operation, with the operation's read preference and write concern.
+
+        :param str operation: (Optional) The name of the repository operation, such as `query`.
+        :return Collection: The PyMongo collection.
+        """
+        connection = self.connection
+        cached = self._collections.get(operation)
+        # the collection is made again if the alias has been registered, unregistered or replaced since
+        if cached is not None and cached[0] is connection:
+            return cached[1]
+
+        if self.alias == self.document_class._meta.get("db_alias", DEFAULT_CONNECTION_NAME):
+            # the document class's collection, which mongoengine has created the indexes for
+            collection = self.document_class._get_collection()
+        else:
+            collection = get_db(self.alias)[self.document_class._get_collection_name()]
+        if connection is not None:
+            options = connection.collection_options(operation)
+            if options:
+                collection = collection.with_options(**options)
+        self._collections[operation] = (connection, collection)
+        return collection
+
+    def _objects(self, operation: str = None) -> QuerySet:
+        """Returns a query set for the document class, on the collection to use for an operation.
+
+        :param str operation: (Optional) The name of the repository operation, such as `query`.
+        :return QuerySet: The query set.
+        """
+        queryset_class = self.document_class._meta.get("queryset_class", QuerySet)
+        return queryset_class(self.document_class, self._get_collection(operation))
+
+    def _split_boundaries(self, query_filter: dict, parts: int, key: str = "_id", operation: str = None) -> list:
+        """Find the values of a key that split the records matching a filter into ranges of about the same size,
+        for use with :meth:`_range_filters`. Each boundary is found by skipping along the key's index, so the key
+        should be indexed.
+
+        :param dict query_filter: The query filter.
+        :param int parts: The number of ranges to split the records into.
+        :param str key: The name of the field to split on.
+        :param str operation: (Optional) The name of the repository operation the split is for.
+        :return list: The ascending boundary values. There may be fewer than `parts - 1` of them, if there are
+            few records or few distinct values.
+        """
+        collection = self._get_collection(operation)
+        field = self._db_field(key)
+        total = collection.count_documents(query_filter) if parts > 1 else 0
+        logging.debug("splitting %d records into %d parts by %s", total, parts, field)
+        boundaries = []
+        for part in range(1, parts):
+            skip = total * part // parts
+            if skip == 0:
+                continue
+            for record in collection.find(query_filter, {field: 1}, sort=[(field, 1)], skip=skip, limit=1):
+                self._add_boundary(boundaries, record, field)
+        logging.debug("boundaries: %s", boundaries)
+
+        return boundaries
+
+    def unit_of_work(self, max_size: int = 1000, ordered: bool = False) -> UnitOfWork:
+        """Start a unit of work, which queues creates, updates and deletes and writes them with one `bulk_write`.
+
+            with repo.unit_of_work() as uow:
+                created = uow.create({"name": "Quiz"})
+                uow.update(record_id, {"inc__score": 1})
+                uow.delete(other_id)
+            assert created.ok
+
+        :param int max_size: The number of queued writes at which the unit of work is flushed automatically.
+        :param bool ordered: Send the writes in order, stopping at the first failure.
+        :return UnitOfWork: The unit of work. See :class:`sweetrpg_db.mongodb.unit_of_work.UnitOfWork`.
+        """
+        return UnitOfWork(self, max_size=max_size, ordered=ordered)
+
+    def ensure_live_indexes(self, create: bool = True) -> list:
+        """Check that the collection has partial indexes covering only records which are not marked "deleted", for
+            each index declared in the document class, and create any that are missing.
+
+        Queries that filter on the indexed fields can then use these smaller indexes, since the soft-delete
+        predicate added to every query matches their partial filter.
+
+        :param bool create: Create the missing indexes. If `False`, they are only reported.
+        :return list: The names of the indexes that were missing.
+        """
+        collection = self._get_collection("ensure_live_indexes")
+        missing = self._missing_indexes(self._live_index_models(), collection.index_information())
+        names = [model.document["name"] for model in missing]
+        logging.info("Missing %s live indexes: %s", self.document_class.__name__, names)
+        if create and missing:
+            collection.create_indexes(missing)
+
+        return names
+
     def create(self, data: dict) -> Document:
         """Inserts a new object in the database with the data provided.
 
         :param dict data: The data for the object
         :return Document: The inserted document.
         """
-        logging.debug("data: %s", data)
+        with self._instrument("create") as event:
+            logging.debug("data: %s", data)
+
+            # collection = self.db[self.collection]
+            logging.info("Creating new %s record with data %s...", self.document_class.__name__, data)
+            doc = self.document_class(**data)
+            logging.debug("doc: %s", doc)
+            doc.validate()
+            if self.alias != self.document_class._meta.get("db_alias", DEFAULT_CONNECTION_NAME):
+                doc.switch_db(self.alias)
+            write_concern = self._collection_options("create").get("write_concern")
+            doc.save(write_concern=write_concern.document if write_concern is not None else None)
+            logging.debug("saved doc: %s", doc)
+            self._invalidate(doc.pk)
+
+            return event.set_result(doc)
+
+    def _insert_batch(self, collection, batch: list, ordered: bool, result: BulkCreateResult) -> bool:
+        """Write a batch of prepared documents with a single `insert_many` call.
+
+        :param collection: The PyMongo collection to write to.
+        :param list batch: A list of `(index, document)` tuples to insert.
+        :param bool ordered: Stop at the first failed write.
+        :param BulkCreateResult result: The result object to record inserted IDs and errors in.
+        :return bool: `True` if every document in the batch was written.
+        """
+        logging.debug("inserting batch of %d documents...", len(batch))
+        try:
+            collection.insert_many([son for _, son in batch], ordered=ordered)
+        except BulkWriteError as e:
+            write_errors = {err["index"]: err for err in e.details.get("writeErrors", [])}
+            logging.debug("write_errors: %s", write_errors)
+            for batch_index, (index, son) in enumerate(batch):
+                if batch_index in write_errors:
+                    result.errors.append((index, write_errors[batch_index].get("errmsg")))
+                    if ordered:
+                        break
+                else:
+                    result.inserted_ids.append(son["_id"])
+            return False
+
+        result.inserted_ids.extend(son["_id"] for _, son in batch)
+        return True
+
+    def create_many(self, data: Iterable, batch_size: int = 1000, ordered: bool = False) -> BulkCreateResult:
+        """Inserts new objects in the database, in batches.
+
+        Each item is validated against the document class before it is written. Items that fail validation or
+        fail to write are reported in the result instead of aborting the rest of the batch, unless `ordered`
+        is set, in which case processing stops at the first failure. Document save signals are not sent.
+
+        :param Iterable data: An iterable of data dictionaries, one for each object.
+        :param int batch_size: The maximum number of documents to send in one `insert_many` call.
+        :param bool ordered: Stop at the first item that fails validation or fails to write.
+        :return BulkCreateResult: The IDs of the inserted documents and any per-item errors.
+        """
+        with self._instrument("create_many") as event:
+            logging.info("Creating %s records in batches of %d...", self.document_class.__name__, batch_size)
+            collection = self._get_collection("create_many")
+            result = BulkCreateResult()
+            batch = []
+            for index, datum in enumerate(data):
+                try:
+                    doc = self.document_class(**datum)
+                    doc.validate()
+                except (FieldDoesNotExist, ValidationError) as e:
+                    logging.debug("item %d failed validation: %s", index, e)
+                    result.errors.append((index, e))
+                    if ordered:
+                        break
+                    continue
 
-        # collection = self.db[self.collection]
-        logging.info("Creating new %s record with data %s...", self.document_class.__name__, data)
-        doc = self.document_class(**data)
-        logging.debug("doc: %s", doc)
-        # result = collection.with_options(write_concern=WriteConcern(w=3, j=True)).insert_one(data)
-        doc.validate()
-        doc.save()
-        logging.debug("saved doc: %s", doc)
+                batch.append((index, doc.to_mongo()))
+                if len(batch) >= batch_size:
+                    if not self._insert_batch(collection, batch, ordered, result) and ordered:
+                        return event.set_result(result)
+                    batch = []
 
-        return doc
+            if batch:
+                self._insert_batch(collection, batch, ordered, result)
+            logging.debug("result: %s", result)
+            self._invalidate(*result.inserted_ids)
 
-    def get(self, record_id: str, deleted: bool = False) -> Document:
+            return event.set_result(result)
+
+    def get(self, record_id: str, deleted: bool = False, raw: bool = False) -> Document | dict:
         """Fetch a single record from the database.
 
         :param str record_id: The identifier for the record to fetch. This value is compared against the attribute specified in `id_attr`.
         :param bool deleted: Include "deleted" objects in the query
-        :return Document: An instance of the object type from `model_class`.
-        """
-        logging.debug("record_id: %s", record_id)
-        id_value = record_id
-        if isinstance(id_value, str):
-            id_value = ObjectId(record_id)
-        logging.debug("id_value: %s", id_value)
-        query_filter = {"_id": id_value}
-        if not deleted:
-            query_filter.update({"deleted_at": {"$not": {"$type": "date"}}})
-        logging.debug("query_filter: %s", query_filter)
+        :param bool raw: Return the record as a plain dictionary (see :meth:`_modify_record`) instead of a document.
+        :return Document: An instance of the object type from `model_class`, or a dictionary if `raw` is set.
+        """
+        with self._instrument("get") as event:
+            logging.debug("record_id: %s", record_id)
+            id_value = self._id_value(record_id)
+            logging.debug("id_value: %s", id_value)
+            query_filter = {"_id": id_value}
+            if not deleted:
+                query_filter.update(self._deleted_filter())
+            logging.debug("query_filter: %s", query_filter)
+            event.query_filter = query_filter
 
-        logging.info("Fetching %s record for ID %s...", self.document_class.__name__, id_value)
-        record = self.document_class.objects(__raw__=query_filter).first()  # QuerySet(self.document_class, self.collection)
-        # print(f"qs: {qs}")
-        # logging.debug("qs: %s", qs)
-        # record = None # qs.get(**query_filter)
-        logging.debug("record: %s", record)
-        # if not record:
-        #     raise ObjectNotFound(f"Record not found where for '{record_id}'")
+            if self.cache is not None:
+                return event.set_result(self._get_cached(id_value, query_filter, deleted=deleted, raw=raw))
 
-        return record
+            logging.info("Fetching %s record for ID %s...", self.document_class.__name__, id_value)
+            records = self._project(self._objects("get")(__raw__=query_filter))
+            if raw:
+                records = records.as_pymongo()
+            record = records.first()
+            # print(f"qs: {qs}")
+            # logging.debug("qs: %s", qs)
+            # record = None # qs.get(**query_filter)
+            logging.debug("record: %s", record)
+            # if not record:
+            #     raise ObjectNotFound(f"Record not found where for '{record_id}'")
 
-    def query(self, options: QueryOptions, deleted: bool = False) -> list:
-        """Perform a query for objects in the database.
+            if raw and record is not None:
+                return event.set_result(self._modify_record(record))
+            return event.set_result(record)
 
-        :param QueryOptions options: (Optional) Options specifying limits to the query's returned results
-        :return list: Returns a list of Document-subclass instances matching the query.
+    def _get_cached(self, id_value, query_filter: dict, deleted: bool = False, raw: bool = False) -> Document | dict:
+        """Fetch a single record through the repository's cache.
+
+        :param ObjectId id_value: The ID of the record.
+        :param dict query_filter: The filter to use if the record is not cached.
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the record as a plain dictionary instead of a document.
+        :return Document: An instance of the object type from `model_class`, or a dictionary if `raw` is set.
         """
-        logging.debug("options: %s", options)
-        query_filter = options.filters or {}
-        if not deleted:
-            query_filter.update({"deleted_at": {"$not": {"$type": "date"}}})
-        logging.debug("query_filter: %s", query_filter)
+        key = (self.collection, id_value, deleted)
+        record = self.cache.get(key)
+        if record is None:
+            logging.info("Fetching %s record for ID %s...", self.document_class.__name__, id_value)
+            # a write that invalidates the key during the read keeps the record it read out of the cache
+            token = self.cache.reserve(key)
+            try:
+                record = self._project(self._objects("get")(__raw__=query_filter)).as_pymongo().first()
+                logging.debug("record: %s", record)
+                if record is None:
+                    return None
+                self.cache.set(key, record, token=token)
+            finally:
+                self.cache.release(key, token)
+        return self._from_record(copy.deepcopy(record), raw=raw)
+
+    def get_many(self, record_ids: Iterable, deleted: bool = False, chunk_size: int = 1000, raw: bool = False) -> list:
+        """Fetch multiple records from the database with as few queries as possible.
+
+        :param Iterable record_ids: The identifiers for the records to fetch. These can be strings or
+            :class:`bson.objectid.ObjectId` values, mixed.
+        :param bool deleted: Include "deleted" objects in the query
+        :param int chunk_size: The maximum number of IDs to send in a single `$in` query.
+        :param bool raw: Return the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return list: A list with one entry per requested ID, in the same order. Entries for records that were not
+            found are `None`.
+        """
+        with self._instrument("get_many") as event:
+            id_values = list(map(self._id_value, record_ids))
+            logging.debug("id_values: %s", id_values)
+            unique_ids = list(dict.fromkeys(id_values))
+
+            logging.info("Fetching %d %s records...", len(unique_ids), self.document_class.__name__)
+            records = {}
+            for start in range(0, len(unique_ids), chunk_size):
+                query_filter = {"_id": {"$in": unique_ids[start : start + chunk_size]}}
+                if not deleted:
+                    query_filter.update(self._deleted_filter())
+                logging.debug("query_filter: %s", query_filter)
+                event.query_filter = query_filter
+                queryset = self._project(self._objects("get_many")(__raw__=query_filter))
+                if raw:
+                    for record in queryset.as_pymongo():
+                        records[record["_id"]] = self.converter.convert(record)
+                else:
+                    for record in queryset:
+                        records[record.pk] = record
+            logging.debug("records: %s", records)
+
+            return event.set_result([records.get(id_value) for id_value in id_values])
+
+    def _queryset(
+        self, options: QueryOptions, deleted: bool = False, keyset: bool = False, event: OperationEvent = None
+    ) -> QuerySet:
+        """Build a query set for the specified query options.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool keyset: Sort for keyset pagination, even if the options do not have a cursor.
+        :param OperationEvent event: (Optional) The instrumentation event to record the query filter in.
+        :return QuerySet: The query set. No query is sent until it is iterated.
+        """
+        query_filter, sort, projection = self._query_spec(options, deleted=deleted, keyset=keyset)
+        if event is not None:
+            event.query_filter = query_filter
 
         logging.info("Searching for %s records matching filter %s...", self.document_class, query_filter)
-        records = (
-            self.document_class.objects(__raw__=query_filter)
-            .order_by(*list(map(self._adjust_sort, options.sort)))
+        return (
+            self._objects(event.operation if event is not None else "query")(__raw__=query_filter)
+            .order_by(*list(map(self._adjust_sort, sort)))
             .skip(options.skip)
             .limit(options.limit)
-            .only(*options.projection)
+            .only(*projection)
         )
-        # qs = QuerySet(self.document_class, self.collection)
-        # if options.skip > 0:
-        #     qs.skip(options.skip)
-        # if options.limit > 0:
-        #     qs.limit(options.limit)
-        # if len(options.projection) > 0:
-        #     qs.only(*options.projection)
-        # if len(options.sort) > 0:
-        #     qs.order_by(*options.sort)
-        # print(f"qs: {qs}")
-        # logging.debug("qs: %s", qs)
-        # query_set = self.document_class.objects.skip(options.skip).limit(options.limit).order_by(options.sort).only(*options.projection)
-        # records = list(qs.all())  # .all()
-        logging.debug("records: %s", records)
-
-        # modified_records = map(self._modify_record, records)
-        # logging.debug("modified_records: %s", modified_records)
-
-        return list(records)
-
-    def update(self, record_id: str, update: dict, deleted: bool = False) -> Document:
+
+    def _prefetch(self, records: list, tree: dict, raw: bool = False):
+        """Fetch the records that a list of records references, with one query per relation level, and attach
+            them (see :meth:`_attach`).
+
+        :param list records: The records, as documents or raw records.
+        :param dict tree: The relations to follow, as returned by :meth:`_include_tree`.
+        :param bool raw: The records are raw records, and the related records are fetched as raw records.
+        """
+        for name, subtree in tree.items():
+            related, _, _ = self._relation(name)
+            ids = self._reference_ids(records, name, raw=raw)
+            logging.debug("including %d %s records", len(ids), name)
+            if not ids:
+                continue
+            found = {i: r for i, r in zip(ids, related.get_many(ids, raw=raw)) if r is not None}
+            self._attach(records, name, found, raw=raw)
+            if subtree:
+                related._prefetch(list(found.values()), subtree, raw=raw)
+
+    def query(self, options: QueryOptions, deleted: bool = False, raw: bool = False) -> list:
+        """Perform a query for objects in the database.
+
+        The records referenced through the relations in `options.include` are fetched with one query per relation
+        level, and attached in place of their references (see :meth:`_prefetch`).
+
+        :param QueryOptions options: (Optional) Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+            This skips building a document for each record.
+        :return list: Returns a list of Document-subclass instances matching the query, or dictionaries if `raw`
+            is set.
+        """
+        with self._instrument("query") as event:
+            if self.query_cache is not None:
+                records = self._query_cached(options, deleted=deleted, raw=raw, event=event)
+            else:
+                queryset = self._queryset(options, deleted=deleted, event=event)
+                logging.debug("records: %s", queryset)
+                if raw:
+                    records = self.converter.convert_many(queryset.as_pymongo())
+                    logging.debug("modified_records: %s", records)
+                else:
+                    records = list(queryset)
+
+            if options.include:
+                self._prefetch(records, self._include_tree(options.include), raw=raw)
+            return event.set_result(records)
+
+    def count(self, options: QueryOptions = None, deleted: bool = False, estimated: bool = False) -> int:
+        """Count the objects in the database matching a query.
+
+        :param QueryOptions options: (Optional) Options with the filters to count. Pagination options are ignored.
+        :param bool deleted: Include "deleted" objects in the count
+        :param bool estimated: If the options have no filters, use the collection's metadata for a fast, estimated
+            count instead of counting matches. The estimate includes objects marked "deleted".
+        :return int: The number of matching objects.
+        """
+        with self._instrument("count") as event:
+            options = options or QueryOptions(filters={})
+            collection = self._get_collection("count")
+            if estimated and not options.filters:
+                logging.info("Estimating the number of %s records...", self.document_class.__name__)
+                return event.set_result(collection.estimated_document_count())
+
+            query_filter = self._options_filter(options, deleted=deleted)
+            event.query_filter = query_filter
+            logging.info("Counting %s records matching filter %s...", self.document_class.__name__, query_filter)
+            return event.set_result(collection.count_documents(query_filter))
+
+    def query_with_total(
+        self, options: QueryOptions, deleted: bool = False, raw: bool = False, estimated: bool = False
+    ) -> QueryPage:
+        """Perform a query for a page of objects, and count all of the objects matching the query, in a single
+            `$facet` aggregation.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :param bool estimated: If the options have no filters, run the query and an estimated count (see
+            :meth:`count`) instead of the aggregation.
+        :return QueryPage: The page of Document-subclass instances, with the number of matching objects in `total`.
+        """
+        with self._instrument("query_with_total") as event:
+            if estimated and not options.filters:
+                records = self.query(options, deleted=deleted, raw=raw)
+                total = self.count(options, deleted=deleted, estimated=True)
+                return event.set_result(QueryPage(records, total=total))
+
+            pipeline = self._total_pipeline(options, deleted=deleted)
+            event.query_filter = pipeline[0]["$match"]
+            logging.info("Searching for %s records with total matching pipeline %s...", self.document_class, pipeline)
+            result = next(self._get_collection("query_with_total").aggregate(pipeline))
+            logging.debug("result: %s", result)
+            total = result["total"][0]["count"] if result["total"] else 0
+
+            records = [self._from_record(record, raw=raw) for record in result["records"]]
+            if options.include:
+                self._prefetch(records, self._include_tree(options.include), raw=raw)
+            return event.set_result(QueryPage(records, total=total))
+
+    def _query_cached(
+        self, options: QueryOptions, deleted: bool = False, raw: bool = False, event: OperationEvent = None
+    ) -> list:
+        """Perform a query through the repository's query cache.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the records as plain dictionaries instead of documents.
+        :param OperationEvent event: (Optional) The instrumentation event to record the query filter in.
+        :return list: Returns a list of Document-subclass instances matching the query, or dictionaries if `raw`
+            is set.
+        """
+        key = (self.collection, options.cache_key(), deleted)
+        records = self.query_cache.get(key)
+        if records is None:
+            token = self.query_cache.reserve(key)
+            try:
+                records = list(self._queryset(options, deleted=deleted, event=event).as_pymongo())
+                logging.debug("records: %s", records)
+                self.query_cache.set(key, records, token=token)
+            finally:
+                self.query_cache.release(key, token)
+        records = copy.deepcopy(records)
+
+        if raw:
+            return self.converter.convert_many(records)
+        return list(map(self.document_class._from_son, records))
+
+    def query_page(self, options: QueryOptions, deleted: bool = False, raw: bool = False) -> QueryPage:
+        """Fetch a page of objects using keyset pagination.
+
+        The query is sorted by the sort in `options` followed by `_id`. The returned page includes a cursor which
+        can be set as `options.cursor` to fetch the following page, with a range predicate instead of `skip`.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results. `limit` must be set
+            for a next-page cursor to be returned.
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool raw: Return the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return QueryPage: The page of Document-subclass instances, and the cursor for the next page.
+        """
+        with self._instrument("query_page") as event:
+            records = list(self._queryset(options, deleted=deleted, keyset=True, event=event).as_pymongo())
+            # the cursor is made from the stored values, which the server sorted by, without any field defaults
+            last_record = records[-1] if records else None
+            if raw:
+                records = self.converter.convert_many(records)
+            else:
+                records = list(map(self.document_class._from_son, records))
+            logging.debug("records: %s", records)
+
+            next_cursor = None
+            if options.limit > 0 and len(records) == options.limit:
+                next_cursor = self._make_cursor(last_record, options.keyset_sort())
+            logging.debug("next_cursor: %s", next_cursor)
+
+            if options.include:
+                self._prefetch(records, self._include_tree(options.include), raw=raw)
+            return event.set_result(QueryPage(records, next_cursor))
+
+    def iter_query(
+        self, options: QueryOptions, deleted: bool = False, batch_size: int = 100, raw: bool = False
+    ) -> Iterator[Document | dict]:
+        """Perform a query for objects in the database, yielding them as they are read from the cursor.
+
+        Unlike :meth:`query`, the results are not collected into a list or cached, so memory use does not grow
+        with the size of the result set.
+
+        :param QueryOptions options: Options specifying limits to the query's returned results
+        :param bool deleted: Include "deleted" objects in the query
+        :param int batch_size: The number of documents the server returns in each cursor batch.
+        :param bool raw: Yield the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return Iterator[Document]: An iterator of Document-subclass instances matching the query, or dictionaries
+            if `raw` is set.
+        """
+        with self._instrument("iter_query") as event:
+            event.result_count = 0
+            records = self._queryset(options, deleted=deleted, event=event).no_cache().batch_size(batch_size)
+            if raw:
+                records = map(self.converter.convert, records.as_pymongo())
+            for record in records:
+                event.result_count += 1
+                with event.paused():
+                    yield record
+
+    @staticmethod
+    def _put(output: queue.Queue, item, stopping: threading.Event) -> bool:
+        """Put an item in a scan's output queue, unless the scan is stopped while waiting for room.
+
+        :return bool: `True` if the item was queued.
+        """
+        while not stopping.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _scan_range(self, collection, query_filter: dict, fields: dict, sort: list, batch_size: int, output, stopping):
+        """Read one range of a parallel scan into an output queue, in chunks of up to `batch_size` records. A
+            `None` is queued when the range is finished, or the exception if reading it failed.
+        """
+        try:
+            chunk = []
+            with collection.find(query_filter, fields, sort=sort, batch_size=batch_size) as cursor:
+                for record in cursor:
+                    chunk.append(record)
+                    if len(chunk) >= batch_size:
+                        if not self._put(output, chunk, stopping):
+                            return
+                        chunk = []
+            if chunk and not self._put(output, chunk, stopping):
+                return
+            self._put(output, None, stopping)
+        except Exception as e:
+            self._put(output, e, stopping)
+
+    def iter_parallel(
+        self,
+        options: QueryOptions = None,
+        deleted: bool = False,
+        workers: int = 4,
+        key: str = "_id",
+        ordered: bool = False,
+        batch_size: int = 100,
+        raw: bool = False,
+    ) -> Iterator[Document | dict]:
+        """Scan the objects matching a query with several cursors in parallel, yielding them as they are read.
+
+        The matching records are split into ranges of `key` of about the same size, and each range is read by its
+        own thread. By default the records are yielded in the order they arrive. With `ordered`, each range is
+        sorted by `key` and the ranges are yielded one after the other, so the records are in order of `key`
+        (records whose key is missing or of another type come first); later ranges are read ahead while the
+        earlier ones are consumed.
+
+        :param QueryOptions options: (Optional) Options with the filters and projection of the scan. Sorting and
+            pagination are not supported.
+        :param bool deleted: Include "deleted" objects in the scan
+        :param int workers: The number of ranges to read in parallel.
+        :param str key: The name of an indexed field to split the ranges on.
+        :param bool ordered: Yield the records in order of `key`.
+        :param int batch_size: The number of documents the server returns in each cursor batch.
+        :param bool raw: Yield the records as plain dictionaries (see :meth:`_modify_record`) instead of documents.
+        :return Iterator[Document]: An iterator of Document-subclass instances matching the query, or dictionaries
+            if `raw` is set.
+        :raises ValueError: If the options sort or paginate.
+        """
+        with self._instrument("iter_parallel") as event:
+            event.result_count = 0
+            options = options or QueryOptions()
+            query_filter, fields, sort = self._scan_spec(options, deleted=deleted, key=key, ordered=ordered)
+            event.query_filter = query_filter
+            boundaries = self._split_boundaries(query_filter, workers, key=key, operation="iter_parallel")
+            filters = self._range_filters(query_filter, boundaries, key=key)
+            logging.info("Scanning %s records in %d range(s) of %s...", self.document_class, len(filters), key)
+
+            collection = self._get_collection("iter_parallel")
+            stopping = threading.Event()
+            if ordered:
+                outputs = [queue.Queue(maxsize=2) for _ in filters]
+            else:
+                outputs = [queue.Queue(maxsize=2 * len(filters))] * len(filters)
+            executor = ThreadPoolExecutor(max_workers=len(filters), thread_name_prefix=f"scan-{self.collection}")
+            try:
+                for range_filter, output in zip(filters, outputs):
+                    executor.submit(
+                        self._scan_range, collection, range_filter, fields, sort, batch_size, output, stopping
+                    )
+
+                # each queue is read until all of the ranges that write to it have finished
+                if ordered:
+                    readers = [(output, 1) for output in outputs]
+                else:
+                    readers = [(outputs[0], len(filters))]
+                for output, ranges in readers:
+                    finished = 0
+                    while finished < ranges:
+                        chunk = output.get()
+                        if chunk is None:
+                            finished += 1
+                            continue
+                        if isinstance(chunk, Exception):
+                            raise chunk
+                        for record in chunk:
+                            event.result_count += 1
+                            record = self._from_record(record, raw=raw)
+                            with event.paused():
+                                yield record
+            finally:
+                # stop the workers if the caller stops iterating early
+                stopping.set()
+                executor.shutdown(wait=False)
+
+    def _aggregate_cursor(
+        self,
+        options: QueryOptions,
+        stages: list,
+        deleted: bool,
+        allow_disk_use: bool,
+        batch_size: int,
+        event: OperationEvent,
+    ) -> CommandCursor:
+        pipeline = self._aggregate_pipeline(options, stages, deleted=deleted)
+        event.query_filter = pipeline[0]["$match"]
+        kwargs = {"allowDiskUse": allow_disk_use}
+        if batch_size is not None:
+            kwargs["batchSize"] = batch_size
+
+        logging.info("Aggregating %s records with pipeline %s...", self.document_class, pipeline)
+        return self._get_collection(event.operation).aggregate(pipeline, **kwargs)
+
+    def aggregate(
+        self,
+        options: QueryOptions = None,
+        stages: list = None,
+        deleted: bool = False,
+        allow_disk_use: bool = False,
+        batch_size: int = None,
+    ) -> list:
+        """Run an aggregation pipeline on the server.
+
+        The pipeline starts with a `$match`, `$sort`, `$skip`, `$limit` and `$project` built from the query options,
+        in that order, followed by `stages`. Use it to group or sum records next to the data, instead of fetching
+        them with :meth:`query`.
+
+        :param QueryOptions options: (Optional) Options specifying the records to aggregate. A keyset cursor is
+            applied as part of the `$match`.
+        :param list stages: (Optional) The aggregation stages to run on the matched records.
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool allow_disk_use: Let the server write temporary files for stages that exceed its memory limit.
+        :param int batch_size: (Optional) The number of documents the server returns in each cursor batch.
+        :return list: The documents the pipeline produced, as dictionaries.
+        """
+        with self._instrument("aggregate") as event:
+            cursor = self._aggregate_cursor(options, stages, deleted, allow_disk_use, batch_size, event)
+            return event.set_result(list(cursor))
+
+    def iter_aggregate(
+        self,
+        options: QueryOptions = None,
+        stages: list = None,
+        deleted: bool = False,
+        allow_disk_use: bool = False,
+        batch_size: int = 100,
+    ) -> Iterator[dict]:
+        """Run an aggregation pipeline on the server, yielding the documents as they are read from the cursor.
+
+        The pipeline is built as for :meth:`aggregate`.
+
+        :param QueryOptions options: (Optional) Options specifying the records to aggregate.
+        :param list stages: (Optional) The aggregation stages to run on the matched records.
+        :param bool deleted: Include "deleted" objects in the query
+        :param bool allow_disk_use: Let the server write temporary files for stages that exceed its memory limit.
+        :param int batch_size: The number of documents the server returns in each cursor batch.
+        :return Iterator[dict]: An iterator of the documents the pipeline produced.
+        """
+        with self._instrument("iter_aggregate") as event:
+            event.result_count = 0
+            with self._aggregate_cursor(options, stages, deleted, allow_disk_use, batch_size, event) as cursor:
+                for document in cursor:
+                    event.result_count += 1
+                    with event.paused():
+                        yield document
+
+    def update(
+        self, record_id: str, update: dict, deleted: bool = False, projection: list = None, raw: bool = False
+    ) -> Document | dict:
         """Update the specified record.
 
+        The update is applied atomically with a single `find_one_and_update` call, and the record is returned as it
+        is after the update.
+
         :param str record_id: The ID of the record to update.
-        :param dict update: The data to update for the record.
+        :param dict update: The data to update for the record. Keys use the same format as :meth:`Document.update`,
+            so plain field names are set and operators like `inc__score` are also accepted.
         :param bool deleted: Indicates whether the update operation should look for deleted records.
-        :return Document: The update version of the object.
-        """
-        id_value = record_id
-        if isinstance(id_value, str):
-            id_value = ObjectId(record_id)
-        # if self.id_attr == "_id":
-        #     logging.debug("ID attribute is '_id', converting to ObjectId")
-        #     id_value = ObjectId(record_id)
-        obj_filter = {"_id": id_value}
-        logging.debug("obj_filter: %s", obj_filter)
-
-        update_oper = {"$set": update}
-        logging.debug("update_oper: %s", update_oper)
-
-        logging.info("Marking %s record %s deleted...", self.model_class, id_value)
-        query_filter = {"_id": id_value}
-        if not deleted:
-            query_filter.update({"deleted_at": {"$not": {"$type": "date"}}})
-        logging.debug("query_filter: %s", query_filter)
-        # doc = self.document_class.objects.raw(query_filter).update(update_oper)
-        doc = self.get(record_id, deleted=deleted)
-        # if doc is None:
-        #     logging.info("No document found to update for record ID %s.", record_id)
-        #     return False
-        logging.debug("doc: %s", doc)
-        doc.update(**update)
+        :param list projection: A list of field names to include in the returned record. If `None`, the
+            repository's default projection is used, or all fields are returned if there is none.
+        :param bool raw: Return the record as a plain dictionary (see :meth:`_modify_record`) instead of a document.
+        :return Document: The update version of the object, or `None` if no matching record was found.
+        """
+        with self._instrument("update") as event:
+            id_value = self._id_value(record_id)
+            # if self.id_attr == "_id":
+            #     logging.debug("ID attribute is '_id', converting to ObjectId")
+            #     id_value = ObjectId(record_id)
 
-        return doc
+            update_oper = transform.update(self.document_class, **update)
+            logging.debug("update_oper: %s", update_oper)
 
-    def delete(self, record_id: str, actually: bool = False) -> bool:
+            logging.info("Updating %s record %s...", self.model_class, id_value)
+            query_filter = {"_id": id_value}
+            if not deleted:
+                query_filter.update(self._deleted_filter())
+            logging.debug("query_filter: %s", query_filter)
+            event.query_filter = query_filter
+
+            fields = self._projection_spec(projection or self.default_projection)
+            record = self._get_collection("update").find_one_and_update(
+                query_filter, update_oper, projection=fields, return_document=ReturnDocument.AFTER
+            )
+            logging.debug("record: %s", record)
+            self._invalidate(id_value)
+            if record is None:
+                logging.info("No document found to update for record ID %s.", record_id)
+                return event.set_result(None)
+
+            return event.set_result(self._from_record(record, raw=raw))
+
+    def delete(self, record_id: str, actually: bool = False) -> WriteResult:
         """'Delete' the specified record. Deletion is accomplished by setting the `deleted_at` field to the current
-            timestamp, so that queries for the object will ignore it.
+            timestamp with a single `update_one` call, so that queries for the object will ignore it.
 
         :param str record_id: The record ID of the object to delete. This can be a string or :class:`bson.objectid.ObjectId`.
-        :param bool actually: Actually delete the record instead of just marking it "deleted".
-        :return bool: A boolean indicating whether the record was able to be marked deleted.
-        :raises DoesNotExist:
-        """
-        id_value = record_id
-        if isinstance(id_value, str):
-            id_value = ObjectId(record_id)
-        doc = self.get(record_id)
-        # if doc is None:
-        #     logging.info("No document found to delete for record ID %s.", record_id)
-        #     return False
-
-        if actually:
-            logging.info("Deleting %s record %s...", self.model_class.__name__, id_value)
-            doc.delete()
-            return True
-        else:
+        :param bool actually: Actually delete the record instead of just marking it "deleted". Records that are
+            already marked "deleted" are also removed.
+        :return WriteResult: The matched and modified counts. This is truthy if the record was found.
+        """
+        with self._instrument("delete") as event:
+            id_value = self._id_value(record_id)
+
+            if actually:
+                logging.info("Deleting %s record %s...", self.model_class.__name__, id_value)
+                event.query_filter = {"_id": id_value}
+                count = self._objects("delete")(__raw__=event.query_filter).delete()
+                logging.debug("count: %s", count)
+                self._invalidate(id_value)
+                return event.set_result(WriteResult(count, count))
+
             logging.info("Marking %s record %s deleted...", self.model_class.__name__, id_value)
+            query_filter = {"_id": id_value, **self._deleted_filter()}
+            event.query_filter = query_filter
             now = datetime.datetime.utcnow()
-            doc.deleted_at = now
-            updated_doc = doc.save()
-            logging.debug("updated_doc: %s", updated_doc)
+            result = self._get_collection("delete").update_one(query_filter, {"$set": {"deleted_at": now}})
+            logging.debug("result: %s", result.raw_result)
+            self._invalidate(id_value)
 
-            return True
+            return event.set_result(WriteResult(result.matched_count, result.modified_count))
 
-        return False
+    def restore(self, record_id: str) -> WriteResult:
+        """Restore a record that was marked "deleted" by :meth:`delete`, by removing its `deleted_at` field.
+
+        :param str record_id: The record ID of the object to restore. This can be a string or :class:`bson.objectid.ObjectId`.
+        :return WriteResult: The matched and modified counts. This is truthy if a deleted record was found.
+        """
+        with self._instrument("restore") as event:
+            id_value = self._id_value(record_id)
+
+            logging.info("Restoring %s record %s...", self.model_class.__name__, id_value)
+            query_filter = {"_id": id_value, "deleted_at": {"$type": "date"}}
+            event.query_filter = query_filter
+            result = self._get_collection("restore").update_one(query_filter, {"$unset": {"deleted_at": ""}})
+            logging.debug("result: %s", result.raw_result)
+            self._invalidate(id_value)
+
+            return event.set_result(WriteResult(result.matched_count, result.modified_count))
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Result objects returned by MongoDB repository operations.
+"""
+
+
+class BulkCreateResult(object):
+    """The result of a :meth:`MongoDataRepository.create_many` call."""
+
+    def __init__(self):
+        """Initialize the BulkCreateResult object.
+
+        `inserted_ids` holds the IDs of the documents that were written, in input order. `errors` holds
+        `(index, error)` tuples, where `index` is the position of the failed item in the input.
+        """
+        self.inserted_ids = []
+        self.errors = []
+
+    def __repr__(self):
+        return f"<BulkCreateResult(inserted={len(self.inserted_ids)}, errors={len(self.errors)})>"
+
+    def __len__(self):
+        return len(self.inserted_ids)
+
+
+class QueryPage(object):
+    """A page of results from :meth:`MongoDataRepository.query_page` or :meth:`MongoDataRepository.query_with_total`."""
+
+    def __init__(self, records: list, next_cursor: str = None, total: int = None):
+        """Initialize the QueryPage object.
+
+        :param list records: The records in this page.
+        :param str next_cursor: The keyset pagination cursor for the next page, or `None` if this is the last page.
+        :param int total: The number of records matching the query across all pages, if it was counted.
+        """
+        self.records = records
+        self.next_cursor = next_cursor
+        self.total = total
+
+    def __repr__(self):
+        return f"<QueryPage(records={len(self.records)}, next_cursor={self.next_cursor}, total={self.total})>"
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+class WriteResult(object):
+    """The result of a single-record write, such as :meth:`MongoDataRepository.delete`."""
+
+    def __init__(self, matched_count: int, modified_count: int):
+        """Initialize the WriteResult object.
+
+        :param int matched_count: The number of records that matched the write's filter.
+        :param int modified_count: The number of records that were changed.
+        """
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+
+    def __repr__(self):
+        return f"<WriteResult(matched_count={self.matched_count}, modified_count={self.modified_count})>"
+
+    def __bool__(self):
+        return self.matched_count > 0
+
+
+class PendingWrite(object):
+    """A write queued in a :class:`sweetrpg_db.mongodb.unit_of_work.UnitOfWork`. Its outcome is filled in when the
+    unit of work is flushed.
+    """
+
+    def __init__(self, operation: str, record_id=None, document=None):
+        """Initialize the PendingWrite object.
+
+        :param str operation: The name of the queued operation: `create`, `update` or `delete`.
+        :param record_id: The ID of the record the write applies to. For `create`, this is set when the record is
+            inserted.
+        :param document: (Optional) The document that `create` validated and inserts.
+        """
+        self.operation = operation
+        self.record_id = record_id
+        self.document = document
+        self.flushed = False
+        self.error = None
+
+    def __repr__(self):
+        return f"<PendingWrite(operation={self.operation}, record_id={self.record_id}, flushed={self.flushed}, error={self.error})>"
+
+    @property
+    def ok(self) -> bool:
+        """`True` if the write was flushed without an error."""
+        return self.flushed and self.error is None
+
+
+class FlushResult(object):
+    """The result of flushing a :class:`sweetrpg_db.mongodb.unit_of_work.UnitOfWork`."""
+
+    def __init__(
+        self,
+        inserted_count: int = 0,
+        matched_count: int = 0,
+        modified_count: int = 0,
+        deleted_count: int = 0,
+    ):
+        """Initialize the FlushResult object.
+
+        The counts are totals for the whole flush, since the server does not report them per operation. `errors`
+        holds `(pending, error)` tuples, where `pending` is the :class:`PendingWrite` that failed.
+
+        :param int inserted_count: The number of records that were inserted.
+        :param int matched_count: The number of records that updates and soft deletes matched.
+        :param int modified_count: The number of records that updates and soft deletes changed.
+        :param int deleted_count: The number of records that were removed.
+        """
+        self.inserted_count = inserted_count
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.deleted_count = deleted_count
+        self.errors = []
+
+    def __repr__(self):
+        return f"<FlushResult(inserted_count={self.inserted_count}, matched_count={self.matched_count}, modified_count={self.modified_count}, deleted_count={self.deleted_count}, errors={len(self.errors)})>"
+
+
+class TransferResult(object):
+    """The result of an export or import from :mod:`sweetrpg_db.mongodb.transfer`."""
+
+    def __init__(self, count: int = 0, written_count: int = 0):
+        """Initialize the TransferResult object.
+
+        `errors` holds `(index, error)` tuples, where `index` is the position of the failed record in the input.
+
+        :param int count: The number of records that were read.
+        :param int written_count: The number of records that were written.
+        """
+        self.count = count
+        self.written_count = written_count
+        self.errors = []
+
+    def __repr__(self):
+        return f"<TransferResult(count={self.count}, written_count={self.written_count}, errors={len(self.errors)})>"
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Streaming export and import of a repository's collection to and from NDJSON or BSON files.
+"""
+
+import bson
+from bson import json_util
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
+import itertools
+import logging
+from mongoengine.errors import FieldDoesNotExist, ValidationError
+import os
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+import shutil
+import sys
+import tempfile
+from typing import Iterable, Iterator
+from .options import QueryOptions
+from .results import TransferResult
+
+
+FORMATS = ("ndjson", "bson")
+
+
+def detect_format(path: str) -> str:
+    """Guess the format of a file from its extension.
+
+    >>> detect_format("exams.bson")
+    'bson'
+    >>> detect_format("exams.jsonl")
+    'ndjson'
+
+    :param str path: The path of the file.
+    :return str: `bson` for `.bson` files, and `ndjson` for anything else.
+    """
+    return "bson" if path.lower().endswith(".bson") else "ndjson"
+
+
+def encode_record(record: dict, fmt: str) -> bytes:
+    """Encode a record for a file. NDJSON records are written as relaxed Extended JSON, one per line, so that
+    types such as `ObjectId` and dates survive the round trip.
+
+    :param dict record: The record, as stored in the database.
+    :param str fmt: The format, `ndjson` or `bson`.
+    :return bytes: The encoded record.
+    """
+    if fmt == "bson":
+        return bson.encode(record)
+    return (json_util.dumps(record, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n").encode("utf-8")
+
+
+def read_records(f, fmt: str) -> Iterator[dict]:
+    """Decode the records in a file.
+
+    :param f: The file, opened in binary mode.
+    :param str fmt: The format, `ndjson` or `bson`.
+    :return Iterator[dict]: The records.
+    """
+    if fmt == "bson":
+        yield from bson.decode_file_iter(f)
+        return
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json_util.loads(line.decode("utf-8"))
+
+
+def _output(path: str):
+    if path == "-":
+        return contextlib.nullcontext(sys.stdout.buffer)
+    return open(path, "wb")
+
+
+def _input(path: str):
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin.buffer)
+    return open(path, "rb")
+
+
+def _export_range(collection, query_filter: dict, fields: dict, f, fmt: str, batch_size: int) -> int:
+    logging.debug("exporting range: %s", query_filter)
+    count = 0
+    for record in collection.find(query_filter, fields, sort=[("_id", 1)], batch_size=batch_size):
+        f.write(encode_record(record, fmt))
+        count += 1
+    return count
+
+
+def _export_part(collection, query_filter: dict, fields: dict, path: str, fmt: str, batch_size: int) -> int:
+    with open(path, "wb") as f:
+        return _export_range(collection, query_filter, fields, f, fmt, batch_size)
+
+
+def export_records(
+    repo,
+    path: str,
+    fmt: str = None,
+    options: QueryOptions = None,
+    deleted: bool = False,
+    workers: int = 4,
+    batch_size: int = 1000,
+) -> TransferResult:
+    """Stream the records of a repository's collection to a file.
+
+    The matching records are split into `_id` ranges of about the same size, which the workers read in parallel
+    into temporary files next to the output. The files are then joined, so the output is in `_id` order.
+
+    :param BaseMongoDataRepository repo: The repository to export from.
+    :param str path: The path of the file to write, or `-` for standard output.
+    :param str fmt: (Optional) The format, `ndjson` or `bson`. By default it is guessed from the path.
+    :param QueryOptions options: (Optional) The filters and projection of the records to export. Other options
+        are ignored. Without a projection, the repository's default projection is used.
+    :param bool deleted: Include records marked "deleted".
+    :param int workers: The number of ranges to read in parallel.
+    :param int batch_size: The number of records the server returns in each cursor batch.
+    :return TransferResult: The number of records written.
+    """
+    fmt = fmt or detect_format(path)
+    with repo._instrument("export") as event:
+        query_filter, _, projection = repo._query_spec(options or QueryOptions(), deleted=deleted)
+        event.query_filter = query_filter
+        fields = repo._projection_spec(projection)
+        collection = repo._get_collection("export")
+        filters = repo._range_filters(query_filter, repo._split_boundaries(query_filter, workers, operation="export"))
+        logging.info("Exporting %s in %d range(s) to %s...", repo.collection, len(filters), path)
+
+        if len(filters) == 1:
+            with _output(path) as f:
+                count = _export_range(collection, query_filter, fields, f, fmt, batch_size)
+        else:
+            directory = None if path == "-" else os.path.dirname(os.path.abspath(path))
+            with tempfile.TemporaryDirectory(dir=directory) as temp_dir:
+                part_paths = [os.path.join(temp_dir, f"part{index}") for index in range(len(filters))]
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(_export_part, collection, part_filter, fields, part_path, fmt, batch_size)
+                        for part_filter, part_path in zip(filters, part_paths)
+                    ]
+                    count = sum(future.result() for future in futures)
+                with _output(path) as f:
+                    for part_path in part_paths:
+                        with open(part_path, "rb") as part:
+                            shutil.copyfileobj(part, f)
+
+        logging.info("Exported %d %s records", count, repo.collection)
+        event.result_count = count
+        return TransferResult(count=count, written_count=count)
+
+
+def _batches(records: Iterable, batch_size: int) -> Iterator[list]:
+    records = iter(records)
+    while batch := list(itertools.islice(records, batch_size)):
+        yield batch
+
+
+def _write_batch(collection, batch: list, upsert: bool) -> tuple:
+    """Write a batch of records with one unordered `bulk_write`.
+
+    :param collection: The PyMongo collection to write to.
+    :param list batch: A list of `(index, record)` tuples.
+    :param bool upsert: Replace existing records with the same `_id`, instead of failing to insert them.
+    :return tuple: The number of records written, and a list of `(index, error)` tuples.
+    """
+    if upsert:
+        requests = [ReplaceOne({"_id": r["_id"]}, r, upsert=True) if "_id" in r else InsertOne(r) for _, r in batch]
+    else:
+        requests = [InsertOne(r) for _, r in batch]
+    try:
+        details = collection.bulk_write(requests, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+    errors = [(batch[err["index"]][0], err.get("errmsg")) for err in details.get("writeErrors", [])]
+    written = details.get("nInserted", 0) + details.get("nUpserted", 0) + details.get("nMatched", 0)
+    logging.debug("wrote batch of %d records, %d errors", written, len(errors))
+    return written, errors
+
+
+def import_records(
+    repo,
+    path: str,
+    fmt: str = None,
+    workers: int = 4,
+    batch_size: int = 1000,
+    upsert: bool = False,
+    validate: bool = False,
+) -> TransferResult:
+    """Stream records from a file into a repository's collection.
+
+    The file is read in batches, which the workers write in parallel, each with one unordered `bulk_write`. A
+    failed write is reported in the result and does not stop the import.
+
+    :param BaseMongoDataRepository repo: The repository to import into.
+    :param str path: The path of the file to read, or `-` for standard input.
+    :param str fmt: (Optional) The format, `ndjson` or `bson`. By default it is guessed from the path.
+    :param int workers: The number of batches to write in parallel.
+    :param int batch_size: The number of records in each batch.
+    :param bool upsert: Replace existing records with the same `_id`, instead of failing to insert them.
+    :param bool validate: Validate each record against the document class, and skip the ones that fail, including
+        records with fields that a strict document class does not declare.
+    :return TransferResult: The number of records read and written, and the per-record errors.
+    """
+    fmt = fmt or detect_format(path)
+    with repo._instrument("import") as event:
+        logging.info("Importing %s from %s...", repo.collection, path)
+        collection = repo._get_collection("import")
+        result = TransferResult()
+
+        def record(futures):
+            for future in futures:
+                written, errors = future.result()
+                result.written_count += written
+                result.errors.extend(errors)
+
+        with _input(path) as f, ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for batch in _batches(enumerate(read_records(f, fmt)), batch_size):
+                result.count += len(batch)
+                if validate:
+                    valid = []
+                    for index, son in batch:
+                        try:
+                            repo.document_class._from_son(son).validate()
+                            valid.append((index, son))
+                        except (FieldDoesNotExist, ValidationError) as e:
+                            result.errors.append((index, e))
+                    batch = valid
+                if batch:
+                    pending.add(executor.submit(_write_batch, collection, batch, upsert))
+                # bound the number of decoded batches waiting in memory
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    record(done)
+            record(wait(pending).done)
+
+        result.errors.sort(key=lambda error: error[0])
+        if repo.cache is not None:
+            repo.cache.invalidate_collection(repo.collection)
+        repo._invalidate()
+        logging.info("Imported %d of %d %s records", result.written_count, result.count, repo.collection)
+        event.result_count = result.written_count
+        return result
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Units of work, which buffer repository writes and send them as one bulk write.
+"""
+
+from bson.objectid import ObjectId
+import datetime
+import logging
+from mongoengine.queryset import transform
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from .results import FlushResult, PendingWrite
+
+
+class BaseUnitOfWork(object):
+    """The parts of a unit of work that do not depend on how the database is accessed.
+
+    Writes are queued as `[kind, filter_or_document, update, pendings]` entries, where `kind` is `insert`, `update`
+    or `delete`, and `pendings` are the :class:`sweetrpg_db.mongodb.results.PendingWrite` objects whose outcome
+    the entry decides.
+    """
+
+    # update operators whose effects on the same field can be combined into one update
+    _merge_operators = {"$set", "$unset", "$inc"}
+
+    def __init__(self, repo, max_size: int = 1000, ordered: bool = False):
+        """Initialize the unit of work.
+
+        :param BaseMongoDataRepository repo: The repository to write through.
+        :param int max_size: The number of queued writes at which the unit of work is flushed automatically.
+        :param bool ordered: Send the writes in order, stopping at the first failure. By default they are sent
+            unordered, which lets the server apply them in any order.
+        """
+        self.repo = repo
+        self.max_size = max_size
+        self.ordered = ordered
+        self.results = []
+        self._reset()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}(repo={self.repo}, queued={len(self)}, flushes={len(self.results)})>"
+
+    def __len__(self):
+        return len(self._writes)
+
+    def _reset(self):
+        self._writes = []
+        # the queued update for each (id, deleted) pair that later updates can be merged into
+        self._updates = {}
+
+    @staticmethod
+    def _overlaps(path: str, other: str) -> bool:
+        return path == other or path.startswith(f"{other}.") or other.startswith(f"{path}.")
+
+    def _merge_update(self, existing: dict, update: dict) -> bool:
+        """Merge an update into a queued update for the same record, if the result is the same as applying them
+        one after the other: later `$set` and `$unset` values replace earlier ones, and `$inc` amounts are added.
+
+        :param dict existing: The queued update. It is changed in place if the updates can be merged.
+        :param dict update: The update to merge.
+        :return bool: `True` if the update was merged.
+        """
+        for operator, values in update.items():
+            if operator not in self._merge_operators:
+                return False
+            for path, value in values.items():
+                for existing_operator, existing_values in existing.items():
+                    for existing_path, existing_value in existing_values.items():
+                        if not self._overlaps(path, existing_path):
+                            continue
+                        if existing_operator != operator or existing_path != path:
+                            return False
+                        if operator == "$inc" and not (
+                            isinstance(value, (int, float)) and isinstance(existing_value, (int, float))
+                        ):
+                            return False
+
+        for operator, values in update.items():
+            target = existing.setdefault(operator, {})
+            for path, value in values.items():
+                if operator == "$inc" and path in target:
+                    target[path] += value
+                else:
+                    target[path] = value
+        return True
+
+    def _queue_create(self, data: dict) -> PendingWrite:
+        doc = self.repo.document_class(**data)
+        doc.validate()
+        son = doc.to_mongo()
+        if "_id" not in son:
+            son["_id"] = ObjectId()
+            doc.pk = son["_id"]
+        pending = PendingWrite("create", son["_id"], doc)
+        self._writes.append(["insert", son, None, [pending]])
+        return pending
+
+    def _queue_update(self, record_id, update: dict, deleted: bool = False) -> PendingWrite:
+        id_value = self.repo._id_value(record_id)
+        update_oper = transform.update(self.repo.document_class, **update)
+        logging.debug("update_oper: %s", update_oper)
+        pending = PendingWrite("update", id_value)
+
+        key = (id_value, deleted)
+        write = self._updates.get(key)
+        if write is not None and self._merge_update(write[2], update_oper):
+            write[3].append(pending)
+            return pending
+
+        query_filter = {"_id": id_value}
+        if not deleted:
+            query_filter.update(self.repo._deleted_filter())
+        write = ["update", query_filter, update_oper, [pending]]
+        self._writes.append(write)
+        self._updates[key] = write
+        return pending
+
+    def _queue_delete(self, record_id, actually: bool = False) -> PendingWrite:
+        id_value = self.repo._id_value(record_id)
+        pending = PendingWrite("delete", id_value)
+        # later updates must not be merged into updates queued before the delete
+        self._updates.pop((id_value, False), None)
+        self._updates.pop((id_value, True), None)
+
+        if actually:
+            self._writes.append(["delete", {"_id": id_value}, None, [pending]])
+        else:
+            query_filter = {"_id": id_value, **self.repo._deleted_filter()}
+            update_oper = {"$set": {"deleted_at": datetime.datetime.utcnow()}}
+            self._writes.append(["update", query_filter, update_oper, [pending]])
+        return pending
+
+    @staticmethod
+    def _requests(writes: list) -> list:
+        requests = []
+        for kind, query_filter, update_oper, _ in writes:
+            if kind == "insert":
+                requests.append(InsertOne(query_filter))
+            elif kind == "update":
+                requests.append(UpdateOne(query_filter, update_oper))
+            else:
+                requests.append(DeleteOne(query_filter))
+        return requests
+
+    def _take(self) -> list:
+        writes = self._writes
+        self._reset()
+        logging.info("Flushing %d %s writes...", len(writes), self.repo.document_class.__name__)
+        return writes
+
+    def _finish(self, writes: list, details: dict) -> FlushResult:
+        """Record the outcome of a bulk write in the pending writes.
+
+        :param list writes: The writes that were sent.
+        :param dict details: The bulk write's `bulk_api_result`, or the details of its error.
+        :return FlushResult: The result of the flush.
+        """
+        result = FlushResult(
+            inserted_count=details.get("nInserted", 0),
+            matched_count=details.get("nMatched", 0),
+            modified_count=details.get("nModified", 0),
+            deleted_count=details.get("nRemoved", 0),
+        )
+        errors = {err["index"]: err.get("errmsg") for err in details.get("writeErrors", [])}
+        logging.debug("errors: %s", errors)
+        if details.get("writeConcernErrors"):
+            logging.warning("Write concern errors: %s", details["writeConcernErrors"])
+        # an ordered bulk write stops at its first error, so the writes after it were not attempted
+        last_index = min(errors) if self.ordered and errors else len(writes) - 1
+
+        for index, (_, _, _, pendings) in enumerate(writes[: last_index + 1]):
+            for pending in pendings:
+                pending.flushed = True
+                if index in errors:
+                    pending.error = errors[index]
+                    result.errors.append((pending, errors[index]))
+        self.repo._invalidate(*{pending.record_id for _, _, _, pendings in writes for pending in pendings})
+        self.results.append(result)
+
+        return result
+
+
+class UnitOfWork(BaseUnitOfWork):
+    """Collects creates, updates and deletes for a repository, and writes them with a single `bulk_write`.
+
+    Use it as a context manager, from :meth:`sweetrpg_db.mongodb.repo.MongoDataRepository.unit_of_work`. The
+    queued writes are flushed when the block exits without an exception, and are discarded otherwise. Each queued
+    write returns a :class:`sweetrpg_db.mongodb.results.PendingWrite` that reports its outcome after the flush.
+
+    Repeated updates to the same record are merged into one update where possible. Writes are sent unordered
+    unless `ordered` is set, so writes to the same record should not depend on one another, apart from merged
+    updates.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            logging.info("Discarding %d queued %s writes", len(self), self.repo.document_class.__name__)
+            self._reset()
+        return False
+
+    def _flush_if_full(self):
+        if len(self) >= self.max_size:
+            self.flush()
+
+    def create(self, data: dict) -> PendingWrite:
+        """Queue the insert of a new record. The data is validated immediately.
+
+        :param dict data: The data for the record.
+        :return PendingWrite: The pending write. Its `record_id` and `document` are set right away.
+        """
+        pending = self._queue_create(data)
+        self._flush_if_full()
+        return pending
+
+    def update(self, record_id, update: dict, deleted: bool = False) -> PendingWrite:
+        """Queue an update of a record.
+
+        :param record_id: The ID of the record to update.
+        :param dict update: The data to update, in the same format as for
+            :meth:`sweetrpg_db.mongodb.repo.MongoDataRepository.update`.
+        :param bool deleted: Also update the record if it is marked "deleted".
+        :return PendingWrite: The pending write.
+        """
+        pending = self._queue_update(record_id, update, deleted=deleted)
+        self._flush_if_full()
+        return pending
+
+    def delete(self, record_id, actually: bool = False) -> PendingWrite:
+        """Queue the deletion of a record.
+
+        :param record_id: The ID of the record to delete.
+        :param bool actually: Remove the record instead of marking it "deleted".
+        :return PendingWrite: The pending write.
+        """
+        pending = self._queue_delete(record_id, actually=actually)
+        self._flush_if_full()
+        return pending
+
+    def flush(self) -> FlushResult:
+        """Send the queued writes as one `bulk_write`.
+
+        :return FlushResult: The counts and per-write errors of the flush.
+        """
+        if not self._writes:
+            return FlushResult()
+
+        with self.repo._instrument("flush") as event:
+            writes = self._take()
+            event.result_count = sum(len(pendings) for _, _, _, pendings in writes)
+            collection = self.repo._get_collection("flush")
+            try:
+                details = collection.bulk_write(self._requests(writes), ordered=self.ordered).bulk_api_result
+            except BulkWriteError as e:
+                details = e.details
+            return self._finish(writes, details)
+
+
+class AsyncUnitOfWork(BaseUnitOfWork):
+    """The asyncio version of :class:`UnitOfWork`, from
+    :meth:`sweetrpg_db.mongodb.async_repo.AsyncMongoDataRepository.unit_of_work`. Use it with `async with`.
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.flush()
+        else:
+            logging.info("Discarding %d queued %s writes", len(self), self.repo.document_class.__name__)
+            self._reset()
+        return False
+
+    async def _flush_if_full(self):
+        if len(self) >= self.max_size:
+            await self.flush()
+
+    async def create(self, data: dict) -> PendingWrite:
+        """Queue the insert of a new record. See :meth:`UnitOfWork.create`."""
+        pending = self._queue_create(data)
+        await self._flush_if_full()
+        return pending
+
+    async def update(self, record_id, update: dict, deleted: bool = False) -> PendingWrite:
+        """Queue an update of a record. See :meth:`UnitOfWork.update`."""
+        pending = self._queue_update(record_id, update, deleted=deleted)
+        await self._flush_if_full()
+        return pending
+
+    async def delete(self, record_id, actually: bool = False) -> PendingWrite:
+        """Queue the deletion of a record. See :meth:`UnitOfWork.delete`."""
+        pending = self._queue_delete(record_id, actually=actually)
+        await self._flush_if_full()
+        return pending
+
+    async def flush(self) -> FlushResult:
+        """Send the queued writes as one `bulk_write`. See :meth:`UnitOfWork.flush`."""
+        if not self._writes:
+            return FlushResult()
+
+        with self.repo._instrument("flush") as event:
+            writes = self._take()
+            event.result_count = sum(len(pendings) for _, _, _, pendings in writes)
+            collection = self.repo._get_collection("flush")
+            try:
+                result = await collection.bulk_write(self._requests(writes), ordered=self.ordered)
+                details = result.bulk_api_result
+            except BulkWriteError as e:
+                details = e.details
+            return self._finish(writes, details)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Projections derived from marshmallow schemas.
+"""
+
+import logging
+from marshmallow import Schema, fields
+
+
+def _field_paths(field: fields.Field, path: str, seen: tuple) -> list:
+    """Find the attribute paths a schema field reads when it is dumped.
+
+    :param Field field: The schema field.
+    :param str path: The attribute path of the field.
+    :param tuple seen: The schema classes being expanded, to stop on recursive nesting.
+    :return list: The paths, or `None` if the field can read any attribute.
+    """
+    if isinstance(field, (fields.Method, fields.Function)):
+        return None
+    elif isinstance(field, fields.Pluck):
+        inner = field.schema.fields[field.field_name]
+        return _field_paths(inner, f"{path}.{inner.attribute or field.field_name}", seen)
+    elif isinstance(field, fields.Nested):
+        schema = field.schema
+        if schema.__class__ in seen:
+            return [path]
+        paths = _schema_paths(schema, seen + (schema.__class__,))
+        if paths is None:
+            return [path]
+        return [f"{path}.{p}" for p in paths]
+    elif isinstance(field, fields.List):
+        return _field_paths(field.inner, path, seen)
+    elif isinstance(field, fields.Tuple):
+        paths = []
+        for inner in field.tuple_fields:
+            inner_paths = _field_paths(inner, path, seen)
+            if inner_paths is None:
+                return [path]
+            paths.extend(inner_paths)
+        return paths
+
+    return [path]
+
+
+def _schema_paths(schema: Schema, seen: tuple) -> list:
+    paths = []
+    for name, field in schema.dump_fields.items():
+        field_paths = _field_paths(field, field.attribute or name, seen)
+        if field_paths is None:
+            logging.debug("field '%s' of %s has no fixed attributes", name, schema.__class__.__name__)
+            return None
+        paths.extend(field_paths)
+    return paths
+
+
+def schema_projection(schema: Schema | type) -> list:
+    """Derive the attribute paths that a schema serializes, for use as a query projection.
+
+    Nested schemas are expanded into dotted paths, and the `only` and `exclude` options of the schema and its
+    nested fields are respected. A path that is inside another path in the list is dropped, since the outer path
+    already includes it.
+
+    >>> class ScoreSchema(Schema):
+    ...     value = fields.Int()
+    ...     scale = fields.Str()
+    >>> class ExamSchema(Schema):
+    ...     id = fields.Str()
+    ...     title = fields.Str(attribute="name")
+    ...     score = fields.Nested(ScoreSchema, only=["value"])
+    ...     graders = fields.List(fields.Pluck(lambda: ExamSchema, "id"))
+    ...     secret = fields.Str(load_only=True)
+    >>> schema_projection(ExamSchema)
+    ['id', 'name', 'score.value', 'graders.id']
+
+    :param Schema schema: The schema, or schema class, to derive the projection from.
+    :return list: The attribute paths, or `None` if the schema has fields (such as `Method` or `Function` fields)
+        that can read any attribute, so all fields have to be fetched.
+    """
+    if isinstance(schema, type):
+        schema = schema()
+    paths = _schema_paths(schema, (schema.__class__,))
+    if paths is None:
+        return None
+
+    projection = []
+    for path in dict.fromkeys(paths):
+        if any(path.startswith(f"{other}.") for other in paths):
+            continue
+        projection.append(path)
+    return projection
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for async repo functions
+"""
+
+from sweetrpg_db.mongodb.async_repo import AsyncMongoDataRepository
+from sweetrpg_db.mongodb.loader import AsyncRecordLoader
+from sweetrpg_db.mongodb.options import QueryOptions
+from sweetrpg_model_core.model.base import BaseModel
+from asgiref.sync import async_to_sync
+import asyncio
+import os
+from dotenv import load_dotenv
+import pytest
+from bson.objectid import ObjectId
+from mongoengine import Document, fields
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    # without the ``async`` extra installed, run against an in-memory stand-in for Motor
+    from mongomock_motor import AsyncMongoMockClient as AsyncIOMotorClient
+
+
+load_dotenv()
+MONGODB_URI = os.environ["MONGODB_URI"]
+
+
+class AsyncTestModel(BaseModel):
+    """ """
+
+    pass
+
+
+class AsyncTestDocument(Document):
+    """ """
+
+    meta = {
+        "collection": "async_exams",
+        "strict": False,
+    }
+
+    name = fields.StringField(required=True)
+    score = fields.IntField(min_value=0, max_value=100, default=0)
+
+
+class AsyncIncludeSystem(Document):
+    """ """
+
+    meta = {"collection": "async_include_systems", "strict": False}
+
+    name = fields.StringField()
+
+
+class AsyncIncludeVolume(Document):
+    """ """
+
+    meta = {"collection": "async_include_volumes", "strict": False}
+
+    name = fields.StringField()
+    system = fields.ReferenceField(AsyncIncludeSystem)
+
+
+@pytest.fixture(scope="module")
+def repo():
+    client = AsyncIOMotorClient(MONGODB_URI)
+    return AsyncMongoDataRepository(
+        model=AsyncTestModel, document=AsyncTestDocument, collection="async_exams", db=client["unit-tests"]
+    )
+
+
+def test_async_create_and_get(repo):
+    doc = async_to_sync(repo.create)({"name": "Async Quiz", "score": 64})
+    assert doc.pk is not None
+    fetched = async_to_sync(repo.get)(str(doc.pk))
+    assert isinstance(fetched, AsyncTestDocument)
+    assert fetched.score == 64
+    raw = async_to_sync(repo.get)(doc.pk, raw=True)
+    assert raw["id"] == str(doc.pk)
+    docs = async_to_sync(repo.get_many)([ObjectId(), doc.pk])
+    assert docs[0] is None
+    assert docs[1].pk == doc.pk
+    async_to_sync(repo.delete)(doc.pk, actually=True)
+
+
+def test_async_query(repo):
+    for score in (30, 10, 20):
+        async_to_sync(repo.create)({"name": "Async Sorted", "score": score})
+    options = QueryOptions(filters={"name": {"$eq": "Async Sorted"}}, sort=[("score", 1)])
+    docs = async_to_sync(repo.query)(options)
+    assert [d.score for d in docs] == [10, 20, 30]
+
+    async def collect():
+        return [r async for r in repo.iter_query(options, batch_size=2, raw=True)]
+
+    records = async_to_sync(collect)()
+    assert [r["score"] for r in records] == [10, 20, 30]
+    assert async_to_sync(repo.count)(options) == 3
+    options.limit = 1
+    page = async_to_sync(repo.query_with_total)(options)
+    assert page.total == 3
+    assert [d.score for d in page] == [10]
+
+    stages = [{"$group": {"_id": "$name", "total": {"$sum": "$score"}}}]
+    assert async_to_sync(repo.aggregate)(QueryOptions(filters=options.filters), stages) == [
+        {"_id": "Async Sorted", "total": 60}
+    ]
+
+    async def collect_aggregate():
+        return [d async for d in repo.iter_aggregate(options, [{"$project": {"_id": 0, "score": 1}}])]
+
+    assert async_to_sync(collect_aggregate)() == [{"score": 10}]
+    for d in docs:
+        async_to_sync(repo.delete)(d.pk, actually=True)
+
+
+def test_async_update_delete_restore(repo):
+    doc = async_to_sync(repo.create)({"name": "Async Update", "score": 1})
+    updated = async_to_sync(repo.update)(doc.pk, {"inc__score": 2})
+    assert updated.score == 3
+    assert async_to_sync(repo.delete)(doc.pk)
+    assert async_to_sync(repo.get)(doc.pk) is None
+    assert async_to_sync(repo.update)(doc.pk, {"score": 5}) is None
+    assert async_to_sync(repo.restore)(doc.pk)
+    assert async_to_sync(repo.get)(doc.pk).score == 3
+    assert async_to_sync(repo.delete)(doc.pk, actually=True)
+
+
+def test_async_unit_of_work(repo):
+    doc = async_to_sync(repo.create)({"name": "Async Unit of Work", "score": 1})
+
+    async def work():
+        async with repo.unit_of_work() as uow:
+            created = await uow.create({"name": "Async Unit of Work", "score": 2})
+            updated = await uow.update(doc.pk, {"inc__score": 1})
+            await uow.update(doc.pk, {"inc__score": 1})
+            await uow.delete(created.record_id, actually=True)
+        return uow, created, updated
+
+    uow, created, updated = async_to_sync(work)()
+    assert created.ok and updated.ok
+    assert uow.results[0].deleted_count == 1
+    assert async_to_sync(repo.get)(doc.pk).score == 3
+    assert async_to_sync(repo.get)(created.record_id, deleted=True) is None
+    async_to_sync(repo.delete)(doc.pk, actually=True)
+
+
+def test_async_iter_parallel(repo):
+    docs = [async_to_sync(repo.create)({"name": "Async Parallel", "score": i}) for i in range(12)]
+    options = QueryOptions(filters={"name": {"$eq": "Async Parallel"}})
+
+    async def collect(**kwargs):
+        return [r async for r in repo.iter_parallel(options, workers=3, batch_size=2, **kwargs)]
+
+    assert sorted(d.score for d in async_to_sync(collect)()) == list(range(12))
+    records = async_to_sync(collect)(key="score", ordered=True, raw=True)
+    assert [r["score"] for r in records] == list(range(12))
+    for d in docs:
+        async_to_sync(repo.delete)(d.pk, actually=True)
+
+
+def test_async_record_loader(repo):
+    docs = [async_to_sync(repo.create)({"name": "Async Loaded", "score": i}) for i in range(3)]
+    loader = AsyncRecordLoader(repo)
+
+    async def load():
+        return await asyncio.gather(*(loader.load(d.pk) for d in reversed(docs)))
+
+    assert [d.score for d in async_to_sync(load)()] == [2, 1, 0]
+    assert loader.batches == 1
+    for d in docs:
+        async_to_sync(repo.delete)(d.pk, actually=True)
+
+
+def test_async_query_include(repo):
+    system_repo = AsyncMongoDataRepository(
+        model=dict, document=AsyncIncludeSystem, collection="async_include_systems", db=repo.db
+    )
+    volume_repo = AsyncMongoDataRepository(
+        model=dict, document=AsyncIncludeVolume, collection="async_include_volumes", db=repo.db
+    )
+    system = async_to_sync(system_repo.create)({"name": "Async System"})
+    volume = async_to_sync(volume_repo.create)({"name": "Async Volume", "system": system})
+    options = QueryOptions(include=["system"])
+
+    docs = async_to_sync(volume_repo.query)(options)
+    assert docs[0]._data["system"].name == "Async System"
+    records = async_to_sync(volume_repo.query)(options, raw=True)
+    assert records[0]["system"]["id"] == str(system.pk)
+    async_to_sync(volume_repo.delete)(volume.pk, actually=True)
+    async_to_sync(system_repo.delete)(system.pk, actually=True)
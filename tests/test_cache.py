@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for repository caches
+"""
+
+from sweetrpg_db.mongodb.cache import LRUCache
+import pytest
+
+
+class FakeClock(object):
+    """ """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_get_set():
+    cache = LRUCache(max_size=2)
+    assert cache.get(("c", 1)) is None
+    cache.set(("c", 1), "one")
+    assert cache.get(("c", 1)) == "one"
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "size": 1}
+
+
+def test_cache_lru_eviction():
+    cache = LRUCache(max_size=2)
+    cache.set(("c", 1), "one")
+    cache.set(("c", 2), "two")
+    cache.get(("c", 1))
+    cache.set(("c", 3), "three")
+    assert cache.get(("c", 2)) is None
+    assert cache.get(("c", 1)) == "one"
+    assert cache.get(("c", 3)) == "three"
+    assert cache.evictions == 1
+
+
+def test_cache_ttl():
+    clock = FakeClock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set(("c", 1), "one")
+    clock.now = 9.9
+    assert cache.get(("c", 1)) == "one"
+    clock.now = 10.0
+    assert cache.get(("c", 1)) is None
+    assert len(cache) == 0
+
+
+def test_cache_invalidate():
+    cache = LRUCache()
+    cache.set(("a", 1), "one")
+    cache.set(("a", 2), "two")
+    cache.set(("b", 1), "three")
+    cache.invalidate(("a", 1))
+    assert cache.get(("a", 1)) is None
+    cache.invalidate_collection("a")
+    assert cache.get(("a", 2)) is None
+    assert cache.get(("b", 1)) == "three"
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_cache_bind():
+    cache = LRUCache()
+    cache.bind("exams", ("null", ()))
+    cache.bind("exams", ("null", ()))
+    cache.bind("volumes", ("type", ("name",)))
+    with pytest.raises(ValueError):
+        cache.bind("exams", ("null", ("name",)))
+
+
+def test_cache_reserve():
+    cache = LRUCache()
+    token = cache.reserve(("a", 1))
+    assert cache.set(("a", 1), "one", token=token)
+    cache.release(("a", 1), token)
+    assert cache.get(("a", 1)) == "one"
+
+    # a value read before the key was invalidated is stale
+    token = cache.reserve(("a", 1))
+    cache.invalidate(("a", 1))
+    assert not cache.set(("a", 1), "old", token=token)
+    cache.release(("a", 1), token)
+    assert cache.get(("a", 1)) is None
+
+    token = cache.reserve(("a", 2))
+    cache.invalidate_collection("a")
+    assert not cache.set(("a", 2), "old", token=token)
+    cache.release(("a", 2), token)
+    assert cache._pending == {}
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for the command line interface
+"""
+
+from sweetrpg_db.cli import main
+from pymongo import MongoClient
+import os
+from dotenv import load_dotenv
+import pytest
+
+
+load_dotenv()
+MONGODB_URI = os.environ["MONGODB_URI"]
+
+
+@pytest.fixture
+def collection():
+    collection = MongoClient(host=MONGODB_URI).get_default_database("unit-tests")["cli_exams"]
+    collection.delete_many({})
+    yield collection
+    collection.delete_many({})
+
+
+def test_export_import(collection, tmp_path, capsys):
+    collection.insert_many([{"name": f"Exam {i}", "score": i} for i in range(10)])
+    collection.update_one({"score": 0}, {"$currentDate": {"deleted_at": True}})
+    path = str(tmp_path / "exams.jsonl")
+
+    args = ["export", "cli_exams", path, "--workers", "2", "--filter", '{"score": {"$lt": 5}}']
+    assert main(["--uri", MONGODB_URI] + args) == 0
+    assert "Exported 4 records" in capsys.readouterr().err
+
+    collection.delete_many({})
+    assert main(["--uri", MONGODB_URI, "import", "cli_exams", path]) == 0
+    assert sorted(r["score"] for r in collection.find()) == [1, 2, 3, 4]
+    assert main(["--uri", MONGODB_URI, "import", "cli_exams", path]) == 1
+    assert "Imported 0 of 4 records" in capsys.readouterr().err
+
+
+def test_bad_document(tmp_path, capsys):
+    path = str(tmp_path / "exams.jsonl")
+    assert main(["--uri", MONGODB_URI, "export", "cli_exams", path, "--document", "sweetrpg_db"]) == 2
+    assert "package.module:name" in capsys.readouterr().err
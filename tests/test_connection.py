@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for the connection registry
+"""
+
+from sweetrpg_db.mongodb.connection import ConnectionRegistry, ConnectionSettings
+from pymongo import ReadPreference
+from pymongo.write_concern import WriteConcern
+import pytest
+
+
+def test_settings_client_options():
+    settings = ConnectionSettings(
+        max_pool_size=50,
+        min_pool_size=5,
+        compressors=["zstd", "zlib"],
+        connect_timeout=2.5,
+        server_selection_timeout=5,
+        socket_timeout=10,
+        appname="tests",
+    )
+    assert settings.client_options() == {
+        "maxPoolSize": 50,
+        "minPoolSize": 5,
+        "compressors": "zstd,zlib",
+        "connectTimeoutMS": 2500,
+        "serverSelectionTimeoutMS": 5000,
+        "socketTimeoutMS": 10000,
+        "appname": "tests",
+    }
+    assert "socketTimeoutMS" not in ConnectionSettings().client_options()
+
+
+def test_settings_collection_options():
+    settings = ConnectionSettings(
+        read_preference="primaryPreferred",
+        write_concern={"w": "majority"},
+        read_preferences={"query": "secondaryPreferred", "count": ReadPreference.NEAREST},
+        write_concerns={"create": WriteConcern(w=1, j=True)},
+    )
+    assert settings.collection_options("query") == {
+        "read_preference": ReadPreference.SECONDARY_PREFERRED,
+        "write_concern": WriteConcern(w="majority"),
+    }
+    assert settings.collection_options("count")["read_preference"] == ReadPreference.NEAREST
+    assert settings.collection_options("create")["write_concern"] == WriteConcern(w=1, j=True)
+    assert settings.collection_options("get")["read_preference"] == ReadPreference.PRIMARY_PREFERRED
+    assert ConnectionSettings().collection_options("query") == {}
+
+    with pytest.raises(ValueError):
+        ConnectionSettings(read_preference="secondaryOnly")
+
+
+def test_registry():
+    registry = ConnectionRegistry()
+    settings = registry.register("registry-tests", host="mongodb://localhost/registry-tests", max_pool_size=10)
+    try:
+        assert "registry-tests" in registry
+        assert registry.get("registry-tests") is settings
+        assert registry.get("unknown") is None
+        with pytest.raises(ValueError):
+            registry.register("registry-tests", host="mongodb://localhost/registry-tests")
+    finally:
+        registry.unregister("registry-tests")
+    assert "registry-tests" not in registry
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for record conversion
+"""
+
+from sweetrpg_db.mongodb.convert import RecordConverter, convert_value
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+from mongoengine import Document, fields
+import datetime
+
+
+class ConvertDocument(Document):
+    """ """
+
+    meta = {"collection": "converts", "strict": False}
+
+    name = fields.StringField()
+    owner = fields.ObjectIdField(db_field="owner_id")
+    created_at = fields.DateTimeField()
+    refs = fields.ListField(fields.ObjectIdField())
+    tags = fields.ListField(fields.StringField())
+
+
+def test_convert_value():
+    oid = ObjectId()
+    now = datetime.datetime(2024, 1, 2, 3, 4, 5, 6000)
+    assert convert_value(oid) == str(oid)
+    assert convert_value(now) == "2024-01-02T03:04:05.006+00:00"
+    assert convert_value(Timestamp(0, 1)) == datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    assert convert_value([oid, "x"]) == [str(oid), "x"]
+    assert convert_value(5) == 5
+
+
+def test_converter_cached():
+    assert RecordConverter.for_document(ConvertDocument) is RecordConverter.for_document(ConvertDocument)
+
+
+def test_converter_convert():
+    oid = ObjectId()
+    owner = ObjectId()
+    now = datetime.datetime(2024, 1, 2, 3, 4, 5, 6000)
+    record = {
+        "_id": oid,
+        "name": "Name",
+        "owner_id": owner,
+        "created_at": now,
+        "refs": [owner, None],
+        "tags": ["a"],
+        "extra": [now],
+        "missing": None,
+    }
+    converted = RecordConverter.for_document(ConvertDocument).convert(record)
+    assert converted == {
+        "id": str(oid),
+        "name": "Name",
+        "owner_id": str(owner),
+        "created_at": "2024-01-02T03:04:05.006+00:00",
+        "refs": [str(owner), None],
+        "tags": ["a"],
+        "extra": ["2024-01-02T03:04:05.006+00:00"],
+        "missing": None,
+    }
+
+
+def test_converter_convert_many():
+    records = [{"_id": ObjectId(), "created_at": None} for _ in range(3)]
+    converted = RecordConverter(ConvertDocument).convert_many(records)
+    assert [c["id"] for c in converted] == [str(r["_id"]) for r in records]
+    assert all(c["created_at"] is None for c in converted)
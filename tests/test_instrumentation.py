@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for repository instrumentation
+"""
+
+from sweetrpg_db.mongodb.instrumentation import HistogramCollector, OperationEvent, SlowQueryLogger, redact_filter
+from sweetrpg_db.mongodb.results import QueryPage, WriteResult
+import logging
+import time
+
+
+def make_event(operation="query", duration=0.02, result_count=3, error=None):
+    event = OperationEvent(operation, "exams")
+    event.query_filter = {"name": "secret", "deleted_at": None}
+    event.duration = duration
+    event.result_count = result_count
+    event.error = error
+    return event
+
+
+def test_redact_filter():
+    shape = redact_filter({"_id": {"$in": [1, 2]}, "$and": [{"a": 1}, {"b": {"$gt": 2}}], "tags": ["x"]})
+    assert shape == {"_id": {"$in": "?"}, "$and": [{"a": "?"}, {"b": {"$gt": "?"}}], "tags": "?"}
+
+
+def test_event_set_result():
+    event = OperationEvent("get", "exams")
+    assert event.set_result(None) is None
+    assert event.result_count == 0
+    event.set_result([1, None, 2])
+    assert event.result_count == 2
+    event.set_result(QueryPage([1, 2, 3]))
+    assert event.result_count == 3
+    event.set_result(WriteResult(1, 0))
+    assert event.result_count == 0
+    event.set_result({"id": "x"})
+    assert event.result_count == 1
+
+
+def test_event_paused():
+    event = OperationEvent("iter_query", "exams")
+    with event.paused():
+        time.sleep(0.02)
+    with event.paused():
+        time.sleep(0.02)
+    assert event.consumer_time >= 0.04
+
+
+def test_slow_query_logger(caplog):
+    logger = SlowQueryLogger(threshold=0.01)
+    with caplog.at_level(logging.WARNING):
+        logger(make_event(duration=0.001))
+        assert caplog.records == []
+        logger(make_event(duration=0.5))
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert "Slow query on exams" in message
+    assert "secret" not in message
+
+
+def test_histogram_collector():
+    histogram = HistogramCollector(buckets=(0.01, 0.1))
+    histogram(make_event(duration=0.005))
+    histogram(make_event(duration=0.05, result_count=None, error=ValueError()))
+    histogram(make_event(duration=5))
+    histogram(make_event(operation="get", duration=0.01, result_count=1))
+    snapshot = histogram.snapshot()
+    query = snapshot[("exams", "query")]
+    assert query["counts"] == [1, 1, 1]
+    assert query["count"] == 3
+    assert query["results"] == 6
+    assert query["errors"] == 1
+    assert snapshot[("exams", "get")]["counts"] == [1, 0, 0]
+    histogram.reset()
+    assert histogram.snapshot() == {}
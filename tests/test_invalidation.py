@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for change stream cache invalidation
+"""
+
+from sweetrpg_db.mongodb.invalidation import ChangeStreamInvalidator, FileTokenStore, TokenStore
+from sweetrpg_db.mongodb.repo import MongoDataRepository
+from sweetrpg_db.mongodb.cache import LRUCache
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+import datetime
+import os
+from dotenv import load_dotenv
+import pytest
+import time
+from bson.objectid import ObjectId
+from mongoengine import connect, Document, fields
+
+
+load_dotenv()
+MONGODB_URI = os.environ["MONGODB_URI"]
+
+
+class WatchedDocument(Document):
+    """ """
+
+    meta = {"collection": "watched_exams", "strict": False, "db_alias": "unit-tests"}
+
+    name = fields.StringField(required=True)
+    score = fields.IntField(default=0)
+    deleted_at = fields.DateTimeField()
+
+
+class FakeStream(object):
+    """Replays change events, and stops the invalidator when they run out."""
+
+    def __init__(self, invalidator, changes):
+        self.invalidator = invalidator
+        self.changes = list(changes)
+        self.resume_token = None
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def try_next(self):
+        if not self.changes:
+            self.invalidator.stop()
+            return None
+        change = self.changes.pop(0)
+        self.resume_token = change["_id"]
+        return change
+
+
+def _repo(**kwargs):
+    return MongoDataRepository(model=dict, document=WatchedDocument, collection="watched_exams", **kwargs)
+
+
+def test_handle_invalidates():
+    cache, query_cache = LRUCache(), LRUCache()
+    repo = _repo(cache=cache, query_cache=query_cache)
+    id_value = ObjectId()
+    cache.set(("watched_exams", id_value, False), {"_id": id_value, "name": "old"})
+    query_cache.set(("watched_exams", "query"), [])
+    invalidator = ChangeStreamInvalidator(repo)
+
+    invalidator.handle({"operationType": "update", "documentKey": {"_id": id_value}})
+    assert cache.get(("watched_exams", id_value, False)) is None
+    assert query_cache.get(("watched_exams", "query")) is None
+    assert invalidator.changes == 1
+
+
+def test_handle_refresh():
+    cache = LRUCache()
+    repo = _repo(cache=cache)
+    invalidator = ChangeStreamInvalidator(repo, refresh=True)
+    live, deleted = ObjectId(), ObjectId()
+
+    invalidator.handle({"operationType": "replace", "documentKey": {"_id": live}, "fullDocument": {"_id": live}})
+    assert cache.get(("watched_exams", live, False)) == {"_id": live}
+    assert cache.get(("watched_exams", live, True)) == {"_id": live}
+
+    document = {"_id": deleted, "deleted_at": datetime.datetime.utcnow()}
+    invalidator.handle({"operationType": "update", "documentKey": {"_id": deleted}, "fullDocument": document})
+    assert cache.get(("watched_exams", deleted, False)) is None
+    assert cache.get(("watched_exams", deleted, True)) == document
+
+
+def test_handle_collection_operation():
+    cache = LRUCache()
+    repo = _repo(cache=cache)
+    other = ("other", ObjectId(), False)
+    cache.set(("watched_exams", ObjectId(), False), {})
+    cache.set(other, {})
+
+    ChangeStreamInvalidator(repo).handle({"operationType": "drop"})
+    assert len(cache) == 1
+    assert cache.get(other) == {}
+
+
+def test_run_saves_token(monkeypatch):
+    cache = LRUCache()
+    repo = _repo(cache=cache)
+    store = TokenStore()
+    store.save({"_data": "start"})
+    invalidator = ChangeStreamInvalidator(repo, token_store=store, save_interval=3600)
+    id_value = ObjectId()
+    cache.set(("watched_exams", id_value, False), {})
+    watched = []
+
+    def watch(token):
+        watched.append(token)
+        change = {"_id": {"_data": "1"}, "operationType": "delete", "documentKey": {"_id": id_value}}
+        return FakeStream(invalidator, [change])
+
+    monkeypatch.setattr(invalidator, "_watch", watch)
+    invalidator.run()
+    assert watched == [{"_data": "start"}]
+    assert cache.get(("watched_exams", id_value, False)) is None
+    assert store.load() == {"_data": "1"}
+
+
+def test_run_history_lost(monkeypatch):
+    cache = LRUCache()
+    repo = _repo(cache=cache)
+    store = TokenStore()
+    store.save({"_data": "expired"})
+    invalidator = ChangeStreamInvalidator(repo, token_store=store)
+    cache.set(("watched_exams", ObjectId(), False), {})
+    watched = []
+
+    def watch(token):
+        watched.append(token)
+        if token is not None:
+            raise OperationFailure("resume point may no longer be in the oplog", code=286)
+        return FakeStream(invalidator, [])
+
+    monkeypatch.setattr(invalidator, "_watch", watch)
+    invalidator.run()
+    assert watched == [{"_data": "expired"}, None]
+    assert len(cache) == 0
+    assert store.load() is None
+
+
+def test_file_token_store(tmp_path):
+    path = str(tmp_path / "token.json")
+    store = FileTokenStore(path)
+    assert store.load() is None
+    store.save({"_data": "8263"})
+    assert FileTokenStore(path).load() == {"_data": "8263"}
+
+
+def _replica_set() -> bool:
+    try:
+        return bool(MongoClient(host=MONGODB_URI).admin.command("hello").get("setName"))
+    except Exception:
+        return False
+
+
+def test_replica_set(tmp_path):
+    if not _replica_set():
+        pytest.skip("change streams need a replica set")
+
+    connect(host=MONGODB_URI, alias="unit-tests")
+    cache = LRUCache()
+    repo = _repo(cache=cache)
+    store = FileTokenStore(str(tmp_path / "token.json"))
+    doc = repo.create({"name": "Watched Quiz"})
+    invalidator = ChangeStreamInvalidator(repo, token_store=store, max_await_time=0.2, save_interval=0)
+    invalidator.start()
+    try:
+        time.sleep(0.5)
+        repo.get(doc.pk)
+        assert cache.get(("watched_exams", doc.pk, False)) is not None
+        WatchedDocument._get_collection().update_one({"_id": doc.pk}, {"$set": {"score": 5}})
+        deadline = time.monotonic() + 5
+        while cache.get(("watched_exams", doc.pk, False)) is not None and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert cache.get(("watched_exams", doc.pk, False)) is None
+    finally:
+        invalidator.stop()
+        WatchedDocument._get_collection().delete_many({})
+    assert store.load() is not None
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for record loaders
+"""
+
+from sweetrpg_db.mongodb.loader import AsyncRecordLoader, LoaderScope, RecordLoader
+from sweetrpg_db.mongodb.repo import MongoDataRepository
+import asyncio
+import os
+from dotenv import load_dotenv
+import pytest
+from bson.objectid import ObjectId
+from mongoengine import connect, Document, fields
+
+
+load_dotenv()
+MONGODB_URI = os.environ["MONGODB_URI"]
+
+
+class LoadedDocument(Document):
+    """ """
+
+    meta = {"collection": "loaded_exams", "strict": False, "db_alias": "unit-tests"}
+
+    name = fields.StringField(required=True)
+    score = fields.IntField(default=0)
+
+
+@pytest.fixture
+def repo():
+    connect(host=MONGODB_URI, alias="unit-tests")
+    repo = MongoDataRepository(model=dict, document=LoadedDocument, collection="loaded_exams")
+    repo.events = []
+    repo.add_listener(repo.events.append)
+    yield repo
+    LoadedDocument._get_collection().delete_many({})
+
+
+def _queries(repo) -> int:
+    return sum(1 for event in repo.events if event.operation == "get_many")
+
+
+def test_record_loader(repo):
+    ids = repo.create_many({"name": f"Loaded {i}"} for i in range(3)).inserted_ids
+    loader = RecordLoader(repo)
+    missing = ObjectId()
+
+    deferred = [loader.defer(ids[0]), loader.defer(str(ids[1])), loader.defer(ids[0]), loader.defer(missing)]
+    assert [d.get() and d.get().name for d in deferred] == ["Loaded 0", "Loaded 1", "Loaded 0", None]
+    assert _queries(repo) == 1
+    assert loader.load(ids[1]) is deferred[1].get()
+    assert loader.load_many([ids[2], ids[0]])[0].name == "Loaded 2"
+    assert _queries(repo) == 2
+
+    loader.clear(ids[0])
+    assert loader.load(str(ids[0])).name == "Loaded 0"
+    assert loader.batches == _queries(repo) == 3
+
+
+def test_async_record_loader(repo):
+    ids = repo.create_many({"name": f"Loaded {i}"} for i in range(3)).inserted_ids
+    scope = LoaderScope(AsyncRecordLoader, raw=True)
+
+    async def resolve(record_id):
+        await asyncio.sleep(0)
+        return await scope[repo].load(record_id)
+
+    async def run():
+        first = await asyncio.gather(*(scope[repo].load(i) for i in [ids[0], str(ids[1]), ids[0], ObjectId()]))
+        second = await scope[repo].load_many([ids[1], ids[2]])
+        third = await asyncio.gather(resolve(ids[2]), resolve(ids[0]))
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert [r and r["name"] for r in first] == ["Loaded 0", "Loaded 1", "Loaded 0", None]
+    assert [r["name"] for r in second] == ["Loaded 1", "Loaded 2"]
+    assert [r["name"] for r in third] == ["Loaded 2", "Loaded 0"]
+    assert scope[repo].batches == _queries(repo) == 2
+
+
+def test_async_record_loader_error(repo, monkeypatch):
+    doc = repo.create({"name": "Loaded Later"})
+    loader = AsyncRecordLoader(repo)
+    get_many = repo.get_many
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("connection lost")
+
+    async def run():
+        monkeypatch.setattr(repo, "get_many", fail)
+        with pytest.raises(RuntimeError):
+            await loader.load(doc.pk)
+        monkeypatch.setattr(repo, "get_many", get_many)
+        return await loader.load(doc.pk)
+
+    assert asyncio.run(run()).name == "Loaded Later"
@@ -5,6 +5,14 @@ Test cases for QueryOptions
 """
 
 from sweetrpg_db.mongodb.options import QueryOptions
+from bson.code import Code
+from bson.decimal128 import Decimal128
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from bson.timestamp import Timestamp
+import datetime
+import pytest
 
 
 def test_options_init():
@@ -59,3 +67,176 @@ def test_options_set_by_querystring():
     # assert o.filters == {"field": {"op": "value"}}
     # assert o.projection == projection
     # assert o.sort == [{"field": 1}]
+
+
+def test_options_keyset_sort():
+    o = QueryOptions(sort=[("score", -1)])
+    assert o.keyset_sort() == [("score", -1), ("_id", -1)]
+    o = QueryOptions(sort=[("_id", 1)])
+    assert o.keyset_sort() == [("_id", 1)]
+    assert QueryOptions().keyset_sort() == [("_id", 1)]
+
+
+def test_options_cursor_round_trip():
+    values = [42, ObjectId(), datetime.datetime(2024, 1, 2, 3, 4, 5, 6000)]
+    cursor = QueryOptions.encode_cursor(values)
+    assert isinstance(cursor, str)
+    assert QueryOptions.decode_cursor(cursor) == values
+
+
+def test_options_cursor_invalid():
+    with pytest.raises(ValueError):
+        QueryOptions.decode_cursor("not a cursor")
+    with pytest.raises(ValueError):
+        QueryOptions.decode_cursor(QueryOptions.encode_cursor([{"$ne": None}, ObjectId()]))
+    for value in (Regex("^a"), Code("1"), [1], Timestamp(0, 1)):
+        with pytest.raises(ValueError):
+            QueryOptions.decode_cursor(QueryOptions.encode_cursor([value, ObjectId()]))
+    values = [None, True, 1, Int64(2), 1.5, Decimal128("1.5"), "a", ObjectId(), datetime.datetime(2024, 1, 2)]
+    assert QueryOptions.decode_cursor(QueryOptions.encode_cursor(values)) == values
+
+
+def test_options_cache_key():
+    a = QueryOptions()
+    a.set_filters(
+        from_querystring=[{"name": "score", "op": "gt", "val": 5}, {"name": "tags", "op": "in_", "val": ["x", "y"]}]
+    )
+    a.set_projection(projection=["name", "score"])
+    b = QueryOptions()
+    b.set_filters(
+        from_querystring=[{"name": "tags", "op": "in_", "val": ["x", "y"]}, {"name": "score", "op": "gt", "val": 5}]
+    )
+    b.set_projection(projection=["score", "name"])
+    assert hash(a.cache_key()) == hash(b.cache_key())
+    assert a.cache_key() == b.cache_key()
+    b.limit = 10
+    assert a.cache_key() != b.cache_key()
+
+
+def test_options_cache_key_collisions():
+    def key(filters):
+        return QueryOptions(filters=filters).cache_key()
+
+    # MongoDB matches each of these pairs differently
+    assert key({"active": True}) != key({"active": 1})
+    assert key({"score": {"$in": [1, True]}}) != key({"score": {"$in": [1, 1]}})
+    assert key({"grade": {"a": 1, "b": 2}}) != key({"grade": {"b": 2, "a": 1}})
+    assert key({"grade": {"a": 1}}) != key({"grade": [("a", 1)]})
+    assert key({"$or": [{"grade": {"a": 1, "b": 2}}]}) != key({"$or": [{"grade": {"b": 2, "a": 1}}]})
+
+    # the order of fields and operators does not matter
+    assert key({"a": 1, "b": {"$gt": 1, "$lt": 5}}) == key({"b": {"$lt": 5, "$gt": 1}, "a": 1})
+    assert key({"tags": {"$elemMatch": {"x": 1, "y": {"$ne": 2}}}}) == key(
+        {"tags": {"$elemMatch": {"y": {"$ne": 2}, "x": 1}}}
+    )
+
+
+def test_options_defaults_not_shared():
+    a = QueryOptions()
+    b = QueryOptions()
+    a.filters["name"] = "x"
+    a.projection.append("name")
+    a.sort.append(("name", 1))
+    assert b.filters == {}
+    assert b.projection == []
+    assert b.sort == []
+
+
+def test_options_operators():
+    o = QueryOptions()
+    o.set_filters(
+        from_querystring=[
+            {"name": "name", "op": "startswith", "val": "Orc"},
+            {"name": "score", "op": "between", "val": [10, 20]},
+            {"name": "tags", "op": "any", "val": ["x", "y"]},
+            {"name": "title", "op": "like", "val": "The_%"},
+            {"name": "code", "op": "ilike", "val": "ab%cd"},
+        ]
+    )
+    assert o.filters == {
+        "name": {"$gte": "Orc", "$lt": "Ord"},
+        "score": {"$gte": 10, "$lte": 20},
+        "tags": {"$in": ["x", "y"]},
+        "title": {"$regex": "^The."},
+        "code": {"$regex": "^ab.*cd$", "$options": "i"},
+    }
+    with pytest.raises(ValueError):
+        o.set_filters(from_querystring=[{"name": "score", "op": "between", "val": 10}])
+
+
+def test_options_prefix_upper_bound():
+    assert QueryOptions._prefix_upper_bound("a\U0010ffff") == "b"
+    assert QueryOptions._prefix_upper_bound("\U0010ffff") is None
+    assert QueryOptions._prefix_upper_bound("\ud7ff") == "\ue000"
+
+
+def test_options_groups_and_merging():
+    o = QueryOptions()
+    o.set_filters(
+        from_querystring=[
+            {"name": "score", "op": "ge", "val": 10},
+            {"name": "score", "op": "le", "val": 20},
+            {"name": "score", "op": "ne", "val": 15},
+            {"name": "score", "op": "ne", "val": 16},
+            {"or_": [{"name": "name", "op": "eq", "val": "a"}, {"name": "name", "op": "eq", "val": "b"}]},
+            {"not": {"name": "tags", "op": "in_", "val": ["z"]}},
+        ]
+    )
+    assert o.filters == {
+        "score": {"$gte": 10, "$lte": 20, "$ne": 15},
+        "$and": [{"score": {"$ne": 16}}],
+        "$or": [{"name": {"$eq": "a"}}, {"name": {"$eq": "b"}}],
+        "$nor": [{"tags": {"$in": ["z"]}}],
+    }
+
+
+def test_options_compile():
+    o = QueryOptions(filters={"score": {"$gt": 5}}, projection=["name"], limit=10, sort=[("name", 1)])
+    plan = o.compile()
+    o.filters["score"]["$gt"] = 50
+    assert plan.filters == {"score": {"$gt": 5}}
+    assert plan.sort == (("name", 1),)
+    assert plan.keyset_sort() == [("name", 1), ("_id", 1)]
+    assert plan.compile() is plan
+    with pytest.raises(AttributeError):
+        plan.limit = 20
+    with pytest.raises(AttributeError):
+        plan.set_filters(filters={})
+    with pytest.raises(TypeError):
+        plan.filters["name"] = "x"
+    with pytest.raises(TypeError):
+        plan.filters["score"]["$gt"] = 50
+    assert plan.query_filter() == {"score": {"$gt": 5}}
+    plan.query_filter()["score"]["$gt"] = 50
+    assert plan.filters == {"score": {"$gt": 5}}
+
+    nested = QueryOptions(filters={"$or": [{"tags": {"$in": ["a", "b"]}}, {"score": 1}]}).compile()
+    with pytest.raises(AttributeError):
+        nested.filters["$or"].append({"score": 2})
+    with pytest.raises(TypeError):
+        nested.filters["$or"][0]["tags"]["$in"] = ["c"]
+    assert nested.query_filter() == {"$or": [{"tags": {"$in": ["a", "b"]}}, {"score": 1}]}
+    assert nested.cache_key() == QueryOptions(filters=nested.query_filter()).cache_key()
+
+    same = QueryOptions(filters={"score": {"$gt": 5}}, projection=["name"], limit=10, sort=[("name", 1)]).compile()
+    assert plan == same
+    assert hash(plan) == hash(same)
+    assert plan.cache_key() == o.compile().replace(filters={"score": {"$gt": 5}}).cache_key()
+
+    page = plan.replace(cursor="abc")
+    assert page.cursor == "abc"
+    assert plan.cursor is None
+    assert page != plan
+
+
+def test_options_include():
+    o = QueryOptions(include=["system.publisher"])
+    assert o.cache_key() != QueryOptions().cache_key()
+    o.set_include(from_querystring=" authors, system.publisher ,")
+    assert o.include == ["authors", "system.publisher"]
+    assert o.cache_key() == QueryOptions(include=["system.publisher", "authors"]).cache_key()
+    plan = o.compile()
+    assert plan.include == ("authors", "system.publisher")
+    assert plan.replace(include=[]).include == ()
+    with pytest.raises(AttributeError):
+        plan.set_include(["authors"])
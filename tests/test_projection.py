@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for schema projections
+"""
+
+from sweetrpg_db.schema.projection import schema_projection
+from marshmallow import Schema, fields
+
+
+class ScoreSchema(Schema):
+    value = fields.Int()
+    scale = fields.Str()
+    grader = fields.Nested("GraderSchema")
+
+
+class GraderSchema(Schema):
+    name = fields.Str()
+    scores = fields.List(fields.Nested(ScoreSchema))
+
+
+class ExamSchema(Schema):
+    id = fields.Str()
+    title = fields.Str(attribute="name")
+    score = fields.Nested(ScoreSchema, exclude=["grader"])
+    graders = fields.List(fields.Nested(GraderSchema, only=["name"]))
+    tags = fields.List(fields.Str())
+    secret = fields.Str(load_only=True)
+
+
+def test_schema_projection():
+    assert schema_projection(ExamSchema) == ["id", "name", "score.value", "score.scale", "graders.name", "tags"]
+
+
+def test_schema_projection_only():
+    assert schema_projection(ExamSchema(only=["title", "score"])) == ["name", "score.value", "score.scale"]
+
+
+def test_schema_projection_recursive():
+    assert schema_projection(GraderSchema) == [
+        "name",
+        "scores.value",
+        "scores.scale",
+        "scores.grader",
+    ]
+
+
+def test_schema_projection_method_field():
+    class SummarySchema(Schema):
+        name = fields.Str()
+        summary = fields.Method("get_summary")
+
+        def get_summary(self, obj):
+            return f"{obj.name} ({obj.score})"
+
+    assert schema_projection(SummarySchema) is None
+
+    class NestedSummarySchema(Schema):
+        name = fields.Str()
+        summary = fields.Nested(SummarySchema)
+
+    assert schema_projection(NestedSummarySchema) == ["name", "summary"]
+
+
+def test_schema_projection_overlapping_paths():
+    class OverlapSchema(Schema):
+        score_value = fields.Int(attribute="score.value")
+        score = fields.Dict()
+
+    assert schema_projection(OverlapSchema) == ["score"]
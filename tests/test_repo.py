@@ -6,10 +6,15 @@ Test cases for repo functions
 
 from sweetrpg_db.mongodb.repo import MongoDataRepository
 from sweetrpg_db.mongodb.options import QueryOptions
+from sweetrpg_db.mongodb.cache import LRUCache
 from sweetrpg_model_core.schema.base import BaseSchema
 from sweetrpg_model_core.model.base import BaseModel
-from pymongo import IndexModel, MongoClient
+from sweetrpg_db.mongodb.connection import ConnectionRegistry
+from pymongo import IndexModel, MongoClient, ReadPreference
+from pymongo.write_concern import WriteConcern
+import marshmallow
 import os
+import time
 from dotenv import load_dotenv
 import pytest
 from bson.objectid import ObjectId
@@ -49,6 +54,45 @@ class TestDocument(Document):
         return f"<TestDocument(name={self.name}, score={self.score})>"
 
 
+class RankedDocument(Document):
+    """ """
+
+    meta = {"collection": "ranked_exams", "strict": False, "db_alias": "unit-tests"}
+
+    name = fields.StringField()
+    rank = fields.IntField()
+    score = fields.IntField(default=0)
+
+
+class IncludePublisher(Document):
+    """ """
+
+    meta = {"collection": "include_publishers", "strict": False, "db_alias": "unit-tests"}
+
+    name = fields.StringField()
+    deleted_at = fields.DateTimeField()
+
+
+class IncludeSystem(Document):
+    """ """
+
+    meta = {"collection": "include_systems", "strict": False, "db_alias": "unit-tests"}
+
+    name = fields.StringField()
+    publisher = fields.ReferenceField(IncludePublisher)
+
+
+class IncludeVolume(Document):
+    """ """
+
+    meta = {"collection": "include_volumes", "strict": False, "db_alias": "unit-tests"}
+
+    name = fields.StringField()
+    system = fields.ReferenceField(IncludeSystem)
+    authors = fields.ListField(fields.ReferenceField(IncludePublisher))
+    editor_id = fields.ObjectIdField()
+
+
 @pytest.fixture(scope="session", autouse=True)
 def setup_repo(request):
     # db = MongoClient(host=MONGODB_URI)
@@ -74,6 +118,24 @@ def test_create(request):
     request.session.object_ids.append(doc.pk)
 
 
+def test_create_many(request):
+    data = [{"name": "Quiz 1", "score": 70}, {"score": 101}, {"name": "Quiz 3", "score": 90}]
+    result = request.session.repo.create_many(data, batch_size=2)
+    assert result is not None
+    assert len(result.inserted_ids) == 2
+    assert len(result.errors) == 1
+    assert result.errors[0][0] == 1
+    request.session.object_ids.extend(result.inserted_ids)
+
+
+def test_create_many_ordered(request):
+    data = [{"name": "Quiz 4", "score": 75}, {"score": -1}, {"name": "Quiz 6", "score": 95}]
+    result = request.session.repo.create_many(data, ordered=True)
+    assert len(result.inserted_ids) == 1
+    assert len(result.errors) == 1
+    request.session.object_ids.extend(result.inserted_ids)
+
+
 @pytest.mark.run(after="test_create")
 def test_get(request):
     id = ObjectId(request.session.object_ids[0])
@@ -82,6 +144,210 @@ def test_get(request):
     assert isinstance(doc, TestDocument)
 
 
+@pytest.mark.run(after="test_create")
+def test_get_raw(request):
+    id = request.session.object_ids[0]
+    record = request.session.repo.get(id, raw=True)
+    assert isinstance(record, dict)
+    assert record["id"] == str(id)
+    assert "_id" not in record
+    assert record["name"] == "Pop Quiz"
+
+
+def test_ensure_live_indexes(request):
+    repo = request.session.repo
+    collection = TestDocument._get_collection()
+    if "exam_name_live" in collection.index_information():
+        collection.drop_index("exam_name_live")
+    assert repo.ensure_live_indexes(create=False) == ["exam_name_live"]
+    assert repo.ensure_live_indexes() == ["exam_name_live"]
+    assert repo.ensure_live_indexes() == []
+
+
+def test_soft_delete_strategy(request):
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", soft_delete="type")
+    doc = repo.create({"name": "Typed Delete", "score": 5})
+    assert repo.delete(doc.pk)
+    assert repo.get(doc.pk) is None
+    assert request.session.repo.get(doc.pk) is None
+    assert repo.get(doc.pk, deleted=True) is not None
+    repo.delete(doc.pk, actually=True)
+    with pytest.raises(ValueError):
+        MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", soft_delete="nope")
+
+
+def test_listeners(request):
+    events = []
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", listeners=[events.append])
+    doc = repo.create({"name": "Listened", "score": 40})
+    repo.get(doc.pk)
+    docs = list(repo.iter_query(QueryOptions(filters={"name": {"$eq": "Listened"}})))
+    repo.delete(doc.pk, actually=True)
+    assert [e.operation for e in events] == ["create", "get", "iter_query", "delete"]
+    assert all(e.collection == "exams" and e.duration >= 0 and e.error is None for e in events)
+    assert events[1].result_count == 1
+    assert events[1].filter_shape == {"_id": "?", "deleted_at": "?"}
+    assert events[2].result_count == len(docs) == 1
+    assert events[3].result_count == 1
+
+
+def test_listeners_slow_consumer(request):
+    events = []
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", listeners=[events.append])
+    docs = [repo.create({"name": "Slow Consumer", "score": score}) for score in range(3)]
+    options = QueryOptions(filters={"name": {"$eq": "Slow Consumer"}})
+    for _ in repo.iter_query(options):
+        time.sleep(0.05)
+    for _ in repo.iter_aggregate(options):
+        time.sleep(0.05)
+    records = repo.iter_query(options)
+    next(records)
+    time.sleep(0.05)
+    records.close()
+    for doc in docs:
+        repo.delete(doc.pk, actually=True)
+    streamed = [e for e in events if e.operation.startswith("iter_")]
+    assert [(e.operation, e.result_count) for e in streamed] == [
+        ("iter_query", 3),
+        ("iter_aggregate", 3),
+        ("iter_query", 1),
+    ]
+    assert [e.consumer_time >= 0.15 for e in streamed] == [True, True, False]
+    assert streamed[2].consumer_time >= 0.05
+    assert all(e.duration < 0.05 for e in streamed)
+
+
+def test_connection_alias(request):
+    registry = ConnectionRegistry()
+    # repositories are often created before the application registers their alias
+    early = MongoDataRepository(
+        model=TestModel, document=TestDocument, collection="exams", alias="unit-tests-routed", registry=registry
+    )
+    registry.register(
+        "unit-tests-routed",
+        host=MONGODB_URI,
+        read_preferences={"query": "secondaryPreferred"},
+        write_concerns={"create": {"w": 1}},
+    )
+    try:
+        repo = MongoDataRepository(
+            model=TestModel, document=TestDocument, collection="exams", alias="unit-tests-routed", registry=registry
+        )
+        assert repo._get_collection("query").read_preference == ReadPreference.SECONDARY_PREFERRED
+        assert repo._get_collection("get").read_preference == ReadPreference.PRIMARY
+        assert repo._get_collection("create").write_concern == WriteConcern(w=1)
+        assert early._get_collection("query").read_preference == ReadPreference.SECONDARY_PREFERRED
+        doc = repo.create({"name": "Routed", "score": 12})
+        assert request.session.repo.get(doc.pk).name == "Routed"
+        assert repo.get(doc.pk).score == 12
+        assert repo.delete(doc.pk, actually=True)
+    finally:
+        registry.unregister("unit-tests-routed")
+    assert early.connection is None
+    assert early._collection_options("query") == {}
+
+
+def test_unit_of_work(request):
+    events = []
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", listeners=[events.append])
+    existing = repo.create({"name": "Unit of Work", "score": 10})
+    with repo.unit_of_work() as uow:
+        created = uow.create({"name": "Unit of Work", "score": 20})
+        first = uow.update(existing.pk, {"inc__score": 5})
+        second = uow.update(str(existing.pk), {"inc__score": 5, "name": "Unit of Work Updated"})
+        missing = uow.update(ObjectId(), {"score": 1})
+        deleted = uow.delete(created.record_id)
+        assert len(uow) == 4
+        assert not created.flushed
+    assert len(uow) == 0
+    assert [e.operation for e in events] == ["create", "flush"]
+    assert events[1].result_count == 5
+    assert all(p.ok for p in (created, first, second, missing, deleted))
+    result = uow.results[0]
+    assert (result.inserted_count, result.matched_count, result.modified_count) == (1, 2, 2)
+
+    record = repo.get(existing.pk)
+    assert (record.name, record.score) == ("Unit of Work Updated", 20)
+    assert repo.get(created.record_id) is None
+    assert repo.get(created.record_id, deleted=True).score == 20
+
+    uow = repo.unit_of_work(ordered=True, max_size=3)
+    before = uow.create({"name": "Before Duplicate", "score": 1})
+    duplicate = uow.create({"id": existing.pk, "name": "Duplicate"})
+    after = uow.update(existing.pk, {"score": 99})
+    assert len(uow.results) == 1
+    assert before.ok
+    assert duplicate.flushed and duplicate.error is not None
+    assert not after.flushed
+    assert [p for p, _ in uow.results[0].errors] == [duplicate]
+
+    with pytest.raises(RuntimeError):
+        with repo.unit_of_work() as uow:
+            uow.delete(existing.pk, actually=True)
+            raise RuntimeError()
+    assert repo.get(existing.pk) is not None
+    for record_id in (existing.pk, created.record_id, before.record_id):
+        repo.delete(record_id, actually=True)
+
+
+@pytest.mark.run(after="test_create")
+def test_get_cached(request):
+    cache = LRUCache()
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", cache=cache)
+    data = {"name": "Cached Quiz", "score": 50}
+    doc = repo.create(data)
+    assert repo.get(doc.pk).score == 50
+    assert repo.get(str(doc.pk)).score == 50
+    assert repo.get(doc.pk, raw=True)["score"] == 50
+    assert cache.hits == 2
+    assert cache.misses == 1
+    repo.update(doc.pk, {"score": 51})
+    assert repo.get(doc.pk).score == 51
+    repo.delete(doc.pk)
+    assert repo.get(doc.pk) is None
+    repo.delete(doc.pk, actually=True)
+    MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", cache=cache)
+    with pytest.raises(ValueError):
+        MongoDataRepository(
+            model=TestModel, document=TestDocument, collection="exams", cache=cache, soft_delete="type"
+        )
+
+
+def test_get_cached_concurrent_write(monkeypatch):
+    cache = LRUCache()
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", cache=cache)
+    doc = repo.create({"name": "Raced Quiz", "score": 60})
+
+    class RacingQuery(object):
+        """Reads the record, and then lets another write invalidate it before the read is cached."""
+
+        def as_pymongo(self):
+            return self
+
+        def first(self):
+            record = TestDocument._get_collection().find_one({"_id": doc.pk})
+            repo.update(doc.pk, {"score": 61})
+            return record
+
+    monkeypatch.setattr(repo, "_project", lambda queryset: RacingQuery())
+    assert repo.get(doc.pk).score == 60
+    monkeypatch.undo()
+    assert repo.get(doc.pk).score == 61
+    repo.delete(doc.pk, actually=True)
+
+
+@pytest.mark.run(after="test_create")
+def test_get_many(request):
+    id = request.session.object_ids[0]
+    missing = ObjectId()
+    docs = request.session.repo.get_many([missing, str(id), id])
+    assert len(docs) == 3
+    assert docs[0] is None
+    assert isinstance(docs[1], TestDocument)
+    assert docs[1].pk == id
+    assert docs[2].pk == id
+
+
 @pytest.mark.run(after="test_create")
 def test_query_all(request):
     options = QueryOptions()
@@ -90,6 +356,54 @@ def test_query_all(request):
     assert len(docs) >= len(request.session.object_ids)
 
 
+@pytest.mark.run(after="test_create")
+def test_query_raw(request):
+    options = QueryOptions(projection=["score"])
+    records = request.session.repo.query(options, raw=True)
+    assert len(records) >= len(request.session.object_ids)
+    for r in records:
+        assert isinstance(r, dict)
+        assert isinstance(r["id"], str)
+        assert "name" not in r
+
+
+@pytest.mark.run(after="test_create")
+def test_query_cached(request):
+    query_cache = LRUCache()
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", query_cache=query_cache)
+    options = QueryOptions(filters={"name": {"$eq": "Query Cache"}})
+    assert repo.query(options) == []
+    assert repo.query(options, raw=True) == []
+    assert query_cache.hits == 1
+    doc = repo.create({"name": "Query Cache", "score": 12})
+    docs = repo.query(options)
+    assert len(docs) == 1
+    assert isinstance(docs[0], TestDocument)
+    assert repo.query(options, raw=True)[0]["score"] == 12
+    assert query_cache.hits == 2
+    repo.delete(doc.pk, actually=True)
+    assert repo.query(options) == []
+
+    class NameSchema(marshmallow.Schema):
+        id = marshmallow.fields.Str()
+        name = marshmallow.fields.Str()
+
+    with pytest.raises(ValueError):
+        MongoDataRepository(
+            model=TestModel, document=TestDocument, collection="exams", query_cache=query_cache, schema=NameSchema
+        )
+
+
+@pytest.mark.run(after="test_create")
+def test_iter_query(request):
+    options = QueryOptions(sort=[("score", 1)])
+    docs = request.session.repo.iter_query(options, batch_size=2)
+    assert not isinstance(docs, list)
+    docs = list(docs)
+    assert len(docs) >= len(request.session.object_ids)
+    assert all(isinstance(d, TestDocument) for d in docs)
+
+
 @pytest.mark.run(after="test_create")
 def test_query_deleted(request):
     data = {"name": "Delete Me", "score": 86}
@@ -101,6 +415,22 @@ def test_query_deleted(request):
     deleted_docs = request.session.repo.query(options, deleted=True)
     assert deleted_docs is not None
     assert len(deleted_docs) >= 1
+    request.session.object_ids.append(doc.pk)
+
+
+@pytest.mark.run(after="test_query_deleted")
+def test_restore(request):
+    data = {"name": "Restore Me", "score": 87}
+    doc = request.session.repo.create(data)
+    request.session.object_ids.append(doc.pk)
+    result = request.session.repo.delete(doc.pk)
+    assert result.matched_count == 1
+    assert result.modified_count == 1
+    assert request.session.repo.get(doc.pk) is None
+    assert not request.session.repo.delete(doc.pk)
+    assert request.session.repo.restore(doc.pk)
+    assert request.session.repo.get(doc.pk) is not None
+    assert not request.session.repo.restore(doc.pk)
 
 
 @pytest.mark.run(after="test_create")
@@ -133,6 +463,143 @@ def test_query_sorted(request):
     assert sorted_properly
 
 
+@pytest.mark.run(after="test_query_sorted")
+def test_query_plan(request):
+    options = QueryOptions(sort=[("score", 1)], limit=2)
+    options.set_filters(
+        from_querystring=[
+            {"name": "name", "op": "startswith", "val": "Th"},
+            {"or": [{"name": "score", "op": "between", "val": [25, 35]}, {"name": "name", "op": "eq", "val": "First"}]},
+        ]
+    )
+    plan = options.compile()
+    docs = request.session.repo.query(plan)
+    assert [d.name for d in docs] == ["Third"]
+    assert plan.query_filter() == options.filters
+
+    plan = QueryOptions(sort=[("score", 1)], limit=2).compile()
+    page = request.session.repo.query_page(plan)
+    assert page.next_cursor is not None
+    next_page = request.session.repo.query_page(plan.replace(cursor=page.next_cursor))
+    assert not {d.pk for d in page} & {d.pk for d in next_page}
+
+
+@pytest.mark.run(after="test_query_sorted")
+def test_query_page(request):
+    options = QueryOptions(sort=[("score", 1)], limit=2)
+    expected = [d.pk for d in request.session.repo.query(QueryOptions(sort=[("score", 1), ("_id", 1)]))]
+    seen = []
+    page = request.session.repo.query_page(options)
+    while True:
+        assert len(page) <= 2
+        seen.extend(d.pk for d in page)
+        if page.next_cursor is None:
+            break
+        options.cursor = page.next_cursor
+        page = request.session.repo.query_page(options)
+    assert seen == expected
+
+
+def test_query_page_nulls():
+    repo = MongoDataRepository(model=dict, document=RankedDocument, collection="ranked_exams")
+    collection = RankedDocument._get_collection()
+    # `score` is left unset, so documents would see its default instead of the stored (missing) value
+    collection.insert_many([{"name": f"n{i}", "rank": None if i < 3 else i} for i in range(6)])
+    try:
+        for sort in ([("rank", 1)], [("rank", -1)], [("score", 1), ("rank", -1)]):
+            keyset_sort = QueryOptions(sort=sort).keyset_sort()
+            expected = [r["name"] for r in repo.query(QueryOptions(sort=keyset_sort), raw=True)]
+            for raw in (False, True):
+                options = QueryOptions(sort=sort, limit=2)
+                seen = []
+                while True:
+                    page = repo.query_page(options, raw=raw)
+                    seen.extend(r["name"] if raw else r.name for r in page)
+                    if page.next_cursor is None:
+                        break
+                    options.cursor = page.next_cursor
+                assert seen == expected
+    finally:
+        collection.delete_many({})
+
+
+@pytest.mark.run(after="test_query_sorted")
+def test_count(request):
+    options = QueryOptions(filters={"name": {"$in": ["First", "Second", "Third"]}})
+    assert request.session.repo.count(options) == 3
+    assert request.session.repo.count() >= 3
+    assert request.session.repo.count(estimated=True) >= 3
+
+
+@pytest.mark.run(after="test_query_sorted")
+def test_query_with_total(request):
+    options = QueryOptions(filters={"name": {"$in": ["First", "Second", "Third"]}}, sort=[("score", -1)], limit=2)
+    page = request.session.repo.query_with_total(options)
+    assert page.total == 3
+    assert [d.name for d in page] == ["Third", "Second"]
+    # the sort runs before $facet, where it can use an index
+    pipeline = request.session.repo._total_pipeline(options)
+    assert [next(iter(stage)) for stage in pipeline] == ["$match", "$sort", "$facet"]
+    assert [next(iter(stage)) for stage in pipeline[2]["$facet"]["records"]] == ["$limit"]
+    options.skip = 2
+    page = request.session.repo.query_with_total(options, raw=True)
+    assert page.total == 3
+    assert [d["name"] for d in page] == ["First"]
+
+
+@pytest.mark.run(after="test_query_sorted")
+def test_aggregate(request):
+    repo = request.session.repo
+    options = QueryOptions(filters={"name": {"$in": ["First", "Second", "Third"]}}, sort=[("score", -1)], limit=2)
+    stages = [{"$group": {"_id": None, "total": {"$sum": "$score"}, "count": {"$sum": 1}}}]
+    results = repo.aggregate(options, stages, allow_disk_use=True, batch_size=10)
+    assert len(results) == 1
+    assert results[0]["total"] == 50
+    assert results[0]["count"] == 2
+
+    documents = repo.iter_aggregate(options, [{"$project": {"_id": 0, "score": 1}}], batch_size=1)
+    assert list(documents) == [{"score": 30}, {"score": 20}]
+
+    pipeline = repo._aggregate_pipeline(options, stages)
+    assert pipeline[0] == {"$match": {"name": {"$in": ["First", "Second", "Third"]}, "deleted_at": None}}
+    assert pipeline[1:3] == [{"$sort": {"score": -1}}, {"$limit": 2}]
+    assert pipeline[3:] == stages
+
+
+@pytest.mark.run(after="test_query_sorted")
+def test_schema_projection(request):
+    class NameSchema(marshmallow.Schema):
+        id = marshmallow.fields.Str()
+        name = marshmallow.fields.Str()
+
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", schema=NameSchema)
+    assert repo.default_projection == ["id", "name"]
+    options = QueryOptions(filters={"name": {"$eq": "Third"}})
+    records = repo.query(options, raw=True)
+    assert records == [{"id": records[0]["id"], "name": "Third"}]
+    assert repo.get(records[0]["id"], raw=True) == records[0]
+    assert repo.get_many([records[0]["id"]], raw=True) == records
+    assert repo.query(QueryOptions(filters=options.filters, projection=["score"]), raw=True)[0]["score"] == 30
+    assert repo.update(records[0]["id"], {"score": 30}, raw=True) == records[0]
+    assert repo.aggregate(options, [{"$project": {"_id": 0, "score": 1}}]) == [{"score": 30}]
+
+
+def test_schema_projection_undeclared(request):
+    class AuditedSchema(TestSchema):
+        name = marshmallow.fields.Str()
+
+    repo = MongoDataRepository(model=TestModel, document=TestDocument, collection="exams", schema=AuditedSchema)
+    # TestDocument does not declare the audit fields that BaseSchema dumps, but soft deletes still store them
+    assert repo.default_projection is None
+    doc = repo.create({"name": "Audited", "score": 5})
+    repo.delete(doc.pk)
+    record = repo.get(doc.pk, deleted=True, raw=True)
+    assert record["name"] == "Audited"
+    assert record["score"] == 5
+    assert record["deleted_at"] is not None
+    repo.delete(doc.pk, actually=True)
+
+
 @pytest.mark.run(after="test_create")
 def test_query_with_projections(request):
     options = QueryOptions(projection=["score"])
@@ -148,6 +615,112 @@ def test_update(request):
     id = ObjectId(request.session.object_ids[0])
     updated_doc = request.session.repo.update(id, {"score": 22})
     assert updated_doc is not None
+    assert isinstance(updated_doc, TestDocument)
+    assert updated_doc.score == 22
+    assert updated_doc.name == "Pop Quiz"
+
+
+@pytest.mark.run(after="test_update")
+def test_update_projection(request):
+    id = ObjectId(request.session.object_ids[0])
+    updated = request.session.repo.update(id, {"inc__score": 1}, projection=["score"], raw=True)
+    assert updated == {"id": str(id), "score": 23}
+
+
+def test_update_missing(request):
+    assert request.session.repo.update(ObjectId(), {"score": 1}) is None
+
+
+def test_iter_parallel(request):
+    repo = request.session.repo
+    ids = repo.create_many({"name": "Parallel Scan", "score": (i * 7) % 30} for i in range(30)).inserted_ids
+    repo.delete(ids[0])
+    options = QueryOptions(filters={"name": {"$eq": "Parallel Scan"}})
+
+    docs = list(repo.iter_parallel(options, workers=3, batch_size=4))
+    assert sorted(d.pk for d in docs) == sorted(ids[1:])
+    records = list(repo.iter_parallel(options, workers=3, ordered=True, raw=True))
+    assert [r["id"] for r in records] == sorted(str(i) for i in ids[1:])
+    scores = [d.score for d in repo.iter_parallel(options, key="score", ordered=True, deleted=True)]
+    assert scores == sorted((i * 7) % 30 for i in range(30))
+
+    scan = repo.iter_parallel(options, workers=3, batch_size=2)
+    assert next(scan).name == "Parallel Scan"
+    scan.close()
+    with pytest.raises(ValueError):
+        next(repo.iter_parallel(QueryOptions(sort=[("score", 1)])))
+    TestDocument._get_collection().delete_many({"name": "Parallel Scan"})
+
+
+def test_query_include(request):
+    events = []
+    registry = ConnectionRegistry()
+    publisher_repo = MongoDataRepository(model=dict, document=IncludePublisher, collection="include_publishers")
+    publishers = [IncludePublisher(name=name).save() for name in ("P1", "P2")]
+    publisher_repo.delete(publishers[1].pk)
+    systems = [IncludeSystem(name=f"S{i}", publisher=p).save() for i, p in enumerate(publishers, 1)]
+    for i in range(4):
+        IncludeVolume(name=f"V{i}", system=systems[i % 2], authors=publishers, editor_id=publishers[0].pk).save()
+    repo = MongoDataRepository(
+        model=dict,
+        document=IncludeVolume,
+        collection="include_volumes",
+        listeners=[events.append],
+        relations={"editor_id": publisher_repo},
+    )
+    options = QueryOptions(sort=[("name", 1)], include=["system.publisher", "authors"])
+
+    docs = repo.query(options)
+    assert [e.operation for e in events] == ["get_many", "get_many", "get_many", "query"]
+    assert [d.system.name for d in docs] == ["S1", "S2", "S1", "S2"]
+    assert docs[0].system.publisher.name == "P1"
+    assert isinstance(docs[0]._data["system"], IncludeSystem)
+    assert not isinstance(docs[1].system._data["publisher"], IncludePublisher)
+    assert [a.name for a in docs[0].authors[:1]] == ["P1"]
+
+    options.set_include(from_querystring="system.publisher,editor_id")
+    records = repo.query_page(options, raw=True).records
+    assert records[0]["system"]["publisher"]["name"] == "P1"
+    assert records[1]["system"]["publisher"] == str(publishers[1].pk)
+    assert records[0]["editor_id"]["name"] == "P1"
+    with pytest.raises(ValueError):
+        repo.query(options)
+    with pytest.raises(ValueError):
+        repo.query(QueryOptions(include=["name"]), raw=True)
+
+    records = repo.query(QueryOptions(projection=["name"], include=["system.publisher"]), raw=True)
+    assert records[0]["system"]["publisher"]["name"] == "P1"
+    typed_repo = MongoDataRepository(
+        model=dict, document=IncludeVolume, collection="include_volumes", soft_delete="type", registry=registry
+    )
+    system_repo, _, _ = typed_repo._relation("system")
+    assert (system_repo.soft_delete, system_repo.registry) == ("type", registry)
+    for document in (IncludeVolume, IncludeSystem, IncludePublisher):
+        document._get_collection().delete_many({})
+
+
+def test_schema_projection_reference():
+    class SystemSchema(marshmallow.Schema):
+        name = marshmallow.fields.Str()
+
+    class VolumeSchema(marshmallow.Schema):
+        id = marshmallow.fields.Str()
+        name = marshmallow.fields.Str()
+        system = marshmallow.fields.Nested(SystemSchema, only=["name"])
+        authors = marshmallow.fields.List(marshmallow.fields.Nested(SystemSchema))
+
+    repo = MongoDataRepository(model=dict, document=IncludeVolume, collection="include_volumes", schema=VolumeSchema)
+    assert repo.default_projection == ["id", "name", "system", "authors"]
+    system = IncludeSystem(name="Projected System").save()
+    IncludeVolume(name="Projected Volume", system=system, editor_id=system.pk).save()
+    filters = {"name": {"$eq": "Projected Volume"}}
+    records = repo.query(QueryOptions(filters=filters), raw=True)
+    assert records[0]["system"] == str(system.pk)
+    assert "editor_id" not in records[0]
+    records = repo.query(QueryOptions(filters=filters, include=["system"]), raw=True)
+    assert records[0]["system"]["name"] == "Projected System"
+    for document in (IncludeVolume, IncludeSystem):
+        document._get_collection().delete_many({})
 
 
 @pytest.mark.run("last")
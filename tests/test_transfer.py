@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for export and import
+"""
+
+from sweetrpg_db.mongodb.repo import MongoDataRepository
+from sweetrpg_db.mongodb.options import QueryOptions
+from sweetrpg_db.mongodb.transfer import export_records, import_records, read_records
+import datetime
+import os
+from dotenv import load_dotenv
+import pytest
+from mongoengine import connect, Document, fields
+
+
+load_dotenv()
+MONGODB_URI = os.environ["MONGODB_URI"]
+
+
+class TransferDocument(Document):
+    """ """
+
+    meta = {"collection": "transfer_exams", "strict": False, "db_alias": "unit-tests"}
+
+    name = fields.StringField(required=True)
+    score = fields.IntField(min_value=0, max_value=100, default=0)
+    deleted_at = fields.DateTimeField()
+
+
+class StrictTransferDocument(Document):
+    """ """
+
+    meta = {"collection": "transfer_exams", "db_alias": "unit-tests"}
+
+    name = fields.StringField(required=True)
+
+
+@pytest.fixture
+def repo():
+    connect(host=MONGODB_URI, alias="unit-tests")
+    TransferDocument._get_collection().delete_many({})
+    yield MongoDataRepository(model=dict, document=TransferDocument, collection="transfer_exams")
+    TransferDocument._get_collection().delete_many({})
+
+
+def _seed(repo, count: int):
+    result = repo.create_many({"name": f"Exam {i:03d}", "score": i % 100} for i in range(count))
+    return result.inserted_ids
+
+
+def test_split_boundaries(repo):
+    ids = sorted(_seed(repo, 40))
+    boundaries = repo._split_boundaries({}, 4)
+    assert boundaries == [ids[10], ids[20], ids[30]]
+    filters = repo._range_filters({"score": {"$gte": 0}}, boundaries)
+    collection = TransferDocument._get_collection()
+    assert [collection.count_documents(f) for f in filters] == [10, 10, 10, 10]
+    assert repo._split_boundaries({}, 1) == []
+    assert repo._range_filters({}, []) == [{}]
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "bson"])
+def test_export_import(repo, tmp_path, fmt):
+    ids = _seed(repo, 25)
+    repo.delete(ids[0])
+    path = str(tmp_path / f"exams.{fmt}")
+
+    result = export_records(repo, path, workers=3, batch_size=4)
+    assert result.count == 24
+    with open(path, "rb") as f:
+        records = list(read_records(f, fmt))
+    assert [r["_id"] for r in records] == sorted(ids[1:])
+
+    assert export_records(repo, path, deleted=True, workers=3).count == 25
+    TransferDocument._get_collection().delete_many({})
+    result = import_records(repo, path, workers=2, batch_size=7)
+    assert (result.count, result.written_count, result.errors) == (25, 25, [])
+    assert isinstance(repo.get(ids[1]).name, str)
+    assert isinstance(TransferDocument._get_collection().find_one({"_id": ids[0]})["deleted_at"], datetime.datetime)
+
+
+def test_export_projection(repo, tmp_path):
+    _seed(repo, 5)
+    path = str(tmp_path / "exams.jsonl")
+    export_records(repo, path, options=QueryOptions(filters={"score": {"$lt": 2}}, projection=["name"]), workers=2)
+    with open(path, "rb") as f:
+        records = list(read_records(f, "ndjson"))
+    assert [set(r) for r in records] == [{"_id", "name"}, {"_id", "name"}]
+
+
+def test_import_errors(repo, tmp_path):
+    ids = _seed(repo, 3)
+    path = str(tmp_path / "exams.jsonl")
+    export_records(repo, path)
+    with open(path, "ab") as f:
+        f.write(b'{"name": "New Exam", "score": 5}\n{"name": "Bad Exam", "score": 500}\n')
+
+    result = import_records(repo, path, validate=True)
+    assert (result.count, result.written_count) == (5, 1)
+    assert [index for index, _ in result.errors] == [0, 1, 2, 4]
+
+    TransferDocument._get_collection().update_one({"_id": ids[0]}, {"$set": {"score": 99}})
+    result = import_records(repo, path, upsert=True, batch_size=2)
+    assert result.written_count == 5
+    assert TransferDocument._get_collection().find_one({"_id": ids[0]})["score"] == 0
+
+
+def test_import_undeclared_fields(repo, tmp_path):
+    path = str(tmp_path / "exams.jsonl")
+    with open(path, "wb") as f:
+        f.write(b'{"name": "a"}\n{"name": "b", "extra": 1}\n{"name": "c"}\n')
+
+    strict_repo = MongoDataRepository(model=dict, document=StrictTransferDocument, collection="transfer_exams")
+    result = import_records(strict_repo, path, validate=True, batch_size=1)
+    assert (result.count, result.written_count) == (3, 2)
+    assert [index for index, _ in result.errors] == [1]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+__author__ = "Paul Schifferer <dm@sweetrpg.com>"
+"""
+Test cases for units of work
+"""
+
+from sweetrpg_db.mongodb.unit_of_work import BaseUnitOfWork
+
+
+def test_merge_update():
+    uow = BaseUnitOfWork(None)
+    existing = {"$set": {"name": "a"}, "$inc": {"score": 1}}
+    assert uow._merge_update(existing, {"$set": {"name": "b", "level": 2}, "$inc": {"score": 4}})
+    assert existing == {"$set": {"name": "b", "level": 2}, "$inc": {"score": 5}}
+    assert uow._merge_update(existing, {"$unset": {"notes": ""}})
+    assert existing["$unset"] == {"notes": ""}
+
+
+def test_merge_update_conflicts():
+    uow = BaseUnitOfWork(None)
+    existing = {"$set": {"name": "a", "stats": {"hp": 1}}, "$inc": {"score": 1}, "$push": {"tags": "x"}}
+    original = {k: dict(v) for k, v in existing.items()}
+    assert not uow._merge_update(existing, {"$inc": {"name": 1}})
+    assert not uow._merge_update(existing, {"$set": {"score": 3}})
+    assert not uow._merge_update(existing, {"$set": {"stats.hp": 2}})
+    assert not uow._merge_update(existing, {"$set": {"tags": []}})
+    assert not uow._merge_update(existing, {"$push": {"other": 1}})
+    assert existing == original